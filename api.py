@@ -33,6 +33,7 @@ import json
 #*** Constants for REST API:
 REST_RESULT = 'result'
 REST_NG = 'failure'
+REST_OK = 'success'
 REST_DETAILS = 'details'
 NMETA_INSTANCE = 'nmeta_api_app'
 
@@ -130,6 +131,103 @@ class RESTAPIController(ControllerBase):
                         ('packet_delta')
         return packet_processing_stats
 
+    @rest_command
+    def get_policy_stats(self, req, **kwargs):
+        """
+        REST API function that returns per-rule and per-condition
+        policy evaluation counters (evaluations, matches and time)
+        """
+        nmeta = self.nmeta_parent_self
+        return nmeta.tc_policy.get_policy_stats()
+
+    @rest_command
+    def reset_policy_stats(self, req, **kwargs):
+        """
+        REST API function that resets the per-rule and per-condition
+        policy evaluation counters
+        """
+        nmeta = self.nmeta_parent_self
+        nmeta.tc_policy.reset_policy_stats()
+        return {REST_RESULT: REST_OK}
+
+    @rest_command
+    def get_identity_queue_stats(self, req, **kwargs):
+        """
+        REST API function that returns the identity queue counters
+        (enqueued, dropped, processed, errors, backlog)
+        """
+        nmeta = self.nmeta_parent_self
+        return nmeta.tc_policy.get_identity_queue_stats()
+
+    @rest_command
+    def get_counter_classify_stats(self, req, **kwargs):
+        """
+        REST API function that returns the flow counter classification
+        counters (flows, polls, replies, remarked, removed, active)
+        """
+        nmeta = self.nmeta_parent_self
+        return nmeta.counter_classify.get_counter_stats()
+
+    @rest_command
+    def get_async_classify_stats(self, req, **kwargs):
+        """
+        REST API function that returns the asynchronous classification
+        counters (submitted, completed, rejected, timeouts, errors,
+        fallbacks, remarked, workers, queued, running)
+        """
+        nmeta = self.nmeta_parent_self
+        return nmeta.async_classify.get_async_stats()
+
+    @rest_command
+    def get_verdict_cache_stats(self, req, **kwargs):
+        """
+        REST API function that returns the statistical verdict cache
+        counters (hits, misses, samples, disagreements, evictions,
+        entries)
+        """
+        nmeta = self.nmeta_parent_self
+        return nmeta.tc_policy.statistical.get_verdict_cache_stats()
+
+    @rest_command
+    def get_statistical_decisions(self, req, **kwargs):
+        """
+        REST API function that returns, per statistical classifier, the
+        distribution of packets inspected per flow before deciding
+        """
+        nmeta = self.nmeta_parent_self
+        return nmeta.tc_policy.statistical.get_decision_stats()
+
+    @rest_command
+    def get_statistical_model(self, req, **kwargs):
+        """
+        REST API function that returns the trained model in use by the
+        statistical_model classifier and its counters
+        """
+        nmeta = self.nmeta_parent_self
+        return nmeta.tc_policy.statistical.model.get_model_info()
+
+    @rest_command
+    def reload_statistical_model(self, req, **kwargs):
+        """
+        REST API function that reloads the trained model file of the
+        statistical_model classifier and swaps it in. The model in use
+        is kept if the file doesn't load
+        """
+        nmeta = self.nmeta_parent_self
+        if nmeta.tc_policy.statistical.model.load_model():
+            return {REST_RESULT: REST_OK}
+        return {REST_RESULT: REST_NG,
+                REST_DETAILS: 'model file did not load, see log'}
+
+    @rest_command
+    def get_policy_analysis(self, req, **kwargs):
+        """
+        REST API function that returns shadowed, redundant and
+        conflicting policy rules (by rule index)
+        """
+        nmeta = self.nmeta_parent_self
+        return nmeta.tc_policy.get_policy_analysis()
+
     @rest_command
     def list_flow_table(self, req, **kwargs):
         """
@@ -148,10 +246,10 @@ class RESTAPIController(ControllerBase):
         identity metadata
         """
         nmeta = self.nmeta_parent_self
+        #*** Identity metadata is kept up to date on the flows as identity
+        #*** changes, so this is just a read:
         _fm_table = nmeta.flowmetadata.get_fm_table()
-        #*** Ask the identity module to augment the flow metadata:
-        _result = nmeta.tc_policy.identity.get_augmented_fm_table(_fm_table)
-        return _result
+        return _fm_table
 
     @rest_command
     def list_flow_table_by_IP(self, req, **kwargs):
@@ -240,6 +338,19 @@ class RESTAPIController(ControllerBase):
             return 0
         return _id_service
 
+    @rest_command
+    def get_id_service_ips(self, req, **kwargs):
+        """
+        REST API function that returns the IP addresses that currently
+        back a DNS service, with seconds of validity remaining for each
+        """
+        nmeta = self.nmeta_parent_self
+        #*** context is future-proofing for when the system will support 
+        #*** multiple contexts. For now just set to 'default':
+        context = 'default'
+        return nmeta.tc_policy.identity.get_service_ips(context,
+                                                        kwargs['service'])
+
 class Api(object):
     """
     This class is instantiated by nmeta.py and provides methods
@@ -251,14 +362,24 @@ class Api(object):
     url_flowtable_by_ip = '/nmeta/flowtable/{ip}'
     url_identity_nic_table = '/nmeta/identity/nictable/'
     url_identity_system_table = '/nmeta/identity/systemtable/'
+    url_policy_analysis = '/nmeta/policy/analysis/'
+    url_policy_statistical_model = '/nmeta/policy/statistical/model/'
     #*** Measurement APIs:
     url_data_size_rows = '/nmeta/measurement/tablesize/rows/'
     url_measure_event_rates = '/nmeta/measurement/eventrates/'
     url_measure_pkt_time = '/nmeta/measurement/metrics/packet_time/'
+    url_measure_policy = '/nmeta/measurement/policy/'
+    url_measure_identity_queue = '/nmeta/measurement/identityqueue/'
+    url_measure_counter_classify = '/nmeta/measurement/counterclassify/'
+    url_measure_verdict_cache = '/nmeta/measurement/verdictcache/'
+    url_measure_async_classify = '/nmeta/measurement/asyncclassify/'
+    url_measure_statistical_decisions = \
+                                '/nmeta/measurement/statisticaldecisions/'
     #*** New Identity Metadata calls:
     url_identity_mac = '/nmeta/identity/mac/'
     url_identity_ip = '/nmeta/identity/ip/'
     url_identity_service = '/nmeta/identity/service/'
+    url_identity_service_ips = '/nmeta/identity/service/{service}/ips/'
     #
     IP_PATTERN = r'\b(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)(\.|$){4}\b'
     _CONTEXTS = {'wsgi': WSGIApplication}
@@ -323,6 +444,63 @@ class Api(object):
                        requirements=requirements,
                        action='get_packet_time',
                        conditions=dict(method=['GET']))
+        mapper.connect('policy_stats', self.url_measure_policy,
+                       controller=RESTAPIController,
+                       requirements=requirements,
+                       action='get_policy_stats',
+                       conditions=dict(method=['GET']))
+        mapper.connect('policy_stats_reset', self.url_measure_policy,
+                       controller=RESTAPIController,
+                       requirements=requirements,
+                       action='reset_policy_stats',
+                       conditions=dict(method=['DELETE']))
+        mapper.connect('identity_queue_stats',
+                       self.url_measure_identity_queue,
+                       controller=RESTAPIController,
+                       requirements=requirements,
+                       action='get_identity_queue_stats',
+                       conditions=dict(method=['GET']))
+        mapper.connect('counter_classify_stats',
+                       self.url_measure_counter_classify,
+                       controller=RESTAPIController,
+                       requirements=requirements,
+                       action='get_counter_classify_stats',
+                       conditions=dict(method=['GET']))
+        mapper.connect('async_classify_stats',
+                       self.url_measure_async_classify,
+                       controller=RESTAPIController,
+                       requirements=requirements,
+                       action='get_async_classify_stats',
+                       conditions=dict(method=['GET']))
+        mapper.connect('verdict_cache_stats',
+                       self.url_measure_verdict_cache,
+                       controller=RESTAPIController,
+                       requirements=requirements,
+                       action='get_verdict_cache_stats',
+                       conditions=dict(method=['GET']))
+        mapper.connect('statistical_decisions',
+                       self.url_measure_statistical_decisions,
+                       controller=RESTAPIController,
+                       requirements=requirements,
+                       action='get_statistical_decisions',
+                       conditions=dict(method=['GET']))
+        mapper.connect('policy_analysis', self.url_policy_analysis,
+                       controller=RESTAPIController,
+                       requirements=requirements,
+                       action='get_policy_analysis',
+                       conditions=dict(method=['GET']))
+        mapper.connect('statistical_model',
+                       self.url_policy_statistical_model,
+                       controller=RESTAPIController,
+                       requirements=requirements,
+                       action='get_statistical_model',
+                       conditions=dict(method=['GET']))
+        mapper.connect('statistical_model_reload',
+                       self.url_policy_statistical_model,
+                       controller=RESTAPIController,
+                       requirements=requirements,
+                       action='reload_statistical_model',
+                       conditions=dict(method=['PUT']))
         mapper.connect('flowtable', self.url_flowtable,
                        controller=RESTAPIController,
                        requirements=requirements,
@@ -363,3 +541,8 @@ class Api(object):
                        requirements=requirements,
                        action='get_id_service',
                        conditions=dict(method=['GET']))
+        mapper.connect('identity_service_ips', self.url_identity_service_ips,
+                       controller=RESTAPIController,
+                       requirements=requirements,
+                       action='get_id_service_ips',
+                       conditions=dict(method=['GET']))
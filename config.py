@@ -35,14 +35,38 @@ CONFIG_TEMPLATE = \
     {
     'miss_send_len': 1500,
     'ofpc_frag': 0,
+    'proactive_static_rules': 0,
     'fm_table_max_age': 600,
     'fm_table_tidyup_interval': 12,
     'identity_nic_table_max_age': 600,
     'identity_system_table_max_age': 600,
     'identity_table_tidyup_interval': 5,
     'identity_arp_max_age': 60,
+    'identity_persist_enabled': 0,
+    'identity_persist_directory': 'persist',
+    'identity_snapshot_interval': 300,
+    'identity_journal_flush_interval': 1,
+    'identity_queue_max': 10000,
     'statistical_fcip_table_max_age': 600,
     'statistical_fcip_table_tidyup_interval': 5,
+    'statistical_fcip_buffer_packets': 0,
+    'statistical_counter_mode': 0,
+    'statistical_counter_poll_min': 1,
+    'statistical_counter_poll_max': 16,
+    'statistical_counter_hog_rate': 1000000,
+    'statistical_counter_hog_avg_size': 1200,
+    'statistical_model_file': '',
+    'statistical_model_packets': 5,
+    'statistical_model_batch_interval': 0.1,
+    'statistical_verdict_cache_max': 10000,
+    'statistical_verdict_cache_ttl': 300,
+    'statistical_verdict_cache_agree': 5,
+    'statistical_verdict_cache_sample': 50,
+    'async_classify_workers': 0,
+    'async_classify_max_pending': 100,
+    'async_classify_max_batch': 500,
+    'async_classify_timeout': 1.0,
+    'async_classify_fallback': 'QoS_treatment=default_priority',
     'payload_fcip_table_max_age': 600,
     'payload_fcip_table_tidyup_interval': 5,
     'measure_buckets_max_age': 600,
@@ -55,6 +79,13 @@ CONFIG_TEMPLATE = \
     'tc_identity_logging_level_c': 'INFO',
     'tc_payload_logging_level_c': 'INFO',
     'tc_statistical_logging_level_c': 'INFO',
+    'tc_batch_logging_level_c': 'INFO',
+    'tc_counters_logging_level_c': 'INFO',
+    'tc_model_logging_level_c': 'INFO',
+    'tc_async_logging_level_c': 'INFO',
+    'persist_logging_level_c': 'INFO',
+    'dns_logging_level_c': 'INFO',
+    'dhcp_logging_level_c': 'INFO',
     'sa_logging_level_c': 'INFO',
     'measure_logging_level_c': 'INFO',
     'forwarding_logging_level_c': 'INFO',
@@ -67,6 +98,13 @@ CONFIG_TEMPLATE = \
     'tc_identity_logging_level_s': 'INFO',
     'tc_payload_logging_level_s': 'INFO',
     'tc_statistical_logging_level_s': 'INFO',
+    'tc_batch_logging_level_s': 'INFO',
+    'tc_counters_logging_level_s': 'INFO',
+    'tc_model_logging_level_s': 'INFO',
+    'tc_async_logging_level_s': 'INFO',
+    'persist_logging_level_s': 'INFO',
+    'dns_logging_level_s': 'INFO',
+    'dhcp_logging_level_s': 'INFO',
     'sa_logging_level_s': 'INFO',
     'measure_logging_level_s': 'INFO',
     'forwarding_logging_level_s': 'INFO',
@@ -80,6 +118,9 @@ CONFIG_TEMPLATE = \
     'console_log_enabled': 1,
     'console_format': "%(levelname)s: %(name)s %(funcName)s: %(message)s",
     'event_rate_interval': 60,
+    'policy_stats_enabled': 1,
+    'policy_condition_reorder_interval': 0,
+    'policy_prune_unreachable': 0,
     'augment_flow_metadata_with_identity': 1
 }
 
@@ -0,0 +1,146 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#*** nmeta - DHCP option scanner
+
+"""
+This module is part of the nmeta suite running on top of Ryu SDN
+controller to provide network identity and flow metadata.
+It scans DHCP messages for the few fields and options that identity
+uses, straight from the payload bytes.
+"""
+
+import logging
+import logging.handlers
+import struct
+import socket
+
+#*** Ryu imports:
+from ryu.lib import addrconv
+
+#*** DHCP message types (option 53):
+DHCP_DISCOVER = 1
+DHCP_OFFER = 2
+DHCP_REQUEST = 3
+DHCP_ACK = 5
+#*** DHCP options that are extracted:
+DHCP_OPT_HOSTNAME = 12
+DHCP_OPT_REQUESTED_IP = 50
+DHCP_OPT_LEASE_TIME = 51
+DHCP_OPT_MESSAGE_TYPE = 53
+DHCP_OPT_PAD = 0
+DHCP_OPT_END = 255
+#*** Lease time value that means the lease never expires:
+DHCP_LEASE_INFINITE = 0xffffffff
+#*** Offset of the magic cookie, and the cookie itself:
+DHCP_COOKIE_OFFSET = 236
+DHCP_COOKIE = '\x63\x82\x53\x63'
+
+class DHCP(object):
+    """
+    This class is instantiated by tc_policy.py and provides a method
+    to scan a DHCP message
+    """
+    def __init__(self, _config):
+        #*** Get logging config values from config class:
+        _logging_level_s = _config.get_value \
+                                    ('dhcp_logging_level_s')
+        _logging_level_c = _config.get_value \
+                                    ('dhcp_logging_level_c')
+        _syslog_enabled = _config.get_value('syslog_enabled')
+        _loghost = _config.get_value('loghost')
+        _logport = _config.get_value('logport')
+        _logfacility = _config.get_value('logfacility')
+        _syslog_format = _config.get_value('syslog_format')
+        _console_log_enabled = _config.get_value('console_log_enabled')
+        _console_format = _config.get_value('console_format')
+        #*** Set up Logging:
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        #*** Syslog:
+        if _syslog_enabled:
+            #*** Log to syslog on host specified in config.yaml:
+            self.syslog_handler = logging.handlers.SysLogHandler(address=(
+                                                _loghost, _logport),
+                                                facility=_logfacility)
+            syslog_formatter = logging.Formatter(_syslog_format)
+            self.syslog_handler.setFormatter(syslog_formatter)
+            self.syslog_handler.setLevel(_logging_level_s)
+            #*** Add syslog log handler to logger:
+            self.logger.addHandler(self.syslog_handler)
+        #*** Console logging:
+        if _console_log_enabled:
+            #*** Log to the console:
+            self.console_handler = logging.StreamHandler()
+            console_formatter = logging.Formatter(_console_format)
+            self.console_handler.setFormatter(console_formatter)
+            self.console_handler.setLevel(_logging_level_c)
+            #*** Add console log handler to logger:
+            self.logger.addHandler(self.console_handler)
+
+    def parse_dhcp(self, _dhcp_payload):
+        """
+        Scan a DHCP message. Return a dictionary of results:
+            'message_type': option 53 value (0 if absent)
+            'chaddr': client hardware address as MAC text
+            'yiaddr': 'your' (client) IP address as text
+            'hostname': option 12 value or None
+            'requested_ip': option 50 value as text or None
+            'lease_time': option 51 value in seconds or None
+        or 0 if the payload is not a well formed DHCP message
+        """
+        _end = len(_dhcp_payload)
+        if _end < DHCP_COOKIE_OFFSET + 4 or \
+                    _dhcp_payload[DHCP_COOKIE_OFFSET:DHCP_COOKIE_OFFSET + 4] \
+                    != DHCP_COOKIE:
+            self.logger.debug("Not a DHCP message length=%s", _end)
+            return 0
+        _htype, _hlen = struct.unpack_from('!xBB', _dhcp_payload, 0)
+        if _htype != 1 or _hlen != 6:
+            #*** Only Ethernet client hardware addresses are of use:
+            return 0
+        _result = {'message_type': 0,
+                   'chaddr': addrconv.mac.bin_to_text(_dhcp_payload[28:34]),
+                   'yiaddr': socket.inet_ntoa(_dhcp_payload[16:20]),
+                   'hostname': None,
+                   'requested_ip': None,
+                   'lease_time': None}
+        _offset = DHCP_COOKIE_OFFSET + 4
+        while _offset < _end:
+            _code = ord(_dhcp_payload[_offset])
+            if _code == DHCP_OPT_END:
+                break
+            if _code == DHCP_OPT_PAD:
+                _offset += 1
+                continue
+            if _offset + 2 > _end:
+                self.logger.debug("DHCP option header past end")
+                return 0
+            _length = ord(_dhcp_payload[_offset + 1])
+            _value_start = _offset + 2
+            _offset = _value_start + _length
+            if _offset > _end:
+                self.logger.debug("DHCP option=%s past end", _code)
+                return 0
+            if _code == DHCP_OPT_MESSAGE_TYPE and _length == 1:
+                _result['message_type'] = ord(_dhcp_payload[_value_start])
+            elif _code == DHCP_OPT_HOSTNAME and _length:
+                _result['hostname'] = _dhcp_payload[_value_start:_offset]
+            elif _code == DHCP_OPT_REQUESTED_IP and _length == 4:
+                _result['requested_ip'] = socket.inet_ntoa(
+                                        _dhcp_payload[_value_start:_offset])
+            elif _code == DHCP_OPT_LEASE_TIME and _length == 4:
+                _result['lease_time'] = struct.unpack_from('!I',
+                                        _dhcp_payload, _value_start)[0]
+        return _result
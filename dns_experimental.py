@@ -16,10 +16,33 @@
 """
 This module is part of the nmeta suite running on top of Ryu SDN
 controller to provide network identity and flow metadata.
+It parses DNS responses, extracting only what identity needs
+(question names and A, AAAA and CNAME answers), directly from the
+packet buffer without building full DNS objects.
 """
 
 import logging
 import logging.handlers
+import struct
+import socket
+
+#*** Ryu imports:
+from ryu.lib import addrconv
+
+#*** DNS resource record types that are extracted:
+DNS_TYPE_A = 1
+DNS_TYPE_CNAME = 5
+DNS_TYPE_AAAA = 28
+#*** Maximum length of a DNS name in octets (RFC 1035):
+DNS_MAX_NAME_LENGTH = 255
+#*** Maximum number of compression pointers to follow in one name:
+DNS_MAX_POINTERS = 32
+
+class DNSParseError(Exception):
+    """
+    Raised when a DNS payload is malformed or runs past its bounds
+    """
+    pass
 
 class DNS(object):
     """
@@ -65,9 +88,113 @@ class DNS(object):
             #*** Add console log handler to logger:
             self.logger.addHandler(self.console_handler)
 
-    def parse_dns(self, _dns_payload):
+    def parse_dns(self, _dns_payload, tcp=0):
         """
-        Parse a DNS payload. Return a dictionary of results
+        Parse a DNS payload. If tcp is set then the payload starts with
+        the two byte length prefix used by DNS over TCP.
+        Return a dictionary of results:
+            'queries': list of question names
+            'answers': list of (name, type, ttl, value) tuples for A,
+                       AAAA (value is IP address text) and CNAME (value
+                       is the canonical name) answers
+        or 0 if the payload is not a DNS response or is malformed
         """
-        #*** Not written yet...
-        pass
+        _buf = memoryview(_dns_payload)
+        _offset = 0
+        _end = len(_buf)
+        try:
+            if tcp:
+                if _end < 2:
+                    raise DNSParseError("short TCP length prefix")
+                _length = struct.unpack_from('!H', _buf, 0)[0]
+                if _length + 2 > _end:
+                    raise DNSParseError("TCP message longer than payload")
+                #*** Names are relative to the start of the message:
+                _buf = _buf[2:2 + _length]
+                _end = _length
+            if _end < 12:
+                raise DNSParseError("short header")
+            _flags, _qdcount, _ancount = struct.unpack_from('!2xHHH', _buf, 0)
+            if not _flags & 0x8000:
+                #*** A query, not a response:
+                return 0
+            _offset = 12
+            _queries = []
+            for _ in range(_qdcount):
+                _name, _offset = _read_name(_buf, _offset, _end)
+                #*** Skip QTYPE and QCLASS:
+                _offset += 4
+                if _offset > _end:
+                    raise DNSParseError("question past end")
+                _queries.append(_name)
+            _answers = []
+            for _ in range(_ancount):
+                _name, _offset = _read_name(_buf, _offset, _end)
+                if _offset + 10 > _end:
+                    raise DNSParseError("answer header past end")
+                _type, _ttl, _rdlength = struct.unpack_from('!HxxIH', _buf,
+                                                             _offset)
+                _offset += 10
+                _rdata_end = _offset + _rdlength
+                if _rdata_end > _end:
+                    raise DNSParseError("answer data past end")
+                if _type == DNS_TYPE_A and _rdlength == 4:
+                    _answers.append((_name, _type, _ttl,
+                            socket.inet_ntoa(_buf[_offset:_rdata_end].tobytes())))
+                elif _type == DNS_TYPE_AAAA and _rdlength == 16:
+                    _answers.append((_name, _type, _ttl,
+                            addrconv.ipv6.bin_to_text(
+                                        _buf[_offset:_rdata_end].tobytes())))
+                elif _type == DNS_TYPE_CNAME:
+                    _cname, _cname_end = _read_name(_buf, _offset, _rdata_end)
+                    _answers.append((_name, _type, _ttl, _cname))
+                _offset = _rdata_end
+        except (DNSParseError, struct.error) as exception:
+            self.logger.debug("DNS parse failed exception=%s", exception)
+            return 0
+        return {'queries': _queries, 'answers': _answers}
+
+def _read_name(buf, offset, end):
+    """
+    Passed a buffer, the offset of a DNS name in it and the offset that
+    the name must not extend past and return a tuple of the name as dot
+    separated text and the offset just past the name. Follows
+    compression pointers, which may point anywhere earlier in the buffer
+    """
+    _labels = []
+    _length = 0
+    _pointers = 0
+    _next = None
+    while True:
+        if offset >= end:
+            raise DNSParseError("name past end")
+        _label_length = ord(buf[offset])
+        if _label_length == 0:
+            offset += 1
+            break
+        if _label_length & 0xC0 == 0xC0:
+            #*** Compression pointer:
+            if offset + 2 > end:
+                raise DNSParseError("pointer past end")
+            _pointer = struct.unpack_from('!H', buf, offset)[0] & 0x3FFF
+            if _next is None:
+                _next = offset + 2
+            _pointers += 1
+            if _pointers > DNS_MAX_POINTERS or _pointer >= offset:
+                raise DNSParseError("bad compression pointer")
+            offset = _pointer
+            #*** Pointers can point outside the current record data:
+            end = len(buf)
+            continue
+        if _label_length & 0xC0:
+            raise DNSParseError("unsupported label type")
+        _length += _label_length + 1
+        if _length > DNS_MAX_NAME_LENGTH:
+            raise DNSParseError("name too long")
+        if offset + 1 + _label_length > end:
+            raise DNSParseError("label past end")
+        _labels.append(buf[offset + 1:offset + 1 + _label_length].tobytes())
+        offset += 1 + _label_length
+    if _next is None:
+        _next = offset
+    return ('.'.join(_labels), _next)
@@ -89,6 +89,9 @@ class FlowMetadata(object):
         self.augment = _config.get_value('augment_flow_metadata_with_identity')
         #*** Reference to call methods in nmeta module:
         self._nmeta = _nmeta
+        #*** Index of FM table references by IP address, used to refresh
+        #*** identity metadata on flows when identity changes:
+        self._fm_refs_by_ip = {}
         
     def update_flowmetadata(self, msg, flow_actions):
         """
@@ -140,6 +143,13 @@ class FlowMetadata(object):
                     _for_deletion.append(_table_ref)
         #*** Now iterate over the list of references to delete:
         for _del_ref in _for_deletion:
+            for _side in ('ip_A', 'ip_B'):
+                _ip = self._fm_table[_del_ref].get(_side)
+                _refs = self._fm_refs_by_ip.get(_ip)
+                if _refs:
+                    _refs.discard(_del_ref)
+                    if not _refs:
+                        del self._fm_refs_by_ip[_ip]
             del self._fm_table[_del_ref]
 
     def get_fm_table(self):
@@ -148,6 +158,27 @@ class FlowMetadata(object):
         """
         return self._fm_table
 
+    def reclassify_flow(self, pkt, actions):
+        """
+        Passed a packet of a flow and the actions of a classification
+        verdict that arrived after its flow entry was installed. Update
+        the actions of the flow in the Flow Metadata (FM) table and
+        return the QoS queue for them
+        """
+        _table_ref = self._fm_check(pkt)
+        if _table_ref and self._fm_table[_table_ref]["flow_actions"]:
+            self._fm_table[_table_ref]["flow_actions"]["actions"] = actions
+        return self.qos.check_policy(actions)
+
+    def identity_changed(self, ctx, ip):
+        """
+        Called by the identity module when the identity records for an
+        IP address are created or deleted. Refresh the identity metadata
+        on flows to or from that IP
+        """
+        for _table_ref in self._fm_refs_by_ip.get(ip, ()):
+            self._fm_attach_identity(_table_ref, ctx)
+
     def get_fm_table_size_rows(self):
         """
         Return the number of rows (items) in the flow metadata table
@@ -290,19 +321,12 @@ class FlowMetadata(object):
                 self._fm_table[self._fm_ref]["ip_A"] = _pkt_ip6.src
                 self._fm_table[self._fm_ref]["ip_B"] = _pkt_ip6.dst
                 self._fm_table[self._fm_ref]["ip_next_header"] = _pkt_ip6.nxt
-            if self.augment:
-                #*** Augment flow metadata with IP identity metadata:
-                id_ip_ref = self._nmeta.tc_policy.identity.id_ip
-                id_ip_ref.setdefault(ctx, {})
-                fm_id_ref = self._fm_table[self._fm_ref].setdefault('id', {})
-                if self._fm_table[self._fm_ref]["ip_A"]:
-                    ip = self._fm_table[self._fm_ref]["ip_A"]
-                    if ip in id_ip_ref[ctx]:
-                        fm_id_ref[ip] = id_ip_ref[ctx][ip]
-                if self._fm_table[self._fm_ref]["ip_B"]:
-                    ip = self._fm_table[self._fm_ref]["ip_B"]
-                    if ip in id_ip_ref[ctx]:
-                        fm_id_ref[ip] = id_ip_ref[ctx][ip]
+            #*** Index the flow by IP and attach identity metadata:
+            for _side in ('ip_A', 'ip_B'):
+                self._fm_refs_by_ip.setdefault(
+                       self._fm_table[self._fm_ref][_side], set()). \
+                       add(self._fm_ref)
+            self._fm_attach_identity(self._fm_ref, ctx)
             if _pkt_tcp:
                 #*** Add TCP info:
                 self._fm_table[self._fm_ref]["tcp_A"] = _pkt_tcp.src_port
@@ -330,6 +354,30 @@ class FlowMetadata(object):
         #*** increment table ref ready for next time we use it:
         self._fm_ref += 1
 
+    def _fm_attach_identity(self, table_ref, ctx):
+        """
+        Attach references to the identity metadata for the IP addresses
+        of a flow in the FM table. References are to the identity
+        module's own records so stay current as those records are
+        updated, and only need refreshing when records come or go
+        """
+        id_ip_ctx = self._nmeta.tc_policy.identity.id_ip.get(ctx, {})
+        _flow = self._fm_table[table_ref]
+        for _side in ('ip_A', 'ip_B'):
+            ip = _flow[_side]
+            id_ip_ip = id_ip_ctx.get(ip)
+            if id_ip_ip and 'service' in id_ip_ip:
+                _flow[_side + '_services'] = id_ip_ip['service']
+            else:
+                _flow.pop(_side + '_services', None)
+            if self.augment:
+                #*** Augment flow metadata with IP identity metadata:
+                fm_id_ref = _flow.setdefault('id', {})
+                if id_ip_ip:
+                    fm_id_ref[ip] = id_ip_ip
+                else:
+                    fm_id_ref.pop(ip, None)
+
     def _fm_add_to_existing(self, pkt, table_ref, flow_actions):
         """
         Passed a packet that is in a flow that we are
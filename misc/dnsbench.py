@@ -0,0 +1,65 @@
+"""
+Benchmark the nmeta DNS response parser against dpkt
+
+Run from the nmeta directory so that nmeta modules can be imported, i.e.:
+
+python misc/dnsbench.py [iterations]
+"""
+
+import sys
+import os
+import socket
+import timeit
+
+import dpkt
+
+#*** Import nmeta modules from the parent directory:
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import config
+import dns_experimental
+
+iterations = 100000
+if len(sys.argv) > 1:
+    iterations = int(sys.argv[1])
+
+#*** Build a typical CDN style response with a CNAME chain:
+dns = dpkt.dns.DNS(id=1)
+dns.qr = dpkt.dns.DNS_R
+dns.qd = [dpkt.dns.DNS.Q(name='www.example.com')]
+dns.an = [dpkt.dns.DNS.RR(name='www.example.com', type=dpkt.dns.DNS_CNAME,
+                          ttl=60, cname='www.example.com.cdn.example.net'),
+          dpkt.dns.DNS.RR(name='www.example.com.cdn.example.net',
+                          type=dpkt.dns.DNS_CNAME, ttl=60,
+                          cname='e1234.a.cdn.example.net')]
+for last_octet in range(1, 5):
+    dns.an.append(dpkt.dns.DNS.RR(name='e1234.a.cdn.example.net',
+                          type=dpkt.dns.DNS_A, ttl=20,
+                          rdata=socket.inet_aton('10.1.2.%s' % last_octet)))
+payload = str(dns)
+
+_config = config.Config()
+parser = dns_experimental.DNS(_config)
+
+def run_dpkt():
+    """
+    Parse with dpkt and pull out what identity needs, as nmeta used to
+    """
+    parsed = dpkt.dns.DNS(payload)
+    result = []
+    for answer in parsed.an:
+        if answer.type == 1:
+            result.append((answer.name, socket.inet_ntoa(answer.rdata)))
+        elif answer.type == 5:
+            result.append((answer.name, answer.cname))
+    return result
+
+def run_nmeta():
+    """
+    Parse with the nmeta DNS response parser
+    """
+    return parser.parse_dns(payload)
+
+print "Payload is %s bytes with %s answers" % (len(payload), len(dns.an))
+for name, function in (('dpkt', run_dpkt), ('nmeta', run_nmeta)):
+    seconds = timeit.timeit(function, number=iterations)
+    print "%s: %.2f us per response" % (name, seconds * 1000000 / iterations)
@@ -0,0 +1,312 @@
+"""
+Extract statistical classification features from packet captures, and
+train models for the statistical_model classifier from them
+
+Captures are read a packet at a time and TCP and UDP packets over IPv4
+are grouped into bidirectional flows with the same canonical keys as the
+tc_statistical FCIP table. The first packet of a flow is 'forward'. Each
+flow keeps its first N packets in a tc_features.FlowFeatureBuffer and
+its statistics in a tc_features.FlowAccumulator, as the online
+classifiers do (TCP window scaling is not applied).
+
+Flows are written out once they are idle for longer than the idle timeout
+(capture time), or the oldest when there are more than the maximum
+number of open flows, in chunks of columnar NumPy arrays (one .npz file
+per chunk), so memory use is bounded however big the captures are:
+    proto, ip_a, port_a, ip_b, port_b: canonical flow key
+    packets: number of (non-duplicate) packets in the flow
+    sizes: first N IP total lengths, 0 padded (flows x N)
+    directions: first N directions, 0 forward and 1 reverse (flows x N)
+    interarrivals: seconds since the previous packet of the first N,
+                   0 for the first packet and padding (flows x N)
+    features: values of feature_names for each flow (flows x features)
+
+Models are trained from chunks with logistic regression and written as
+JSON for tc_model.py. Flows are labelled class 1 if either port is one
+of the --positive ports, otherwise class 0.
+
+Run from the nmeta directory so that nmeta modules can be imported, i.e.:
+
+python misc/flowfeatures.py extract OUTPUT_DIR CAPTURE [CAPTURE...]
+python misc/flowfeatures.py train --positive 6881 MODEL_FILE CHUNK [CHUNK...]
+"""
+
+import sys
+import os
+import socket
+import argparse
+import collections
+import json
+
+import dpkt
+import numpy as np
+
+#*** Import nmeta modules from the parent directory:
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import tc_features
+import tc_statistical
+
+#*** Features written for each flow, in this order:
+FEATURE_NAMES = sorted(tc_features.FEATURES)
+
+class Flow(object):
+    """
+    A flow being extracted from a capture
+    """
+    def __init__(self, key, ip_src, port_src, first_packets):
+        self.key = key
+        #*** Source of the first packet, for working out direction:
+        self.forward = (ip_src, port_src)
+        self.buffer = tc_features.FlowFeatureBuffer(first_packets)
+        self.features = tc_features.FlowAccumulator()
+        self.last_seen = 0
+
+    def add(self, ip_src, port_src, arrival_time, size, window_size,
+                signature):
+        """
+        Add a packet to the flow unless it is a duplicate
+        """
+        if self.features.is_duplicate(signature):
+            return
+        if (ip_src, port_src) == self.forward:
+            _direction = 'forward'
+        else:
+            _direction = 'reverse'
+        self.features.update(_direction, arrival_time, size, window_size,
+                             signature)
+        #*** Only the first packets are kept:
+        if self.buffer.count < self.buffer.slots:
+            self.buffer.append(_direction, arrival_time, size, window_size)
+        self.last_seen = arrival_time
+
+class FlowExtractor(object):
+    """
+    Reads captures into flows and writes them out in chunks
+    """
+    def __init__(self, output_dir, first_packets=5, idle_timeout=600,
+                    max_flows=100000, chunk_flows=10000):
+        self.output_dir = output_dir
+        self.first_packets = first_packets
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.chunk_flows = chunk_flows
+        #*** Open flows, least recently seen first:
+        self.flows = collections.OrderedDict()
+        self.finished = []
+        self.chunks = 0
+        self.packets = 0
+        self.flow_count = 0
+        self._last_expiry = 0
+
+    def read_capture(self, filename):
+        """
+        Add the packets of a pcap file to flows
+        """
+        with open(filename, 'rb') as _file:
+            for _timestamp, _buf in dpkt.pcap.Reader(_file):
+                self.add_packet(_timestamp, _buf)
+
+    def add_packet(self, timestamp, buf):
+        """
+        Passed the timestamp and bytes of an Ethernet frame and add it
+        to its flow if it is TCP or UDP over IPv4
+        """
+        try:
+            _ip = dpkt.ethernet.Ethernet(buf).data
+        except dpkt.dpkt.UnpackError:
+            return
+        if not isinstance(_ip, dpkt.ip.IP):
+            return
+        _transport = _ip.data
+        if isinstance(_transport, dpkt.tcp.TCP):
+            _proto = tc_statistical.IP_PROTO_TCP
+            _window_size = _transport.win
+            _signature = (_transport.seq, _transport.ack, _ip.len,
+                          _transport.flags)
+        elif isinstance(_transport, dpkt.udp.UDP):
+            _proto = tc_statistical.IP_PROTO_UDP
+            _window_size = 0
+            _signature = (_ip.id, _transport.sum)
+        else:
+            return
+        self.packets += 1
+        _ip_src = socket.inet_ntoa(_ip.src)
+        _ip_dst = socket.inet_ntoa(_ip.dst)
+        _key = tc_statistical.fcip_key(_proto, _ip_src, _transport.sport,
+                                       _ip_dst, _transport.dport)
+        _flow = self.flows.pop(_key, None)
+        if _flow and timestamp - _flow.last_seen > self.idle_timeout:
+            #*** Idle for too long so a new flow with the same key:
+            self._finish(_flow)
+            _flow = None
+        if not _flow:
+            _flow = Flow(_key, _ip_src, _transport.sport, self.first_packets)
+            self.flow_count += 1
+        _flow.add(_ip_src, _transport.sport, timestamp, _ip.len,
+                  _window_size, _signature)
+        #*** Re-inserting keeps the flows in order of last seen:
+        self.flows[_key] = _flow
+        if len(self.flows) > self.max_flows:
+            self._finish(self.flows.popitem(last=False)[1])
+        if timestamp - self._last_expiry > 1:
+            self._expire(timestamp)
+            self._last_expiry = timestamp
+
+    def close(self):
+        """
+        Write out all flows that are still open
+        """
+        while self.flows:
+            self._finish(self.flows.popitem(last=False)[1])
+        self._write_chunk()
+
+    def _expire(self, timestamp):
+        """
+        Finish flows that have been idle for longer than the timeout
+        """
+        while self.flows:
+            _flow = next(self.flows.itervalues())
+            if timestamp - _flow.last_seen <= self.idle_timeout:
+                break
+            self._finish(self.flows.popitem(last=False)[1])
+
+    def _finish(self, flow):
+        """
+        Add a flow to the chunk being built, writing the chunk if full
+        """
+        self.finished.append(flow)
+        if len(self.finished) >= self.chunk_flows:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        """
+        Write the finished flows as a chunk of columnar arrays
+        """
+        if not self.finished:
+            return
+        _flows = self.finished
+        self.finished = []
+        _count = len(_flows)
+        _sizes = np.zeros((_count, self.first_packets), dtype=np.uint16)
+        _directions = np.zeros((_count, self.first_packets), dtype=np.uint8)
+        _arrivals = np.zeros((_count, self.first_packets), dtype=np.float64)
+        _lengths = np.zeros(_count, dtype=np.intp)
+        for _row, _flow in enumerate(_flows):
+            _length = len(_flow.buffer)
+            _lengths[_row] = _length
+            _sizes[_row, :_length] = _flow.buffer.column('sizes')
+            _directions[_row, :_length] = [tc_features.DIRECTION_CODES[_d]
+                            for _d in _flow.buffer.column('directions')]
+            _arrivals[_row, :_length] = _flow.buffer.column('arrival_times')
+        #*** Inter-arrival times, with padding masked back to 0:
+        _interarrivals = np.zeros_like(_arrivals)
+        _interarrivals[:, 1:] = np.diff(_arrivals, axis=1)
+        _positions = np.arange(self.first_packets)
+        _interarrivals[_positions >= _lengths[:, None]] = 0
+        _keys = [_flow.key for _flow in _flows]
+        _filename = os.path.join(self.output_dir,
+                                 'flows-%05d.npz' % self.chunks)
+        np.savez_compressed(_filename,
+            proto=np.array([_key[0] for _key in _keys], dtype=np.uint8),
+            ip_a=np.array([_key[1] for _key in _keys]),
+            port_a=np.array([_key[2] for _key in _keys], dtype=np.uint16),
+            ip_b=np.array([_key[3] for _key in _keys]),
+            port_b=np.array([_key[4] for _key in _keys], dtype=np.uint16),
+            packets=np.array([_flow.features.packets for _flow in _flows],
+                             dtype=np.uint32),
+            sizes=_sizes,
+            directions=_directions,
+            interarrivals=_interarrivals,
+            feature_names=np.array(FEATURE_NAMES),
+            features=np.array([_flow.features.get_feature_vector(
+                           FEATURE_NAMES) for _flow in _flows]))
+        self.chunks += 1
+        print "Wrote %s flows to %s" % (_count, _filename)
+
+def train(chunk_files, positive_ports, feature_names, iterations=2000,
+                learning_rate=0.1):
+    """
+    Fit a logistic regression model to the flows in chunk files and
+    return the weights and bias for the (unscaled) features
+    """
+    _features = []
+    _labels = []
+    for _chunk_file in chunk_files:
+        _chunk = np.load(_chunk_file)
+        _columns = [list(_chunk['feature_names']).index(_name)
+                                        for _name in feature_names]
+        _features.append(_chunk['features'][:, _columns])
+        _labels.append(np.in1d(_chunk['port_a'], positive_ports) |
+                       np.in1d(_chunk['port_b'], positive_ports))
+    _x = np.concatenate(_features)
+    _y = np.concatenate(_labels).astype(np.float64)
+    #*** Scale features so that gradient descent converges:
+    _mean = _x.mean(axis=0)
+    _scale = _x.std(axis=0)
+    _scale[_scale == 0] = 1
+    _x = (_x - _mean) / _scale
+    _weights = np.zeros(_x.shape[1])
+    _bias = 0.0
+    for _ in xrange(iterations):
+        _error = 1.0 / (1.0 + np.exp(-(_x.dot(_weights) + _bias))) - _y
+        _weights -= learning_rate * _x.T.dot(_error) / len(_y)
+        _bias -= learning_rate * _error.mean()
+    print "Trained on %s flows, %s positive" % (len(_y), int(_y.sum()))
+    #*** Fold the scaling into the weights:
+    _weights = _weights / _scale
+    _bias = _bias - _weights.dot(_mean)
+    return _weights.tolist(), float(_bias)
+
+def main():
+    """
+    Run from the command line
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command')
+    extract = commands.add_parser('extract',
+                                  help='extract flow features from captures')
+    extract.add_argument('output_dir')
+    extract.add_argument('captures', nargs='+')
+    extract.add_argument('--first-packets', type=int, default=5)
+    extract.add_argument('--idle-timeout', type=float, default=600)
+    extract.add_argument('--max-flows', type=int, default=100000)
+    extract.add_argument('--chunk-flows', type=int, default=10000)
+    train_model = commands.add_parser('train',
+                                  help='train a model from feature chunks')
+    train_model.add_argument('model_file')
+    train_model.add_argument('chunks', nargs='+')
+    train_model.add_argument('--positive', type=int, action='append',
+                             required=True,
+                             help='port of class 1 flows (repeatable)')
+    train_model.add_argument('--features', default='max_size,interval_ratio')
+    train_model.add_argument('--action-0',
+                             default='QoS_treatment=default_priority')
+    train_model.add_argument('--action-1',
+                             default='QoS_treatment=low_priority')
+    args = parser.parse_args()
+    if args.command == 'extract':
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        extractor = FlowExtractor(args.output_dir, args.first_packets,
+                                  args.idle_timeout, args.max_flows,
+                                  args.chunk_flows)
+        for capture in args.captures:
+            extractor.read_capture(capture)
+        extractor.close()
+        print "Read %s packets in %s flows" % (extractor.packets,
+                                               extractor.flow_count)
+    else:
+        feature_names = args.features.split(',')
+        weights, bias = train(args.chunks, args.positive, feature_names)
+        with open(args.model_file, 'w') as model_file:
+            json.dump({'type': 'logistic',
+                       'features': feature_names,
+                       'weights': weights,
+                       'bias': bias,
+                       'actions': [{'set_qos_tag': args.action_0},
+                                   {'set_qos_tag': args.action_1}]},
+                      model_file, indent=4)
+        print "Wrote model to %s" % args.model_file
+
+if __name__ == '__main__':
+    main()
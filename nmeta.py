@@ -39,6 +39,7 @@ from ryu.ofproto import ofproto_v1_0
 from ryu.ofproto import ofproto_v1_3
 from ryu.lib.packet import packet
 from ryu.lib import addrconv
+from ryu.lib import hub
 from ryu.lib.packet import ethernet
 from ryu.lib.packet import ipv4, ipv6
 from ryu.lib.packet import tcp
@@ -54,10 +55,17 @@ import switch_abstraction
 import measure
 import forwarding
 import api
+import persist
+import tc_counters
+import tc_async
 
 #*** Number of preceding seconds that events are averaged over:
 EVENT_RATE_INTERVAL = 60
 
+#*** Flow table that forwards packets that have matched a proactive
+#*** flow entry in table 0:
+PROACTIVE_FORWARDING_TABLE = 1
+
 class NMeta(app_manager.RyuApp):
     """
     This is the main class used to run nmeta
@@ -128,6 +136,9 @@ class NMeta(app_manager.RyuApp):
                              self.miss_send_len)
         #*** Tell switch how to handle fragments (see OpenFlow spec):
         self.ofpc_frag = self.config.get_value("ofpc_frag")
+        #*** Install static-only policy rules on switches as flow entries:
+        self.proactive_static_rules = self.config.get_value \
+                                                  ("proactive_static_rules")
 
         #*** Table maintenance settings from config.yaml file:
         self.fm_table_max_age = self.config.get_value('fm_table_max_age')
@@ -147,6 +158,8 @@ class NMeta(app_manager.RyuApp):
                             get_value('measure_buckets_max_age')
         self.measure_buckets_tidyup_interval = self.config.\
                             get_value('measure_buckets_tidyup_interval')
+        self.policy_condition_reorder_interval = self.config.\
+                            get_value('policy_condition_reorder_interval')
         #*** Set initial value of the variable that holds last time
         #*** for tidy-ups:
         self.fm_table_last_tidyup_time = time.time()
@@ -154,13 +167,40 @@ class NMeta(app_manager.RyuApp):
         self.statistical_fcip_table_last_tidyup_time = time.time()
         self.payload_fcip_table_last_tidyup_time = time.time()
         self.measure_buckets_last_tidyup_time = time.time()
+        self.policy_condition_reorder_last_time = time.time()
 
         #*** Instantiate Module Classes:
         self.flowmetadata = flow.FlowMetadata(self, self.config)
         self.tc_policy = tc_policy.TrafficClassificationPolicy(self.config)
+        #*** Keep identity metadata on flows current as identity changes:
+        self.tc_policy.identity.register_ip_change_callback \
+                                      (self.flowmetadata.identity_changed)
+        #*** Recover identity state from disk and persist it from now on:
+        self.identity_persist = persist.IdentityPersist(self.config,
+                                                   self.tc_policy.identity)
+        if self.identity_persist.enabled:
+            self.identity_persist.restore()
+            self.identity_persist.start()
+        #*** Apply harvested identity updates off the packet-in path:
+        if self.tc_policy.identity_queue_max:
+            hub.spawn(self.tc_policy.identity_worker)
+        #*** Score flows for the trained model classifier in batches:
+        if self.tc_policy.statistical.model.model_file:
+            hub.spawn(self.tc_policy.statistical.model_worker)
         self.sa = switch_abstraction.SwitchAbstract(self.config)
         self.measure = measure.Measurement(self.config)
         self.forwarding = forwarding.Forwarding(self.config)
+        #*** Classify flows from their flow entry counters:
+        self.counter_classify = tc_counters.CounterClassify(self.config,
+                                          self.sa, self.flowmetadata.qos)
+        if self.counter_classify.enabled:
+            hub.spawn(self.counter_classify.run)
+        #*** Run CPU heavy classification in worker processes:
+        self.async_classify = tc_async.AsyncClassify(self.config, self.sa,
+                                                     self.flowmetadata)
+        if self.async_classify.enabled:
+            self.async_classify.start()
+            self.tc_policy.statistical.async_classify = self.async_classify
         wsgi = kwargs['wsgi']
         self.api = api.Api(self, self.config, wsgi)
 
@@ -198,6 +238,39 @@ class NMeta(app_manager.RyuApp):
         #*** packet and send a packet-in message to the controller:
         self.sa.set_switch_table_miss(datapath, self.miss_send_len,
                                                            body.hw_desc)
+        if self.proactive_static_rules:
+            self._install_proactive_flows(datapath)
+
+    def _install_proactive_flows(self, datapath):
+        """
+        Install the flow entries compiled from the leading static-only
+        rules of the traffic classification policy on a switch.
+        Table 0 sets the QoS queue for matching packets and sends them
+        on to a forwarding table, while packets needed for identity
+        harvesting are always sent to the controller. Needs the
+        multiple table pipeline of OpenFlow 1.3
+        """
+        dpid = datapath.id
+        if datapath.ofproto.OFP_VERSION != ofproto_v1_3.OFP_VERSION:
+            self.logger.info("event=proactive_skipped dpid=%s reason="
+                             "OpenFlow version is not 1.3", dpid)
+            return
+        #*** Forwarding table misses go to the controller:
+        self.sa.add_flow_controller(datapath, {}, 0, self.miss_send_len,
+                                    table_id=PROACTIVE_FORWARDING_TABLE)
+        for _match in self.tc_policy.proactive_punts:
+            self.sa.add_flow_controller(datapath, _match,
+                                        self.tc_policy.proactive_punt_priority,
+                                        self.miss_send_len)
+        _installed = 0
+        for _flow in self.tc_policy.proactive_flows:
+            _out_queue = self.flowmetadata.qos.check_policy(_flow['actions'])
+            _installed += self.sa.add_flow_proactive(datapath, _flow['match'],
+                                     _out_queue, _flow['priority'],
+                                     PROACTIVE_FORWARDING_TABLE)
+        self.logger.info("event=proactive_installed dpid=%s flow_entries=%s "
+                         "punts=%s", dpid, _installed,
+                         len(self.tc_policy.proactive_punts))
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
@@ -225,28 +298,76 @@ class NMeta(app_manager.RyuApp):
         if self.debug_on:
             self._packet_in_debug(ev, in_port)
 
-        #*** Traffic Classification:
-        #*** Check traffic classification policy to see if packet matches
-        #*** against policy and if it does return a dictionary of actions:
-        flow_actions = self.tc_policy.check_policy(pkt, dpid, in_port)
+        #*** Forwarding table misses are for traffic that a proactive
+        #*** flow entry has already classified:
+        _proactive_miss = self.proactive_static_rules and \
+                        ofproto.OFP_VERSION == ofproto_v1_3.OFP_VERSION and \
+                        msg.table_id == PROACTIVE_FORWARDING_TABLE
 
         #*** Call Forwarding module to carry out forwarding functions:
         out_port = self.forwarding.basic_switch(ev, in_port)
 
-        #*** Accumulate extra information in the flow_actions dictionary:
-        flow_actions.setdefault('datapath', {})
-        flow_actions['datapath'].setdefault(dpid, {})
-        flow_actions['datapath'][dpid]['in_port'] = in_port
-        flow_actions['datapath'][dpid]['out_port'] = out_port
-
-        #*** Update Flow Metadata Table and add QoS queue:
-        flow_actions = self.flowmetadata.update_flowmetadata(msg, flow_actions)
-        out_queue = flow_actions['datapath'][dpid].setdefault('out_queue', 0)
+        if _proactive_miss:
+            #*** No need to classify again. The queue that the proactive
+            #*** flow entry set isn't kept for packet out, so use the
+            #*** default queue for this packet:
+            out_queue = 0
+        else:
+            #*** Traffic Classification:
+            #*** Check traffic classification policy to see if packet
+            #*** matches against policy and if it does return a dictionary
+            #*** of actions:
+            flow_actions = self.tc_policy.check_policy(pkt, dpid, in_port)
+
+            #*** Accumulate extra information in the flow_actions dictionary:
+            flow_actions.setdefault('datapath', {})
+            flow_actions['datapath'].setdefault(dpid, {})
+            flow_actions['datapath'][dpid]['in_port'] = in_port
+            flow_actions['datapath'][dpid]['out_port'] = out_port
+
+            #*** Update Flow Metadata Table and add QoS queue:
+            flow_actions = self.flowmetadata.update_flowmetadata(msg,
+                                                                flow_actions)
+            out_queue = flow_actions['datapath'][dpid].setdefault(
+                                                            'out_queue', 0)
 
         if out_port != ofproto.OFPP_FLOOD:
             #*** Do some add flow magic, but only if not a flooded packet:
-            #*** Prefer to do fine-grained match where possible:
-            _add_flow_result = self._add_flow(ev, in_port, out_port, out_queue)
+            if _proactive_miss:
+                #*** Already classified by a proactive flow entry so only
+                #*** need a forwarding entry:
+                _add_flow_result = self.sa.add_flow_forwarding(datapath,
+                              eth.src, eth.dst, out_port,
+                              table_id=PROACTIVE_FORWARDING_TABLE,
+                              priority=1, idle_timeout=5)
+            else:
+                #*** Give flow entries that are to be classified from their
+                #*** counters a cookie to poll and re-mark them by:
+                #*** Same for flow entries to be re-marked when a verdict
+                #*** from asynchronous classification arrives. All flow
+                #*** entries of a flow waiting for a verdict share a cookie:
+                _cookie = 0
+                _counter = 0
+                _deferred_key = None
+                if ofproto.OFP_VERSION == ofproto_v1_3.OFP_VERSION:
+                    _counter = self.counter_classify.enabled and \
+                        self.tc_policy.statistical.pop_counter_request(pkt)
+                    if self.async_classify.enabled:
+                        _deferred_key = self.tc_policy.statistical. \
+                                                    get_deferred_flow(pkt)
+                if _deferred_key:
+                    _cookie = self.async_classify.flow_cookie(_deferred_key)
+                if (_counter or _deferred_key) and not _cookie:
+                    _cookie = self.counter_classify.new_cookie()
+                #*** Prefer to do fine-grained match where possible:
+                _add_flow_result = self._add_flow(ev, in_port, out_port,
+                                                  out_queue, _cookie)
+                if _counter and _add_flow_result:
+                    self.counter_classify.add_flow(datapath, _cookie,
+                                                   out_port, out_queue)
+                if _deferred_key and _add_flow_result:
+                    self.async_classify.add_flow(_deferred_key, pkt,
+                                   datapath, _cookie, out_port, out_queue)
             self.logger.debug("event=add_flow result=%s", _add_flow_result)
             #*** Record the event for measurements:
             self.measure.record_rate_event('add_flow')
@@ -309,11 +430,20 @@ class NMeta(app_manager.RyuApp):
             self.measure.kick_the_metric_buckets(
                                      self.measure_buckets_max_age)
             self.measure_buckets_last_tidyup_time = _time
-
-    def _add_flow(self, ev, in_port, out_port, out_queue):
+        #*** Re-order policy conditions based on observed selectivity:
+        if self.policy_condition_reorder_interval:
+            _time = time.time()
+            if (_time - self.policy_condition_reorder_last_time) > \
+                                 self.policy_condition_reorder_interval:
+                self.logger.debug("event=reorder_policy_conditions")
+                self.tc_policy.compile_condition_order(use_stats=1)
+                self.policy_condition_reorder_last_time = _time
+
+    def _add_flow(self, ev, in_port, out_port, out_queue, cookie=0):
         """
         Add a flow entry to a switch
-        Prefer to do fine-grained match where possible
+        Prefer to do fine-grained match where possible.
+        Ethernet (non-IP) flow entries are installed without the cookie
         """
         #*** Extract parameters:
         msg = ev.msg
@@ -335,7 +465,8 @@ class NMeta(app_manager.RyuApp):
             _result = self.sa.add_flow_tcp(datapath, msg, in_port=in_port,
                               out_port=out_port, out_queue=out_queue,
                               priority=1, buffer_id=None,
-                              idle_timeout=5, hard_timeout=0)
+                              idle_timeout=5, hard_timeout=0,
+                              cookie=cookie)
         elif pkt_tcp and pkt_ip6:
             #*** Call abstraction layer to add TCP flow record:
             self.logger.debug("event=add_flow match_type=tcp ip_src=%s "
@@ -345,7 +476,8 @@ class NMeta(app_manager.RyuApp):
             _result = self.sa.add_flow_tcp(datapath, msg, in_port=in_port,
                               out_port=out_port, out_queue=out_queue,
                               priority=1, buffer_id=None,
-                              idle_timeout=5, hard_timeout=0)
+                              idle_timeout=5, hard_timeout=0,
+                              cookie=cookie)
         elif pkt_ip4:
             #*** Call abstraction layer to add IP flow record:
             self.logger.debug("event=add_flow match_type=ip ip_src=%s "
@@ -354,7 +486,8 @@ class NMeta(app_manager.RyuApp):
             _result = self.sa.add_flow_ip(datapath, msg, in_port=in_port,
                               out_port=out_port, out_queue=out_queue,
                               priority=1, buffer_id=None,
-                              idle_timeout=5, hard_timeout=0)
+                              idle_timeout=5, hard_timeout=0,
+                              cookie=cookie)
         elif pkt_ip6:
             #*** Call abstraction layer to add IP flow record:
             self.logger.debug("event=add_flow match_type=ip ip_src=%s "
@@ -363,7 +496,8 @@ class NMeta(app_manager.RyuApp):
             _result = self.sa.add_flow_ip(datapath, msg, in_port=in_port,
                               out_port=out_port, out_queue=out_queue,
                               priority=1, buffer_id=None,
-                              idle_timeout=5, hard_timeout=0)
+                              idle_timeout=5, hard_timeout=0,
+                              cookie=cookie)
         else:
             #*** Call abstraction layer to add Ethernet flow record:
             self.logger.debug("event=add_flow match_type=eth eth_src=%s "
@@ -422,6 +556,14 @@ class NMeta(app_manager.RyuApp):
                                 dpid, in_port, eth_src, eth_dst, eth.ethertype)
 
 
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def flow_stats_reply_handler(self, ev):
+        """
+        Receive a reply from a switch to a flow statistics request
+        and pass it to counter classification
+        """
+        self.counter_classify.flow_stats_reply(ev.msg)
+
     @set_ev_cls(ofp_event.EventOFPErrorMsg,
             [HANDSHAKE_DISPATCHER, CONFIG_DISPATCHER, MAIN_DISPATCHER])
     def error_msg_handler(self, ev):
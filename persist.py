@@ -0,0 +1,281 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#*** nmeta - Network Metadata - Identity Persistence Class and Methods
+
+"""
+This module is part of the nmeta suite running on top of Ryu SDN controller
+to provide network identity and flow (traffic classification) metadata.
+It persists identity state to local disk as periodic snapshots plus
+a journal of identity updates, so that identity can be recovered
+on a controller restart rather than relearnt. Files are JSON lines,
+one identity record per line, so that reading them back can't run
+code and doesn't depend on class import paths.
+"""
+
+import logging
+import logging.handlers
+import sys
+import os
+import time
+
+#*** For serialising identity records:
+import json
+
+#*** Ryu imports:
+from ryu.lib import hub
+
+#*** File names in the persistence directory:
+SNAPSHOT_FILENAME = 'identity.snapshot'
+JOURNAL_PREFIX = 'identity.journal.'
+#*** Number of records to serialise in a snapshot between yields to other
+#*** green threads:
+SNAPSHOT_YIELD_RECORDS = 1000
+
+class IdentityPersist(object):
+    """
+    This class is instantiated by nmeta.py and provides methods to
+    snapshot identity state, journal identity updates between snapshots
+    and recover identity state from them at startup.
+    Journal records are buffered in memory by the packet-in path and
+    written out, along with snapshots, by a separate green thread
+    """
+    def __init__(self, _config, _identity):
+        #*** Get logging config values from config class:
+        _logging_level_s = _config.get_value \
+                                    ('persist_logging_level_s')
+        _logging_level_c = _config.get_value \
+                                    ('persist_logging_level_c')
+        _syslog_enabled = _config.get_value('syslog_enabled')
+        _loghost = _config.get_value('loghost')
+        _logport = _config.get_value('logport')
+        _logfacility = _config.get_value('logfacility')
+        _syslog_format = _config.get_value('syslog_format')
+        _console_log_enabled = _config.get_value('console_log_enabled')
+        _console_format = _config.get_value('console_format')
+        #*** Set up Logging:
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        #*** Syslog:
+        if _syslog_enabled:
+            #*** Log to syslog on host specified in config.yaml:
+            self.syslog_handler = logging.handlers.SysLogHandler(address=(
+                                                _loghost, _logport),
+                                                facility=_logfacility)
+            syslog_formatter = logging.Formatter(_syslog_format)
+            self.syslog_handler.setFormatter(syslog_formatter)
+            self.syslog_handler.setLevel(_logging_level_s)
+            #*** Add syslog log handler to logger:
+            self.logger.addHandler(self.syslog_handler)
+        #*** Console logging:
+        if _console_log_enabled:
+            #*** Log to the console:
+            self.console_handler = logging.StreamHandler()
+            console_formatter = logging.Formatter(_console_format)
+            self.console_handler.setFormatter(console_formatter)
+            self.console_handler.setLevel(_logging_level_c)
+            #*** Add console log handler to logger:
+            self.logger.addHandler(self.console_handler)
+
+        self.identity = _identity
+        self.enabled = _config.get_value('identity_persist_enabled')
+        self.snapshot_interval = _config.get_value \
+                                       ('identity_snapshot_interval')
+        self.journal_flush_interval = _config.get_value \
+                                       ('identity_journal_flush_interval')
+        #*** Directory is relative to the nmeta directory unless absolute:
+        self.directory = os.path.join(os.path.dirname(__file__),
+                           _config.get_value('identity_persist_directory'))
+        #*** Journal records waiting to be written to disk:
+        self._buffer = []
+        #*** Generation number of the journal currently being written:
+        self._generation = 0
+        self._journal_file = None
+        self.last_snapshot_time = time.time()
+        #*** Results of the last recovery:
+        self.recovery = {}
+
+    def restore(self):
+        """
+        Recover identity state from the snapshot and any later journals
+        in the persistence directory, skipping records whose TTL or
+        maximum age has passed. Logs and returns recovery statistics
+        """
+        _start = time.time()
+        _applied = 0
+        _expired = 0
+        _generation = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        _snapshot_path = os.path.join(self.directory, SNAPSHOT_FILENAME)
+        if os.path.exists(_snapshot_path):
+            try:
+                with open(_snapshot_path, 'r') as _file:
+                    #*** First line is the snapshot header:
+                    _generation = json.loads(_file.readline())['generation']
+                    for _line in _file:
+                        if self.identity.apply_record(json.loads(_line),
+                                                      _start):
+                            _applied += 1
+                        else:
+                            _expired += 1
+            except:
+                #*** Log the error and carry on with the journals:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self.logger.error("Could not read identity snapshot "
+                            "file=%s Exception %s, %s, %s", _snapshot_path,
+                             exc_type, exc_value, exc_traceback)
+        for _journal_gen in self._journal_generations():
+            if _journal_gen < _generation:
+                continue
+            for record in self._read_journal(_journal_gen):
+                if self.identity.apply_record(record, _start):
+                    _applied += 1
+                else:
+                    _expired += 1
+            _generation = _journal_gen
+        #*** Start writing the next generation of journal:
+        self._generation = _generation + 1
+        self.recovery = {'seconds': time.time() - _start,
+                         'applied': _applied,
+                         'expired': _expired}
+        self.logger.info("event=identity_recovery seconds=%.3f applied=%s "
+                         "expired=%s", self.recovery['seconds'], _applied,
+                         _expired)
+        return self.recovery
+
+    def start(self):
+        """
+        Start journaling identity updates and run the writer green
+        thread
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._open_journal()
+        self.identity.journal = self.journal
+        hub.spawn(self.run)
+
+    def journal(self, record):
+        """
+        Passed an identity record and buffer it for writing to the
+        journal. Called on the packet-in path so does no I/O
+        """
+        self._buffer.append(record)
+
+    def run(self):
+        """
+        Loop, flushing the journal buffer and taking snapshots at their
+        configured intervals. Runs as a green thread
+        """
+        while True:
+            hub.sleep(self.journal_flush_interval)
+            try:
+                self.flush_journal()
+                if (time.time() - self.last_snapshot_time) > \
+                                                    self.snapshot_interval:
+                    self.snapshot()
+            except:
+                #*** Log the error and keep going:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self.logger.error("Identity persistence failed "
+                            "Exception %s, %s, %s",
+                             exc_type, exc_value, exc_traceback)
+
+    def flush_journal(self):
+        """
+        Write buffered journal records to the current journal file
+        """
+        if not self._buffer:
+            return
+        #*** Swap buffers so that records added meanwhile aren't lost:
+        _records = self._buffer
+        self._buffer = []
+        for record in _records:
+            self._journal_file.write(json.dumps(record) + '\n')
+        self._journal_file.flush()
+
+    def snapshot(self):
+        """
+        Write a compact snapshot of identity state. A new journal
+        generation is started first so that updates made while the
+        snapshot is being taken are in a journal that is replayed after
+        it. Yields to other green threads while serialising, and
+        replaces the previous snapshot atomically
+        """
+        _start = time.time()
+        self.flush_journal()
+        self._generation += 1
+        self._open_journal()
+        _records = 0
+        _snapshot_path = os.path.join(self.directory, SNAPSHOT_FILENAME)
+        _tmp_path = _snapshot_path + '.tmp'
+        with open(_tmp_path, 'w') as _file:
+            _file.write(json.dumps({'generation': self._generation,
+                                    'time': _start}) + '\n')
+            for record in self.identity.get_snapshot_records():
+                _file.write(json.dumps(record) + '\n')
+                _records += 1
+                if not _records % SNAPSHOT_YIELD_RECORDS:
+                    hub.sleep(0)
+        os.rename(_tmp_path, _snapshot_path)
+        #*** Journals older than the snapshot are no longer needed:
+        for _journal_gen in self._journal_generations():
+            if _journal_gen < self._generation:
+                os.remove(self._journal_path(_journal_gen))
+        self.last_snapshot_time = time.time()
+        self.logger.info("event=identity_snapshot records=%s seconds=%.3f",
+                         _records, self.last_snapshot_time - _start)
+
+    def _open_journal(self):
+        """
+        Close the current journal file (if any) and open the journal
+        file for the current generation
+        """
+        if self._journal_file:
+            self._journal_file.close()
+        self._journal_file = open(self._journal_path(self._generation), 'a')
+
+    def _journal_path(self, generation):
+        """
+        Return the path to the journal file for a generation
+        """
+        return os.path.join(self.directory, JOURNAL_PREFIX + str(generation))
+
+    def _journal_generations(self):
+        """
+        Return a sorted list of the generations of journal files in the
+        persistence directory
+        """
+        _generations = []
+        for _filename in os.listdir(self.directory):
+            if _filename.startswith(JOURNAL_PREFIX):
+                _suffix = _filename[len(JOURNAL_PREFIX):]
+                if _suffix.isdigit():
+                    _generations.append(int(_suffix))
+        return sorted(_generations)
+
+    def _read_journal(self, generation):
+        """
+        Generator of the records in a journal file. Stops at the end of
+        the file or at a record that was only partly written
+        """
+        with open(self._journal_path(generation), 'r') as _file:
+            for _line in _file:
+                try:
+                    _record = json.loads(_line)
+                except ValueError:
+                    self.logger.warning("Truncated identity journal "
+                                        "generation=%s", generation)
+                    return
+                yield _record
@@ -219,7 +219,8 @@ class SwitchAbstract(object):
         _result = self.add_flow(datapath, match, actions,
                                  priority=priority, buffer_id=buffer_id,
                                  idle_timeout=idle_timeout,
-                                 hard_timeout=hard_timeout)
+                                 hard_timeout=hard_timeout,
+                                 cookie=kwargs.get('cookie', 0))
         self.logger.debug("result is %s", _result)
         return _result
 
@@ -296,7 +297,8 @@ class SwitchAbstract(object):
         _result = self.add_flow(datapath, match, actions,
                                  priority=priority, buffer_id=buffer_id,
                                  idle_timeout=idle_timeout,
-                                 hard_timeout=hard_timeout)
+                                 hard_timeout=hard_timeout,
+                                 cookie=kwargs.get('cookie', 0))
         self.logger.debug("result is %s", _result)
         return _result
 
@@ -364,6 +366,8 @@ class SwitchAbstract(object):
             buffer_id (None)
             idle_timeout (5)
             hard_timeout (0)
+        Optional kwargs are:
+            cookie (0) - OpenFlow 1.3 only
         """
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
@@ -382,6 +386,7 @@ class SwitchAbstract(object):
             if kwargs['buffer_id']:
                 try:
                     mod = parser.OFPFlowMod(datapath=datapath,
+                                    cookie=kwargs.get('cookie', 0),
                                     idle_timeout=kwargs['idle_timeout'],
                                     hard_timeout=kwargs['hard_timeout'],
                                     buffer_id=kwargs['buffer_id'],
@@ -398,6 +403,7 @@ class SwitchAbstract(object):
             else:
                 try:
                     mod = parser.OFPFlowMod(datapath=datapath,
+                                    cookie=kwargs.get('cookie', 0),
                                     idle_timeout=kwargs['idle_timeout'],
                                     hard_timeout=kwargs['hard_timeout'],
                                     priority=kwargs['priority'],
@@ -448,6 +454,194 @@ class SwitchAbstract(object):
                 return 0
             return 1
 
+    def add_flow_proactive(self, datapath, match_kwargs, out_queue, priority,
+                           goto_table):
+        """
+        Add a proactive flow table entry to a switch that sets the QoS
+        queue for matching packets and passes them on to another table
+        for forwarding. The queue is written to the action set so that
+        it applies to the output action added by the forwarding table.
+        OpenFlow 1.3 only.
+        Returns 1 for success or 0 for any type of error
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        if ofproto.OFP_VERSION != ofproto_v1_3.OFP_VERSION:
+            self.logger.error("event=add_flow_proactive error=E1000030 "
+                              "Unsupported OpenFlow version %s",
+                              ofproto.OFP_VERSION)
+            return 0
+        match = self.get_flow_match(datapath, ofproto.OFP_VERSION,
+                                    **match_kwargs)
+        if not match:
+            return 0
+        try:
+            inst = [parser.OFPInstructionActions(ofproto.OFPIT_WRITE_ACTIONS,
+                                   [parser.OFPActionSetQueue(out_queue)]),
+                    parser.OFPInstructionGotoTable(goto_table)]
+            mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
+                                    match=match, instructions=inst)
+            datapath.send_msg(mod)
+        except:
+            #*** Log the error and return 0:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self.logger.error("event=add_flow_proactive error=E1000031 "
+                            "Exception %s, %s, %s",
+                             exc_type, exc_value, exc_traceback)
+            return 0
+        self.logger.debug("event=add_flow_proactive match=%s queue=%s "
+                          "priority=%s", match, out_queue, priority)
+        return 1
+
+    def add_flow_controller(self, datapath, match_kwargs, priority,
+                            miss_send_len, table_id=0):
+        """
+        Add a flow table entry to a switch that sends matching packets
+        to the controller. Passed an empty match_kwargs this is a
+        table-miss flow entry. OpenFlow 1.3 only.
+        Returns 1 for success or 0 for any type of error
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        if ofproto.OFP_VERSION != ofproto_v1_3.OFP_VERSION:
+            self.logger.error("event=add_flow_controller error=E1000032 "
+                              "Unsupported OpenFlow version %s",
+                              ofproto.OFP_VERSION)
+            return 0
+        if match_kwargs:
+            match = self.get_flow_match(datapath, ofproto.OFP_VERSION,
+                                        **match_kwargs)
+            if not match:
+                return 0
+        else:
+            match = parser.OFPMatch()
+        try:
+            actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
+                                              miss_send_len)]
+            inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
+                                                 actions)]
+            mod = parser.OFPFlowMod(datapath=datapath, table_id=table_id,
+                                    priority=priority, match=match,
+                                    instructions=inst)
+            datapath.send_msg(mod)
+        except:
+            #*** Log the error and return 0:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self.logger.error("event=add_flow_controller error=E1000033 "
+                            "Exception %s, %s, %s",
+                             exc_type, exc_value, exc_traceback)
+            return 0
+        return 1
+
+    def add_flow_forwarding(self, datapath, eth_src, eth_dst, out_port,
+                            **kwargs):
+        """
+        Add a MAC forwarding flow table entry to a forwarding table
+        (as used after proactive flow entries). The output action is
+        written to the action set so that it uses the QoS queue set
+        by the preceding table. OpenFlow 1.3 only.
+        Returns 1 for success or 0 for any type of error
+
+        Required kwargs are:
+            table_id
+            priority
+            idle_timeout
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        if ofproto.OFP_VERSION != ofproto_v1_3.OFP_VERSION:
+            self.logger.error("event=add_flow_forwarding error=E1000034 "
+                              "Unsupported OpenFlow version %s",
+                              ofproto.OFP_VERSION)
+            return 0
+        match = self.get_flow_match(datapath, ofproto.OFP_VERSION,
+                                    eth_src=eth_src, eth_dst=eth_dst)
+        if not match:
+            return 0
+        try:
+            inst = [parser.OFPInstructionActions(ofproto.OFPIT_WRITE_ACTIONS,
+                                   [parser.OFPActionOutput(out_port, 0)])]
+            mod = parser.OFPFlowMod(datapath=datapath,
+                                    table_id=kwargs['table_id'],
+                                    priority=kwargs['priority'],
+                                    idle_timeout=kwargs['idle_timeout'],
+                                    match=match, instructions=inst)
+            datapath.send_msg(mod)
+        except:
+            #*** Log the error and return 0:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self.logger.error("event=add_flow_forwarding error=E1000035 "
+                            "Exception %s, %s, %s",
+                             exc_type, exc_value, exc_traceback)
+            return 0
+        return 1
+
+    def request_flow_stats(self, datapath, cookie):
+        """
+        Request the counters of the flow entries on a switch that have
+        a given cookie. OpenFlow 1.3 only.
+        Returns the xid of the request, or 0 for any type of error
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        if ofproto.OFP_VERSION != ofproto_v1_3.OFP_VERSION:
+            self.logger.error("event=request_flow_stats error=E1000036 "
+                              "Unsupported OpenFlow version %s",
+                              ofproto.OFP_VERSION)
+            return 0
+        try:
+            req = parser.OFPFlowStatsRequest(datapath, 0, ofproto.OFPTT_ALL,
+                                    ofproto.OFPP_ANY, ofproto.OFPG_ANY,
+                                    cookie, 0xffffffffffffffff,
+                                    parser.OFPMatch())
+            datapath.send_msg(req)
+        except:
+            #*** Log the error and return 0:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self.logger.error("event=request_flow_stats error=E1000037 "
+                            "Exception %s, %s, %s",
+                             exc_type, exc_value, exc_traceback)
+            return 0
+        return req.xid
+
+    def modify_flow_queue(self, datapath, cookie, out_port, out_queue,
+                          table_id=0):
+        """
+        Change the QoS queue of the flow entries in a table that have a
+        given cookie, leaving their matches and counters alone.
+        OpenFlow 1.3 only.
+        Returns 1 for success or 0 for any type of error
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        if ofproto.OFP_VERSION != ofproto_v1_3.OFP_VERSION:
+            self.logger.error("event=modify_flow_queue error=E1000038 "
+                              "Unsupported OpenFlow version %s",
+                              ofproto.OFP_VERSION)
+            return 0
+        try:
+            actions = self.get_actions(datapath, ofproto.OFP_VERSION,
+                                       out_port, out_queue)
+            inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
+                                                 actions)]
+            mod = parser.OFPFlowMod(datapath=datapath, cookie=cookie,
+                                    cookie_mask=0xffffffffffffffff,
+                                    table_id=table_id,
+                                    command=ofproto.OFPFC_MODIFY,
+                                    match=parser.OFPMatch(),
+                                    instructions=inst)
+            datapath.send_msg(mod)
+        except:
+            #*** Log the error and return 0:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self.logger.error("event=modify_flow_queue error=E1000039 "
+                            "Exception %s, %s, %s",
+                             exc_type, exc_value, exc_traceback)
+            return 0
+        self.logger.debug("event=modify_flow_queue cookie=%s queue=%s",
+                          cookie, out_queue)
+        return 1
+
     def get_flow_match(self, datapath, ofproto, **kwargs):
         """
         Passed a OF protocol version and a Flow Match keyword arguments dict
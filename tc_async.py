@@ -0,0 +1,371 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#*** nmeta - Network Metadata - TC Asynchronous Classification Class
+#***                                 and Methods
+
+"""
+This module is part of the nmeta suite running on top of Ryu SDN controller
+to provide network identity and flow (traffic classification) metadata.
+It runs CPU heavy classification in worker processes so that it doesn't
+add to packet-in latency. Flows are installed straight away with default
+QoS, then re-marked to the queue for their verdict with a flow
+modification when it arrives.
+"""
+
+import logging
+import logging.handlers
+import sys
+import time
+import collections
+import multiprocessing
+
+#*** Ryu imports:
+from ryu.lib import hub
+
+#*** Seconds between checks for finished jobs:
+POLL_INTERVAL = 0.02
+#*** Seconds to keep a verdict waiting for its flow entry to be
+#*** registered, or a flow entry waiting for its verdict:
+MATCH_MAX_AGE = 60
+
+def worker_main(conn):
+    """
+    Main loop of a worker process. Receives messages on a pipe:
+      ('set', name, value): keep a shared value (i.e. a model) for jobs
+      ('run', function, names, args): call function with the shared
+          values of names then args, and send back (True, result) or
+          (False, error)
+    Stops when sent None
+    """
+    _shared = {}
+    while True:
+        _message = conn.recv()
+        if _message is None:
+            break
+        if _message[0] == 'set':
+            _shared[_message[1]] = _message[2]
+            continue
+        _function, _names, _args = _message[1:]
+        try:
+            conn.send((True, _function(*([_shared[_name]
+                                for _name in _names] + list(_args)))))
+        except:
+            conn.send((False, repr(sys.exc_info()[1])))
+
+class AsyncClassify(object):
+    """
+    This class is instantiated by nmeta.py and provides methods to run
+    classification jobs in a pool of worker processes and to re-mark
+    the flow entries of the flows that they classify.
+    .
+    Workers are polled from a green thread rather than through
+    multiprocessing.Pool, whose result handler would block the Ryu hub.
+    Jobs wait in a bounded queue for a free worker. A job that is
+    rejected because the queue is full, errors, or takes longer than
+    the timeout (its worker is then replaced) gets the fallback verdict.
+    Jobs are sent to workers from the Ryu hub, so large values that
+    many jobs use, such as models, are shared: sent to each worker once
+    and then referred to by name.
+    .
+    Verdicts and flow entries are matched by flow key. The flow
+    entries of a flow (one per switch) are identified by a cookie, so
+    needs OpenFlow 1.3 for cookie masks
+    """
+    def __init__(self, _config, _sa, _flowmetadata):
+        #*** Get logging config values from config class:
+        _logging_level_s = _config.get_value \
+                                    ('tc_async_logging_level_s')
+        _logging_level_c = _config.get_value \
+                                    ('tc_async_logging_level_c')
+        _syslog_enabled = _config.get_value('syslog_enabled')
+        _loghost = _config.get_value('loghost')
+        _logport = _config.get_value('logport')
+        _logfacility = _config.get_value('logfacility')
+        _syslog_format = _config.get_value('syslog_format')
+        _console_log_enabled = _config.get_value('console_log_enabled')
+        _console_format = _config.get_value('console_format')
+        #*** Set up Logging:
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        #*** Syslog:
+        if _syslog_enabled:
+            #*** Log to syslog on host specified in config.yaml:
+            self.syslog_handler = logging.handlers.SysLogHandler(address=(
+                                                _loghost, _logport),
+                                                facility=_logfacility)
+            syslog_formatter = logging.Formatter(_syslog_format)
+            self.syslog_handler.setFormatter(syslog_formatter)
+            self.syslog_handler.setLevel(_logging_level_s)
+            #*** Add syslog log handler to logger:
+            self.logger.addHandler(self.syslog_handler)
+        #*** Console logging:
+        if _console_log_enabled:
+            #*** Log to the console:
+            self.console_handler = logging.StreamHandler()
+            console_formatter = logging.Formatter(_console_format)
+            self.console_handler.setFormatter(console_formatter)
+            self.console_handler.setLevel(_logging_level_c)
+            #*** Add console log handler to logger:
+            self.logger.addHandler(self.console_handler)
+
+        self.sa = _sa
+        self.flowmetadata = _flowmetadata
+        #*** Number of worker processes, 0 to classify inline:
+        self.enabled = _config.get_value('async_classify_workers')
+        self.max_pending = _config.get_value('async_classify_max_pending')
+        #*** Most flows for a caller to put in one job:
+        self.max_batch = _config.get_value('async_classify_max_batch')
+        self.timeout = _config.get_value('async_classify_timeout')
+        self.fallback = {'set_qos_tag':
+                         _config.get_value('async_classify_fallback')}
+        self._workers = []
+        #*** Jobs waiting for a worker:
+        self._queue = collections.deque()
+        #*** Verdicts waiting for their flow entries, and flow entries
+        #*** waiting for their verdict, keyed by flow key:
+        self._verdicts = {}
+        self._flows = {}
+        self.stats = {'submitted': 0, 'completed': 0, 'rejected': 0,
+                      'timeouts': 0, 'errors': 0, 'fallbacks': 0,
+                      'remarked': 0}
+
+    def start(self):
+        """
+        Start the worker processes and the green thread that polls them
+        """
+        self.start_workers()
+        hub.spawn(self.run)
+
+    def start_workers(self):
+        """
+        Start the worker processes
+        """
+        while len(self._workers) < self.enabled:
+            self._workers.append(self._start_worker())
+
+    def stop_workers(self):
+        """
+        Stop the worker processes. Jobs in progress get no verdict
+        """
+        for _worker in self._workers:
+            _worker['process'].terminate()
+            _worker['conn'].close()
+        self._workers = []
+
+    def running(self):
+        """
+        Return True if there are workers to submit jobs to
+        """
+        return bool(self._workers)
+
+    def submit(self, keys, function, args, callback, shared=()):
+        """
+        Passed the keys of the flows that a job classifies, a module
+        level function and its arguments that return a list of actions
+        (one per key), a callback and (optional) shared values as
+        (name, value) pairs. The function is called with the shared
+        values before args. Each worker is only sent a shared value
+        when it doesn't have it already, so jobs should pass the same
+        object (i.e. the model in use) for as long as it is current.
+        Queue the job for a worker. When the job finishes (or falls
+        back), callback is called in the green thread with the keys and
+        actions, and the flow entries of the flows are re-marked.
+        Returns False if there are no workers, in which case the caller
+        should classify inline
+        """
+        if not self._workers:
+            return False
+        self.stats['submitted'] += 1
+        _job = {'keys': keys, 'function': function, 'args': args,
+                'shared': shared, 'callback': callback,
+                'submitted': time.time()}
+        if len(self._queue) >= self.max_pending:
+            self.stats['rejected'] += 1
+            self._complete(_job, None)
+            return True
+        self._queue.append(_job)
+        self._dispatch()
+        return True
+
+    def flow_cookie(self, key):
+        """
+        Passed the key of a flow and return the cookie of the flow
+        entries waiting for its verdict, or 0 if there are none. Flow
+        entries installed for later packets of the flow, or on other
+        switches, should use the same cookie
+        """
+        _flow = self._flows.get(key)
+        if _flow:
+            return _flow['cookie']
+        return 0
+
+    def add_flow(self, key, pkt, datapath, cookie, out_port, out_queue):
+        """
+        Passed the key of a flow that is waiting to be classified, a
+        packet of the flow and the datapath, cookie, out port and out
+        queue of a flow entry installed for it, and re-mark the flow
+        entry when its verdict arrives (or now if it already has)
+        """
+        _flow = self._flows.setdefault(key, {'pkt': pkt, 'cookie': cookie,
+                                             'entries': {}})
+        _flow['time'] = time.time()
+        _flow['entries'][datapath.id] = {'datapath': datapath,
+                                         'out_port': out_port,
+                                         'out_queue': out_queue}
+        if key in self._verdicts:
+            self._remark(self._flows.pop(key),
+                         self._verdicts.pop(key)['actions'])
+
+    def run(self):
+        """
+        Loop, polling for finished jobs. Runs as a green thread
+        """
+        while True:
+            hub.sleep(POLL_INTERVAL)
+            try:
+                self.poll()
+            except:
+                #*** Log the error and keep going:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self.logger.error("Async classify poll failed "
+                            "Exception %s, %s, %s",
+                             exc_type, exc_value, exc_traceback)
+
+    def poll(self):
+        """
+        Complete jobs that have finished or timed out, start waiting
+        jobs on free workers and forget unmatched verdicts and flow
+        entries that are too old
+        """
+        _time = time.time()
+        for _index, _worker in enumerate(self._workers):
+            _job = _worker['job']
+            if not _job:
+                continue
+            if _worker['conn'].poll():
+                _worker['job'] = None
+                try:
+                    _ok, _result = _worker['conn'].recv()
+                except EOFError:
+                    _ok, _result = False, 'worker exited'
+                    self._workers[_index] = self._start_worker()
+                if _ok:
+                    self._complete(_job, _result)
+                else:
+                    self.stats['errors'] += 1
+                    self.logger.error("Async classify job failed error=%s",
+                                      _result)
+                    self._complete(_job, None)
+            elif _time - _job['started'] > self.timeout:
+                #*** Replace the worker as it may never finish:
+                self.stats['timeouts'] += 1
+                _worker['process'].terminate()
+                _worker['conn'].close()
+                self._workers[_index] = self._start_worker()
+                self._complete(_job, None)
+        #*** Jobs that have waited too long for a worker:
+        while self._queue and _time - self._queue[0]['submitted'] > \
+                                                            self.timeout:
+            self.stats['timeouts'] += 1
+            self._complete(self._queue.popleft(), None)
+        self._dispatch()
+        for _table in (self._verdicts, self._flows):
+            for _key, _value in _table.items():
+                if _time - _value['time'] > MATCH_MAX_AGE:
+                    del _table[_key]
+
+    def get_async_stats(self):
+        """
+        Return a dictionary of asynchronous classification statistics
+        """
+        _stats = dict(self.stats)
+        _stats['workers'] = len(self._workers)
+        _stats['queued'] = len(self._queue)
+        _stats['running'] = len([_worker for _worker in self._workers
+                                                    if _worker['job']])
+        return _stats
+
+    def _start_worker(self):
+        """
+        Start a worker process and return its record
+        """
+        _conn, _worker_conn = multiprocessing.Pipe()
+        _process = multiprocessing.Process(target=worker_main,
+                                           args=(_worker_conn,))
+        _process.daemon = True
+        _process.start()
+        _worker_conn.close()
+        return {'process': _process, 'conn': _conn, 'job': None,
+                'shared': {}}
+
+    def _dispatch(self):
+        """
+        Send waiting jobs to free workers
+        """
+        for _worker in self._workers:
+            if not self._queue:
+                return
+            if not _worker['job']:
+                _job = self._queue.popleft()
+                _job['started'] = time.time()
+                for _name, _value in _job['shared']:
+                    if _worker['shared'].get(_name) is not _value:
+                        _worker['conn'].send(('set', _name, _value))
+                        _worker['shared'][_name] = _value
+                _worker['conn'].send(('run', _job['function'],
+                        [_name for _name, _ in _job['shared']], _job['args']))
+                _worker['job'] = _job
+
+    def _complete(self, job, results):
+        """
+        Passed a job and its results, or None to use the fallback
+        verdict, and pass the verdicts to the job callback and on to
+        the flow entries of the flows
+        """
+        if results is None or len(results) != len(job['keys']):
+            self.stats['fallbacks'] += 1
+            results = [self.fallback] * len(job['keys'])
+        else:
+            self.stats['completed'] += 1
+        try:
+            job['callback'](job['keys'], results)
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self.logger.error("Async classify callback failed "
+                            "Exception %s, %s, %s",
+                             exc_type, exc_value, exc_traceback)
+        _time = time.time()
+        for _key, _actions in zip(job['keys'], results):
+            if _key in self._flows:
+                self._remark(self._flows.pop(_key), _actions)
+            else:
+                self._verdicts[_key] = {'actions': _actions, 'time': _time}
+
+    def _remark(self, flow, actions):
+        """
+        Passed the record of the flow entries of a flow and the verdict
+        for the flow. Update the flow metadata and re-mark each flow
+        entry whose QoS queue has changed with a flow modification
+        """
+        _queue = self.flowmetadata.reclassify_flow(flow['pkt'], actions)
+        for _entry in flow['entries'].values():
+            if _queue == _entry['out_queue']:
+                continue
+            if self.sa.modify_flow_queue(_entry['datapath'], flow['cookie'],
+                                         _entry['out_port'], _queue):
+                self.stats['remarked'] += 1
+                self.logger.debug("event=flow_remarked dpid=%s cookie=%s "
+                                  "queue=%s", _entry['datapath'].id,
+                                  flow['cookie'], _queue)
@@ -0,0 +1,245 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#*** nmeta - Network Metadata - TC Batch Classification Class and Methods
+
+"""
+This module is part of the nmeta suite running on top of Ryu SDN controller
+to provide network identity and flow (traffic classification) metadata.
+It provides batch classification of many packets at once against the
+static portion of the compiled traffic classification policy, for
+offline what-if analysis of captures. It is not used by the controller
+and needs NumPy.
+"""
+
+import logging
+import logging.handlers
+
+import struct
+
+#*** NumPy for vectorised matching:
+import numpy as np
+
+#*** Ryu imports (only for building header arrays from packets):
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import ipv4
+from ryu.lib.packet import ipv6
+from ryu.lib.packet import tcp
+from ryu.lib import addrconv
+
+#*** Rule index for packets that match no rule:
+RULE_NO_MATCH = -1
+#*** Rule index for packets that reach a rule that can't be evaluated from
+#*** headers alone (identity, payload or statistical conditions):
+RULE_UNDETERMINED = -2
+
+#*** Header array names and their types:
+HEADER_COLUMNS = {'eth_src': np.uint64,
+                  'eth_dst': np.uint64,
+                  'eth_type': np.uint16,
+                  'ip_ver': np.uint8,
+                  'ip_src': np.uint32,
+                  'ip_dst': np.uint32,
+                  'ip_proto': np.uint8,
+                  'tp_src': np.uint16,
+                  'tp_dst': np.uint16}
+
+class BatchClassify(object):
+    """
+    This class is instantiated with a TrafficClassificationPolicy
+    instance and provides methods to classify columnar arrays of packet
+    headers against the compiled static rules of the policy.
+    Results agree with check_policy for packets that are decided by
+    static rules. Packets that reach a rule with non-static conditions
+    are returned as RULE_UNDETERMINED as the answer would depend on
+    identity, payload or statistical state.
+    """
+    def __init__(self, _config, _tc_policy):
+        #*** Get logging config values from config class:
+        _logging_level_s = _config.get_value \
+                                    ('tc_batch_logging_level_s')
+        _logging_level_c = _config.get_value \
+                                    ('tc_batch_logging_level_c')
+        _syslog_enabled = _config.get_value('syslog_enabled')
+        _loghost = _config.get_value('loghost')
+        _logport = _config.get_value('logport')
+        _logfacility = _config.get_value('logfacility')
+        _syslog_format = _config.get_value('syslog_format')
+        _console_log_enabled = _config.get_value('console_log_enabled')
+        _console_format = _config.get_value('console_format')
+        #*** Set up Logging:
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        #*** Syslog:
+        if _syslog_enabled:
+            #*** Log to syslog on host specified in config.yaml:
+            self.syslog_handler = logging.handlers.SysLogHandler(address=(
+                                                _loghost, _logport),
+                                                facility=_logfacility)
+            syslog_formatter = logging.Formatter(_syslog_format)
+            self.syslog_handler.setFormatter(syslog_formatter)
+            self.syslog_handler.setLevel(_logging_level_s)
+            #*** Add syslog log handler to logger:
+            self.logger.addHandler(self.syslog_handler)
+        #*** Console logging:
+        if _console_log_enabled:
+            #*** Log to the console:
+            self.console_handler = logging.StreamHandler()
+            console_formatter = logging.Formatter(_console_format)
+            self.console_handler.setFormatter(console_formatter)
+            self.console_handler.setLevel(_logging_level_c)
+            #*** Add console log handler to logger:
+            self.logger.addHandler(self.console_handler)
+
+        self.tc_policy = _tc_policy
+
+    def classify(self, headers):
+        """
+        Passed a dictionary of equal length NumPy arrays of packet
+        headers and return a tuple of (rule indices, actions), both
+        arrays with one entry per packet.
+
+        Header arrays are:
+            eth_src, eth_dst: MAC addresses as integers
+            eth_type: EtherType of the Ethernet header
+            ip_ver: (optional) 4, 6 or 0 for not IP. Defaults to being
+                    derived from eth_type
+            ip_src, ip_dst: IPv4 addresses as integers
+            ip_proto: IP protocol number (or IPv6 next header)
+            tp_src, tp_dst: transport source and destination ports
+        Arrays that the policy does not need can be left out.
+
+        Rule indices are the index of the first matching rule in the
+        policy, RULE_NO_MATCH or RULE_UNDETERMINED. Actions are the
+        actions check_policy would return (False for no match) or None
+        for undetermined.
+        """
+        _n = len(headers['eth_type'])
+        _eth_type = np.asarray(headers['eth_type'])
+        if 'ip_ver' in headers:
+            _ip_ver = np.asarray(headers['ip_ver'])
+        else:
+            _ip_ver = np.where(_eth_type == 0x0800, 4,
+                               np.where(_eth_type == 0x86dd, 6, 0))
+        _is_ipv4 = _ip_ver == 4
+        if 'ip_proto' in headers:
+            _is_tcp = (_ip_ver != 0) & (np.asarray(headers['ip_proto']) == 6)
+        else:
+            _is_tcp = None
+        _rule_index = np.full(_n, RULE_NO_MATCH, dtype=np.int32)
+        _unresolved = np.ones(_n, dtype=bool)
+        for idx, tc_rule in self.tc_policy._runtime_ruleset:
+            _boxes = self.tc_policy.compiled_static[idx]
+            if _boxes is None:
+                #*** Can't go any further on headers alone:
+                _rule_index[_unresolved] = RULE_UNDETERMINED
+                break
+            _rule_mask = np.zeros(_n, dtype=bool)
+            for _box in _boxes:
+                _rule_mask |= self._box_mask(_box, headers, _eth_type,
+                                             _is_ipv4, _is_tcp)
+            _rule_mask &= _unresolved
+            _rule_index[_rule_mask] = idx
+            _unresolved &= ~_rule_mask
+            if not _unresolved.any():
+                break
+        #*** Look up actions, offset so that the negative indices map to
+        #*** the first two slots:
+        _lookup = np.empty(len(self.tc_policy.tc_ruleset) + 2, dtype=object)
+        _lookup[RULE_UNDETERMINED + 2] = None
+        _lookup[RULE_NO_MATCH + 2] = False
+        for idx, tc_rule in enumerate(self.tc_policy.tc_ruleset):
+            if isinstance(tc_rule.get('actions'), dict):
+                _lookup[idx + 2] = tc_rule['actions']
+            else:
+                _lookup[idx + 2] = False
+        _actions = _lookup[_rule_index + 2]
+        self.logger.debug("event=classify packets=%s undetermined=%s "
+                          "no_match=%s", _n,
+                          np.count_nonzero(_rule_index == RULE_UNDETERMINED),
+                          np.count_nonzero(_rule_index == RULE_NO_MATCH))
+        return (_rule_index, _actions)
+
+    def _box_mask(self, box, headers, eth_type, is_ipv4, is_tcp):
+        """
+        Passed a compiled match box and the header arrays and return a
+        boolean array of the packets that match the box
+        """
+        _mask = np.ones(len(eth_type), dtype=bool)
+        for _attr, _value in box.items():
+            if _attr in ('eth_src', 'eth_dst'):
+                _mask &= np.asarray(headers[_attr]) == _value
+            elif _attr == 'eth_type':
+                _mask &= eth_type == _value
+            elif _attr in ('ip_src', 'ip_dst'):
+                _column = np.asarray(headers[_attr])
+                _mask &= is_ipv4 & (_column >= _value[0]) & \
+                                   (_column <= _value[1])
+            elif _attr in ('tcp_src', 'tcp_dst'):
+                if is_tcp is None:
+                    raise KeyError("ip_proto header array is needed for "
+                                   "TCP conditions")
+                _column = np.asarray(headers['tp' + _attr[3:]])
+                _mask &= is_tcp & (_column == _value)
+        return _mask
+
+def packets_to_headers(pkts):
+    """
+    Passed a list of Ryu packet objects and return a dictionary of
+    header arrays suitable for BatchClassify.classify()
+    """
+    _columns = dict((_name, []) for _name in HEADER_COLUMNS)
+    for pkt in pkts:
+        pkt_eth = pkt.get_protocol(ethernet.ethernet)
+        pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
+        pkt_ip6 = pkt.get_protocol(ipv6.ipv6)
+        pkt_tcp = pkt.get_protocol(tcp.tcp)
+        _columns['eth_src'].append(_mac_t2i(pkt_eth.src))
+        _columns['eth_dst'].append(_mac_t2i(pkt_eth.dst))
+        _columns['eth_type'].append(pkt_eth.ethertype)
+        if pkt_ip4:
+            _columns['ip_ver'].append(4)
+            _columns['ip_src'].append(_ipv4_t2i(pkt_ip4.src))
+            _columns['ip_dst'].append(_ipv4_t2i(pkt_ip4.dst))
+            _columns['ip_proto'].append(pkt_ip4.proto)
+        elif pkt_ip6:
+            _columns['ip_ver'].append(6)
+            _columns['ip_src'].append(0)
+            _columns['ip_dst'].append(0)
+            _columns['ip_proto'].append(pkt_ip6.nxt)
+        else:
+            _columns['ip_ver'].append(0)
+            _columns['ip_src'].append(0)
+            _columns['ip_dst'].append(0)
+            _columns['ip_proto'].append(0)
+        if pkt_tcp:
+            _columns['tp_src'].append(pkt_tcp.src_port)
+            _columns['tp_dst'].append(pkt_tcp.dst_port)
+        else:
+            _columns['tp_src'].append(0)
+            _columns['tp_dst'].append(0)
+    return dict((_name, np.array(_values, dtype=HEADER_COLUMNS[_name]))
+                for _name, _values in _columns.items())
+
+def _mac_t2i(mac_text):
+    """
+    Turns a MAC address in colon separated hex format into an integer
+    """
+    return int(mac_text.replace(':', ''), 16)
+
+def _ipv4_t2i(ip_text):
+    """
+    Turns an IPv4 address in text format into an integer
+    """
+    return struct.unpack('!I', addrconv.ipv4.text_to_bin(ip_text))[0]
@@ -0,0 +1,267 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#*** nmeta - Network Metadata - TC Flow Counter Classification Class
+#***                                 and Methods
+
+"""
+This module is part of the nmeta suite running on top of Ryu SDN controller
+to provide network identity and flow (traffic classification) metadata.
+It classifies flows statistically from the packet and byte counters of
+their flow entries, polled from switches with targeted flow statistics
+requests, so that flows don't need to be punted to the controller to be
+classified. Flows that cross the bandwidth hog thresholds are re-marked
+to the low priority queue with a flow modification.
+"""
+
+import logging
+import logging.handlers
+import sys
+import time
+
+#*** Ryu imports:
+from ryu.lib import hub
+
+#*** QoS tag that bandwidth hog flows are re-marked with:
+QOS_TAG_HOG = 'QoS_treatment=low_priority'
+#*** Number of maximum poll intervals without a reply after which a flow
+#*** is assumed to have gone:
+NO_REPLY_INTERVALS = 3
+
+class CounterClassify(object):
+    """
+    This class is instantiated by nmeta.py and provides methods to
+    register flow entries for counter based classification, poll their
+    counters on an adaptive schedule and re-mark them when they cross
+    the bandwidth hog thresholds.
+    .
+    Flow entries are identified on switches by a unique cookie. Polling
+    of a flow starts at the minimum poll interval and backs off
+    (doubling) to the maximum while its classification is stable.
+    Needs OpenFlow 1.3 for cookie masks
+    """
+    def __init__(self, _config, _sa, _qos):
+        #*** Get logging config values from config class:
+        _logging_level_s = _config.get_value \
+                                    ('tc_counters_logging_level_s')
+        _logging_level_c = _config.get_value \
+                                    ('tc_counters_logging_level_c')
+        _syslog_enabled = _config.get_value('syslog_enabled')
+        _loghost = _config.get_value('loghost')
+        _logport = _config.get_value('logport')
+        _logfacility = _config.get_value('logfacility')
+        _syslog_format = _config.get_value('syslog_format')
+        _console_log_enabled = _config.get_value('console_log_enabled')
+        _console_format = _config.get_value('console_format')
+        #*** Set up Logging:
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        #*** Syslog:
+        if _syslog_enabled:
+            #*** Log to syslog on host specified in config.yaml:
+            self.syslog_handler = logging.handlers.SysLogHandler(address=(
+                                                _loghost, _logport),
+                                                facility=_logfacility)
+            syslog_formatter = logging.Formatter(_syslog_format)
+            self.syslog_handler.setFormatter(syslog_formatter)
+            self.syslog_handler.setLevel(_logging_level_s)
+            #*** Add syslog log handler to logger:
+            self.logger.addHandler(self.syslog_handler)
+        #*** Console logging:
+        if _console_log_enabled:
+            #*** Log to the console:
+            self.console_handler = logging.StreamHandler()
+            console_formatter = logging.Formatter(_console_format)
+            self.console_handler.setFormatter(console_formatter)
+            self.console_handler.setLevel(_logging_level_c)
+            #*** Add console log handler to logger:
+            self.logger.addHandler(self.console_handler)
+
+        self.sa = _sa
+        self.qos = _qos
+        self.enabled = _config.get_value('statistical_counter_mode')
+        self.poll_min = _config.get_value('statistical_counter_poll_min')
+        self.poll_max = _config.get_value('statistical_counter_poll_max')
+        self.hog_rate = _config.get_value('statistical_counter_hog_rate')
+        self.hog_avg_size = _config.get_value \
+                                    ('statistical_counter_hog_avg_size')
+        #*** Flows being classified, keyed by (dpid, cookie):
+        self._flows = {}
+        #*** Cookies of outstanding flow stats requests keyed by
+        #*** (dpid, xid):
+        self._requests = {}
+        #*** Next cookie to use. Cookie 0 is left for flow entries that
+        #*** aren't being classified:
+        self._cookie = 1
+        self.stats = {'flows': 0, 'polls': 0, 'replies': 0, 'remarked': 0,
+                      'removed': 0}
+
+    def new_cookie(self):
+        """
+        Return a cookie to install a flow entry with so that it can be
+        registered with add_flow
+        """
+        _cookie = self._cookie
+        self._cookie += 1
+        return _cookie
+
+    def add_flow(self, datapath, cookie, out_port, out_queue):
+        """
+        Passed the datapath that a flow entry has been installed on,
+        its cookie, out port and out queue and start classifying it
+        from its counters. Returns the flow record
+        """
+        _time = time.time()
+        _flow = {'datapath': datapath,
+                 'cookie': cookie,
+                 'out_port': out_port,
+                 'out_queue': out_queue,
+                 'default_queue': out_queue,
+                 'packets': 0,
+                 'bytes': 0,
+                 'duration': 0.0,
+                 'rate': 0.0,
+                 'avg_size': 0,
+                 'hog': False,
+                 'interval': self.poll_min,
+                 'next_poll': _time + self.poll_min,
+                 'last_reply': _time,
+                 'xid': None}
+        self._flows[(datapath.id, cookie)] = _flow
+        self.stats['flows'] += 1
+        return _flow
+
+    def run(self):
+        """
+        Loop, polling the counters of flows that are due to be polled.
+        Runs as a green thread
+        """
+        while True:
+            hub.sleep(self.poll_min)
+            try:
+                self.poll()
+            except:
+                #*** Log the error and keep going:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self.logger.error("Flow counter poll failed "
+                            "Exception %s, %s, %s",
+                             exc_type, exc_value, exc_traceback)
+
+    def poll(self):
+        """
+        Send flow stats requests for flows that are due, and forget
+        flows that haven't had a reply for too long
+        """
+        _time = time.time()
+        _for_deletion = []
+        for _key, _flow in self._flows.iteritems():
+            if _time - _flow['last_reply'] > \
+                                    self.poll_max * NO_REPLY_INTERVALS:
+                _for_deletion.append(_key)
+            elif _time >= _flow['next_poll']:
+                _xid = self.sa.request_flow_stats(_flow['datapath'],
+                                                  _flow['cookie'])
+                if _xid:
+                    #*** Only the latest request for a flow is kept:
+                    self._requests.pop((_key[0], _flow['xid']), None)
+                    self._requests[(_key[0], _xid)] = _flow['cookie']
+                    _flow['xid'] = _xid
+                    self.stats['polls'] += 1
+                _flow['next_poll'] = _time + _flow['interval']
+        for _key in _for_deletion:
+            self._remove_flow(_key)
+
+    def flow_stats_reply(self, msg):
+        """
+        Passed a flow stats reply message and update the flows that it
+        has counters for. A reply with no counters for a flow means
+        that its flow entry has gone (i.e. idle timeout)
+        """
+        _dpid = msg.datapath.id
+        _cookie = self._requests.pop((_dpid, msg.xid), None)
+        if not msg.body and _cookie:
+            self._remove_flow((_dpid, _cookie))
+            return
+        for _stat in msg.body:
+            _key = (_dpid, _stat.cookie)
+            if not _key in self._flows:
+                continue
+            self.stats['replies'] += 1
+            _flow = self._flows[_key]
+            _queue = self.update_flow(_flow, _stat.packet_count,
+                                      _stat.byte_count, _stat.duration_sec +
+                                      _stat.duration_nsec / 1000000000.0)
+            if _queue is not None:
+                if self.sa.modify_flow_queue(_flow['datapath'],
+                                _flow['cookie'], _flow['out_port'], _queue):
+                    _flow['out_queue'] = _queue
+                    self.stats['remarked'] += 1
+
+    def update_flow(self, flow, packets, octets, duration):
+        """
+        Passed a flow record and the packet count, byte count and
+        duration of its flow entry. Derive the rate and average packet
+        size since the last poll, adapt the poll interval and return
+        the queue to re-mark the flow to, or None if unchanged
+        """
+        _time = time.time()
+        flow['last_reply'] = _time
+        _delta_packets = packets - flow['packets']
+        _delta_bytes = octets - flow['bytes']
+        _delta_duration = duration - flow['duration']
+        flow['packets'] = packets
+        flow['bytes'] = octets
+        flow['duration'] = duration
+        if _delta_duration > 0:
+            flow['rate'] = _delta_bytes / _delta_duration
+        if _delta_packets > 0:
+            flow['avg_size'] = _delta_bytes / _delta_packets
+        _hog = flow['rate'] > self.hog_rate and \
+                                    flow['avg_size'] > self.hog_avg_size
+        _queue = None
+        if _hog != flow['hog']:
+            flow['hog'] = _hog
+            if _hog:
+                _queue = self.qos.check_policy({'set_qos_tag': QOS_TAG_HOG})
+            else:
+                _queue = flow['default_queue']
+            if _queue == flow['out_queue']:
+                _queue = None
+            #*** Classification changed so poll more often again:
+            flow['interval'] = self.poll_min
+            self.logger.info("event=flow_reclassified cookie=%s hog=%s "
+                             "rate=%s avg_size=%s queue=%s", flow['cookie'],
+                             _hog, flow['rate'], flow['avg_size'], _queue)
+        else:
+            #*** Classification is stable so back off:
+            flow['interval'] = min(flow['interval'] * 2, self.poll_max)
+        flow['next_poll'] = _time + flow['interval']
+        return _queue
+
+    def get_counter_stats(self):
+        """
+        Return a dictionary of counter classification statistics
+        """
+        _stats = dict(self.stats)
+        _stats['active'] = len(self._flows)
+        return _stats
+
+    def _remove_flow(self, key):
+        """
+        Passed a (dpid, cookie) key and stop classifying the flow
+        """
+        if key in self._flows:
+            self._requests.pop((key[0], self._flows[key]['xid']), None)
+            del self._flows[key]
+            self.stats['removed'] += 1
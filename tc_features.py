@@ -0,0 +1,371 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#*** nmeta - Network Metadata - Flow Feature Classes and Methods
+
+"""
+This module is part of the nmeta suite running on top of Ryu SDN controller
+to provide network identity and flow (traffic classification) metadata.
+It provides per-flow feature accumulation, compact raw packet
+feature buffers and duplicate packet filters for statistical traffic
+classifiers.
+"""
+
+from array import array
+
+#*** Packet directions within a flow. Feature buffers store a direction
+#*** as its index in this tuple:
+DIRECTIONS = ('forward', 'reverse')
+DIRECTION_CODES = {'forward': 0, 'reverse': 1}
+
+#*** Duplicate packet filter size per flow. Two generations of bits,
+#*** each holding up to capacity packet fingerprints, so 128 bytes of
+#*** filter per flow. Measured false positive rate is about 0.3% with one
+#*** full generation and 0.6% with two:
+DUPLICATE_FILTER_BITS = 512
+DUPLICATE_FILTER_HASHES = 4
+DUPLICATE_FILTER_CAPACITY = 32
+#*** Constants of the splitmix64 finaliser that spreads fingerprint
+#*** hashes (which are similar for similar fingerprints) over 64 bits:
+MIX_INCREMENT = 0x9e3779b97f4a7c15
+MIX_MULTIPLIER_1 = 0xbf58476d1ce4e5b9
+MIX_MULTIPLIER_2 = 0x94d049bb133111eb
+MASK_64 = 0xffffffffffffffff
+
+class FlowAccumulator(object):
+    """
+    This class is instantiated by tc_statistical.py once per flow in the
+    Flow Classification In Progress (FCIP) table and accumulates the
+    statistics of the flow online as packets are added, so that no
+    per-packet history needs to be kept and the statistics are
+    available in constant time.
+    .
+    Per-direction values are dictionaries keyed by 'forward' and
+    'reverse'. Interval values are in seconds and are between packets
+    in the same direction. A value of 0 means not seen yet.
+    """
+    def __init__(self):
+        #*** Number of (non-duplicate) packets and bytes:
+        self.packets = 0
+        self.packets_dir = {'forward': 0, 'reverse': 0}
+        self.bytes = {'forward': 0, 'reverse': 0}
+        #*** Packet sizes (IP total length):
+        self.max_size = {'forward': 0, 'reverse': 0}
+        self.min_size = {'forward': 0, 'reverse': 0}
+        #*** Count of packets of each size:
+        self.size_counts = {}
+        #*** Arrival times and inter-packet intervals:
+        self.first_arrival = 0
+        self.last_arrival = {'forward': 0, 'reverse': 0}
+        self.max_interval = {'forward': 0, 'reverse': 0}
+        self.min_interval = {'forward': 0, 'reverse': 0}
+        self.last_interval = 0
+        #*** TCP window sizes:
+        self.first_window = {'forward': 0, 'reverse': 0}
+        self.max_window = {'forward': 0, 'reverse': 0}
+        #*** Filter of signatures of packets seen, for duplicate
+        #*** detection. Created on the first signature:
+        self._duplicates = None
+
+    def __repr__(self):
+        return ("FlowAccumulator(packets=%s bytes=%s max_size=%s "
+                "min_interval=%s max_interval=%s)" % (self.packets,
+                self.bytes, self.max_size, self.min_interval,
+                self.max_interval))
+
+    def is_duplicate(self, signature):
+        """
+        Passed a packet signature (a hashable of header values that
+        differ between packets of a flow) and return True if a packet
+        with the same signature has probably already been added (see
+        DuplicateFilter), otherwise False
+        """
+        if self._duplicates is None:
+            return False
+        return signature in self._duplicates
+
+    def update(self, direction, arrival_time, size, window_size=0,
+                    signature=None):
+        """
+        Passed the direction ('forward' or 'reverse'), arrival time,
+        IP total length, (optional) TCP window size (already scaled)
+        and (optional) duplicate detection signature of a packet and
+        update the flow statistics with it
+        """
+        self.packets += 1
+        self.packets_dir[direction] += 1
+        self.bytes[direction] += size
+        #*** Packet sizes:
+        if size > self.max_size[direction]:
+            self.max_size[direction] = size
+        if not self.min_size[direction] or size < self.min_size[direction]:
+            self.min_size[direction] = size
+        self.size_counts[size] = self.size_counts.get(size, 0) + 1
+        #*** Inter-packet intervals in the same direction:
+        if not self.first_arrival:
+            self.first_arrival = arrival_time
+        _previous = self.last_arrival[direction]
+        if _previous:
+            _interval = arrival_time - _previous
+            if _interval > self.max_interval[direction]:
+                self.max_interval[direction] = _interval
+            if not self.min_interval[direction] or \
+                                    _interval < self.min_interval[direction]:
+                self.min_interval[direction] = _interval
+            self.last_interval = _interval
+        self.last_arrival[direction] = arrival_time
+        #*** TCP window sizes:
+        if window_size:
+            if not self.first_window[direction]:
+                self.first_window[direction] = window_size
+            if window_size > self.max_window[direction]:
+                self.max_window[direction] = window_size
+        if signature is not None:
+            if self._duplicates is None:
+                self._duplicates = DuplicateFilter()
+            self._duplicates.add(signature)
+
+    def get_max_packet_size(self):
+        """
+        Return the largest packet size in either direction
+        """
+        return max(self.max_size.values())
+
+    def get_max_interpacket_interval(self):
+        """
+        Return the largest inter-packet interval from either direction
+        """
+        return max(self.max_interval.values())
+
+    def get_min_interpacket_interval(self):
+        """
+        Return the smallest inter-packet interval from either direction
+        or 0 if there isn't one yet
+        """
+        _intervals = [_interval for _interval in self.min_interval.values()
+                                                            if _interval]
+        if _intervals:
+            return min(_intervals)
+        return 0
+
+    def get_max_window_growth(self):
+        """
+        Return the largest TCP window growth ratio (largest window over
+        first window) out of the forward and reverse directions or 0 if
+        no windows have been seen
+        """
+        _max_ratio = 0
+        for _direction in DIRECTIONS:
+            if self.first_window[_direction]:
+                _ratio = float(self.max_window[_direction]) / \
+                                        float(self.first_window[_direction])
+                if _ratio > _max_ratio:
+                    _max_ratio = _ratio
+        return _max_ratio
+
+    def get_feature_vector(self, names):
+        """
+        Passed a list of feature names (see FEATURES) and return a list
+        of the values of those features for the flow, as floats
+        """
+        return [float(FEATURES[_name](self)) for _name in names]
+
+def _min_nonzero(values):
+    """
+    Return the smallest of the non-zero values or 0 if there are none
+    """
+    _values = [_value for _value in values if _value]
+    if _values:
+        return min(_values)
+    return 0
+
+def _interval_ratio(features):
+    """
+    Return the ratio of smallest to largest inter-packet interval of
+    a flow, or 0 if it can't be worked out
+    """
+    _max_interval = features.get_max_interpacket_interval()
+    _min_interval = features.get_min_interpacket_interval()
+    if _max_interval and _min_interval:
+        return float(_min_interval) / float(_max_interval)
+    return 0
+
+#*** Features of a flow that can be used to classify it, by name, with
+#*** functions to get them from a FlowAccumulator:
+FEATURES = {
+    'packets': lambda features: features.packets,
+    'packets_forward': lambda features: features.packets_dir['forward'],
+    'packets_reverse': lambda features: features.packets_dir['reverse'],
+    'bytes_forward': lambda features: features.bytes['forward'],
+    'bytes_reverse': lambda features: features.bytes['reverse'],
+    'max_size': lambda features: features.get_max_packet_size(),
+    'min_size': lambda features: _min_nonzero(features.min_size.values()),
+    'avg_size': lambda features: float(sum(features.bytes.values())) /
+                                            max(features.packets, 1),
+    'max_interval': lambda features:
+                                features.get_max_interpacket_interval(),
+    'min_interval': lambda features:
+                                features.get_min_interpacket_interval(),
+    'last_interval': lambda features: features.last_interval,
+    'interval_ratio': _interval_ratio,
+    'window_growth': lambda features: features.get_max_window_growth(),
+    'duration': lambda features: max(features.last_arrival.values()) -
+                                            features.first_arrival}
+
+class DuplicateFilter(object):
+    """
+    This class is instantiated by FlowAccumulator once per flow and is
+    a rotating Bloom filter of packet fingerprints (hashable tuples of
+    header values), used to reject duplicates of packets, such as the
+    same packet punted by more than one switch on its path, in constant
+    time and fixed memory.
+    .
+    Fingerprints are added to the current generation of bits. Once it
+    holds capacity fingerprints it becomes the previous generation and
+    a new current generation is started, so the filter never fills up
+    and recent fingerprints are always remembered. Membership is
+    checked against both generations. A Bloom filter can give false
+    positives (a new packet reported as a duplicate) but never false
+    negatives
+    """
+    def __init__(self, bits=DUPLICATE_FILTER_BITS,
+                    hashes=DUPLICATE_FILTER_HASHES,
+                    capacity=DUPLICATE_FILTER_CAPACITY):
+        self.bits = bits
+        self.hashes = hashes
+        self.capacity = capacity
+        #*** Generations of bits, as integers used as bit fields:
+        self.current = 0
+        self.previous = 0
+        #*** Number of fingerprints added to the current generation:
+        self.count = 0
+
+    def __repr__(self):
+        return ("DuplicateFilter(bits=%s hashes=%s capacity=%s count=%s)" %
+                (self.bits, self.hashes, self.capacity, self.count))
+
+    def __contains__(self, fingerprint):
+        _mask = self._mask(fingerprint)
+        return (self.current & _mask == _mask or
+                self.previous & _mask == _mask)
+
+    def add(self, fingerprint):
+        """
+        Passed a packet fingerprint and add it to the filter
+        """
+        if self.count >= self.capacity:
+            #*** Rotate generations:
+            self.previous = self.current
+            self.current = 0
+            self.count = 0
+        self.current |= self._mask(fingerprint)
+        self.count += 1
+
+    def false_positive_rate(self):
+        """
+        Return the probability that a fingerprint that hasn't been added
+        is reported as being in the filter, worked out from the number of
+        bits set in each generation
+        """
+        _miss = 1.0
+        for _generation in (self.current, self.previous):
+            _fill = float(bin(_generation).count('1')) / self.bits
+            _miss *= 1 - _fill ** self.hashes
+        return 1 - _miss
+
+    def _mask(self, fingerprint):
+        """
+        Passed a fingerprint and return a bit field with its bits set.
+        Bit positions are worked out by double hashing, with the two
+        hashes being the halves of the mixed fingerprint hash
+        """
+        _mixed = (hash(fingerprint) + MIX_INCREMENT) & MASK_64
+        _mixed = ((_mixed ^ (_mixed >> 30)) * MIX_MULTIPLIER_1) & MASK_64
+        _mixed = ((_mixed ^ (_mixed >> 27)) * MIX_MULTIPLIER_2) & MASK_64
+        _mixed ^= _mixed >> 31
+        _hash_1 = _mixed & 0xffffffff
+        _hash_2 = (_mixed >> 32) | 1
+        _mask = 0
+        for _index in xrange(self.hashes):
+            _mask |= 1 << ((_hash_1 + _index * _hash_2) % self.bits)
+        return _mask
+
+class FlowFeatureBuffer(object):
+    """
+    This class is instantiated by tc_statistical.py once per flow in the
+    Flow Classification In Progress (FCIP) table and keeps the raw
+    features of packets in the flow in fixed size typed array columns
+    rather than per-packet dictionaries.
+    .
+    It is a ring buffer with a fixed number of slots. Once full, each
+    packet appended replaces the oldest. Iterating yields tuples of
+    (direction, arrival_time, size, window_size), oldest first.
+    """
+    def __init__(self, slots):
+        self.slots = slots
+        #*** Total number of packets appended, including overwritten ones:
+        self.count = 0
+        self.directions = array('B', [0]) * slots
+        self.arrival_times = array('d', [0.0]) * slots
+        self.sizes = array('H', [0]) * slots
+        #*** Scaled TCP windows can be larger than 16 bits:
+        self.windows = array('I', [0]) * slots
+
+    def __repr__(self):
+        return "FlowFeatureBuffer(slots=%s count=%s)" % (self.slots,
+                                                          self.count)
+
+    def __len__(self):
+        return min(self.count, self.slots)
+
+    def __iter__(self):
+        for _slot in self._slot_order():
+            yield (DIRECTIONS[self.directions[_slot]],
+                   self.arrival_times[_slot],
+                   self.sizes[_slot],
+                   self.windows[_slot])
+
+    def append(self, direction, arrival_time, size, window_size=0):
+        """
+        Passed the direction ('forward' or 'reverse'), arrival time,
+        IP total length and (optional) TCP window size of a packet and
+        store them in the next slot
+        """
+        _slot = self.count % self.slots
+        self.directions[_slot] = DIRECTION_CODES[direction]
+        self.arrival_times[_slot] = arrival_time
+        self.sizes[_slot] = size
+        self.windows[_slot] = window_size
+        self.count += 1
+
+    def column(self, name):
+        """
+        Passed the name of a column ('directions', 'arrival_times',
+        'sizes' or 'windows') and return a list of its values, oldest
+        first. Directions are returned as 'forward' or 'reverse'
+        """
+        _values = getattr(self, name)
+        if name == 'directions':
+            return [DIRECTIONS[_values[_slot]]
+                                        for _slot in self._slot_order()]
+        return [_values[_slot] for _slot in self._slot_order()]
+
+    def _slot_order(self):
+        """
+        Return the slot numbers holding packets, oldest first
+        """
+        if self.count <= self.slots:
+            return xrange(self.count)
+        _start = self.count % self.slots
+        return [(_start + _offset) % self.slots
+                                        for _offset in xrange(self.slots)]
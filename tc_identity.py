@@ -20,12 +20,12 @@ to provide network identity and flow (traffic classification) metadata
 
 import logging
 import logging.handlers
+import sys
+import heapq
 import struct
 import time
 import re
 
-import socket
-
 #*** Ryu imports:
 from ryu.lib import addrconv
 from ryu.lib.packet import packet
@@ -38,6 +38,13 @@ from ryu.lib.packet import tcp
 #*** nmeta imports:
 import nmisc
 
+#*** Maximum number of (pattern, name) regex results to memoise before the
+#*** memo is cleared:
+IDENTITY_REGEX_MEMO_MAX = 10000
+#*** Maximum number of DHCP REQUEST host names to hold waiting for an ACK
+#*** before they are cleared:
+IDENTITY_DHCP_PENDING_MAX = 10000
+
 class IdentityInspect(object):
     """
     This class is instantiated by tc_policy.py 
@@ -85,12 +92,41 @@ class IdentityInspect(object):
         #*** Instantiate the System and NIC Identity Tables (Legacy):
         self._sys_identity_table = nmisc.AutoVivification()
         self._nic_identity_table = nmisc.AutoVivification()
+        #*** Indexes into the System and NIC Identity Tables, kept in step
+        #*** with the tables by the _set_* and _del_* methods:
+        self._nic_ref_by_mac = {}
+        self._sys_ref_by_chassisid = {}
+        self._sys_refs_by_systemname = {}
+        #*** Compiled policy regexes, memoised regex results and regex
+        #*** system name lookups:
+        self._regexes = {}
+        self._regex_memo = {}
+        self._sys_ref_by_systemname_re = {}
         #*** Identity Dictionaries
         #***  Let these be accessed directly to avoid overhead of getters:
         self.id_mac = {}
         self.id_ip = {}
         self.id_node = {}
         self.id_service = {}
+        #*** Per context trie of reversed DNS labels of services in id_ip,
+        #*** each node holding IPs of services at or under it:
+        self.id_service_trie = {}
+        #*** Per context reverse index of DNS service name to the IPs
+        #*** that back it, with the validity deadline of each:
+        self.id_service_ips = {}
+        #*** Functions to call when an IP's identity records change:
+        self._ip_change_callbacks = []
+        #*** Function to pass identity mutation records to so that they
+        #*** can be persisted (set by the persist module):
+        self.journal = None
+        #*** Host names from DHCP REQUESTs waiting for an ACK, by MAC:
+        self._dhcp_pending = {}
+        #*** Min-heap of (deadline, kind, key) for expiry of id_mac ARP
+        #*** entries, id_ip DNS services and DHCP leases and id_service
+        #*** CNAME domains, with the earliest pending deadline for each
+        #*** (kind, key):
+        self._expiry_heap = []
+        self._expiry_pending = {}
         #*** Initialise Identity Tables unique reference numbers:
         #*** Start at 1 so that value 0 can be used for boolean
         #*** false on checks
@@ -163,7 +199,7 @@ class IdentityInspect(object):
                 return False
 
         elif policy_attr == "identity_service_dns":
-            #*** Look up service in id_ip structure:
+            #*** Look up service in the service to IP reverse index:
             ips = []
             if pkt_ip4:
                 #*** turn the src and dst IPs into a list so can iterate:
@@ -171,18 +207,26 @@ class IdentityInspect(object):
             if pkt_ip6:
                 #*** turn the src and dst IPs into a list so can iterate:
                 ips = [pkt_ip6.src, pkt_ip6.dst]
-            if ctx in self.id_ip:
-                ip_ctx = self.id_ip[ctx]
+            _service_ips = self.id_service_ips.get(ctx, {}).get(policy_value)
+            if _service_ips:
+                _time = time.time()
                 for ip in ips:
-                    if ip in self.id_ip[ctx]:
-                        ip_ctx_ip = ip_ctx[ip]
-                        if 'service' in ip_ctx_ip:
-                            for service in ip_ctx_ip['service']:
-                                if service == policy_value:
-                                    #*** Matched service but is it valid?:
-                                    if self.valid_id_ip_service(ctx, ip,
-                                                                    service):
-                                        return True
+                    #*** Matched service but is it valid?:
+                    if _service_ips.get(ip, 0) > _time:
+                        return True
+
+        elif policy_attr == "identity_service_dns_suffix":
+            #*** Look up domain in the service trie:
+            ips = []
+            if pkt_ip4:
+                #*** turn the src and dst IPs into a list so can iterate:
+                ips = [pkt_ip4.src, pkt_ip4.dst]
+            if pkt_ip6:
+                #*** turn the src and dst IPs into a list so can iterate:
+                ips = [pkt_ip6.src, pkt_ip6.dst]
+            for ip in ips:
+                if self._service_trie_match(ctx, policy_value, ip):
+                    return True
 
         elif policy_attr == "identity_service_dns_re":
             #*** Look up service in id_ip structure:
@@ -200,7 +244,7 @@ class IdentityInspect(object):
                         ip_ctx_ip = ip_ctx[ip]
                         if 'service' in ip_ctx_ip:
                             for service in ip_ctx_ip['service']:
-                                if (re.match(policy_value, service)):
+                                if self._regex_match(policy_value, service):
                                     #*** Matched service but is it valid?:
                                     if self.valid_id_ip_service(ctx, ip,
                                                                     service):
@@ -210,6 +254,58 @@ class IdentityInspect(object):
             self.logger.error("Policy attribute %s did not match", policy_attr)
             return False
 
+    def compile_regexes(self, patterns):
+        """
+        Passed an iterable of regular expressions from the policy and
+        compile them ready for use in identity checks. Memoised
+        results from previous regexes are discarded
+        """
+        _regexes = {}
+        for pattern in patterns:
+            try:
+                _regexes[pattern] = re.compile(pattern)
+            except re.error as exception:
+                self.logger.critical("Invalid identity regex=%s "
+                                     "exception=%s", pattern, exception)
+                sys.exit("Exiting nmeta. Please fix error in "
+                             "main_policy.yaml file")
+        self._regexes = _regexes
+        self._regex_memo = {}
+        self._sys_ref_by_systemname_re = {}
+        self.logger.debug("event=compile_regexes count=%s", len(_regexes))
+
+    def _regex_match(self, pattern, name):
+        """
+        Passed a regular expression and a name and return True if
+        the regular expression matches the start of the name.
+        Results are memoised in a bounded dictionary
+        """
+        _key = (pattern, name)
+        if _key in self._regex_memo:
+            return self._regex_memo[_key]
+        if pattern not in self._regexes:
+            #*** Not seen at policy load, so compile and keep it:
+            self._regexes[pattern] = re.compile(pattern)
+        _result = bool(self._regexes[pattern].match(name))
+        if len(self._regex_memo) >= IDENTITY_REGEX_MEMO_MAX:
+            self._regex_memo = {}
+        self._regex_memo[_key] = _result
+        return _result
+
+    def get_service_ips(self, ctx, service):
+        """
+        Passed a context and a DNS service name and return a dictionary
+        of the IP addresses that currently back the service, keyed by IP
+        with the number of seconds that the mapping remains valid for
+        """
+        _time = time.time()
+        _result = {}
+        for ip, deadline in \
+                    self.id_service_ips.get(ctx, {}).get(service, {}).items():
+            if deadline > _time:
+                _result[ip] = deadline - _time
+        return _result
+
     def valid_id_ip_service(self, ctx, ip, service):
         """
         Passed variables to look up a service in id_ip structure.
@@ -227,11 +323,10 @@ class IdentityInspect(object):
                     return True
         return False
 
-    def lldp_in(self, pkt, dpid, inport):
+    def lldp_extract(self, pkt):
         """
-        Passed an lldp packet, a Data Path ID (dpid) and in port
-        and update identity tables (if required) with this identity
-        information
+        Passed an lldp packet and return a tuple of its Chassis ID
+        in text format and its system name, or 0 if it doesn't parse
         """
         _pkt_lldp = pkt.get_protocol(lldp.lldp)
         if (_pkt_lldp):
@@ -240,112 +335,138 @@ class IdentityInspect(object):
             _chassis_id_text = addrconv.mac.bin_to_text(_chassis_id)
             _tlv_system_name = _pkt_lldp.tlvs[3]
             _system_name = _tlv_system_name.tlv_info
-            _table_ref = self._get_sys_ref_by_chassisid(_chassis_id_text)
-            if _table_ref:
-                #*** Update the last seen timestamp on the System table entry:
-                self._sys_identity_table[_table_ref]['time_last'] = time.time()
-            else:
-                #*** Add a new record to the System table:
-                self._set_sys_record_new_chassisid(_chassis_id_text, 
-                                               _system_name, pkt, dpid, inport)
+            return (_chassis_id_text, _system_name)
         else:
             self.logger.warning("Passed an LLDP packet that did not parse "
                                        "properly")
             return(0)
 
-    def dhcp_in(self, mac, ip, hostname, ctx):
+    def lldp_in(self, chassis_id_text, system_name, eth_src, ip4_src, dpid,
+                                                                    inport):
         """
-        Passed a MAC address, IP address, DHCP host name
-        (from option 12), and a context
-        and add to relevant metadata
+        Passed an LLDP Chassis ID in text format and system name, the
+        source MAC and IPv4 (or None) addresses of the LLDP packet, a
+        Data Path ID (dpid) and in port and update identity tables
+        (if required) with this identity information
         """
-        #*** TBD - add lease time and ensure that request was properly acked
+        _table_ref = self._get_sys_ref_by_chassisid(chassis_id_text)
+        if _table_ref:
+            #*** Update the last seen timestamp on the System table entry:
+            self._sys_identity_table[_table_ref]['time_last'] = time.time()
+        else:
+            #*** Add a new record to the System table:
+            self._set_sys_record_new_chassisid(chassis_id_text, 
+                                  system_name, eth_src, ip4_src, dpid, inport)
 
-        #*** If ip is 0.0.0.0 then just return, as not useful info:
-        if ip == '0.0.0.0':
+    def dhcp_request_in(self, mac, hostname):
+        """
+        Passed the client MAC address and host name (option 12) from a
+        DHCP REQUEST and hold the host name until the request is ACKed
+        """
+        if not hostname:
+            return
+        if len(self._dhcp_pending) >= IDENTITY_DHCP_PENDING_MAX:
+            self._dhcp_pending = {}
+        self._dhcp_pending[mac] = hostname
+
+    def dhcp_in(self, mac, ip, hostname, ctx, lease_time=None,
+                                                        last_seen=None):
+        """
+        Passed a MAC address, IP address, DHCP host name
+        (from option 12 of the ACK, or None to use the one from the
+        client's REQUEST), a context, the lease time in seconds (None
+        for a lease that does not expire) and optionally the time of
+        the ACK (defaults to now) and add to relevant metadata.
+        Entries expire when their lease does
+        """
+        if last_seen is None:
+            last_seen = time.time()
+        if not hostname:
+            hostname = self._dhcp_pending.pop(mac, None)
+        #*** If ip is 0.0.0.0 or no host name then just return, as not
+        #*** useful info:
+        if ip == '0.0.0.0' or not hostname:
             return
         #*** Add to the id_ip structure:
-        self.logger.debug("Adding dhcp hostname=%s ip=%s mac=%s ctx=%s to "
-                                "id_ip structure", 
-                                hostname, ip, mac, ctx)
+        self.logger.debug("Adding dhcp hostname=%s ip=%s mac=%s ctx=%s "
+                                "lease=%s to id_ip structure", 
+                                hostname, ip, mac, ctx, lease_time)
         #*** Make sure keys exist:
         self.id_ip.setdefault(ctx, {})
+        _new_ip = False
         if not ip in self.id_ip[ctx]:
             #*** IP not in table, add it:
             self.id_ip[ctx].setdefault(ip, {})
+            _new_ip = True
         #*** Ensure 'node' key exists:
-        self.id_ip[ctx][ip].setdefault('node', {})
-        #*** Default the hostname:
-        self.id_ip[ctx][ip]['node'].setdefault(hostname, {})
-        #*** Default the source key:
-        self.id_ip[ctx][ip]['node'][hostname].setdefault('source', 'dhcp')
+        ip_ctx_ip_node = self.id_ip[ctx][ip].setdefault('node', {})
+        #*** The lease is this host's now, so drop other host names:
+        for _hostname in list(ip_ctx_ip_node.keys()):
+            if _hostname != hostname:
+                del ip_ctx_ip_node[_hostname]
+        node = ip_ctx_ip_node.setdefault(hostname, {})
+        node['source'] = 'dhcp'
+        node['mac'] = mac
+        node['last_seen'] = last_seen
+        if lease_time:
+            node['lease'] = lease_time
+            self._schedule_expiry('dhcp', (ctx, ip, hostname),
+                                  last_seen + lease_time)
+        else:
+            node.pop('lease', None)
+        if self.journal:
+            self.journal(('dhcp', ctx, mac, ip, hostname, lease_time,
+                                                            last_seen))
+        if _new_ip:
+            self._notify_ip_change(ctx, ip)
 
     def dns_reply_in(self, queries, answers, ctx):
         """
         Passed a DNS parameters and a context
-        and add to relevant metadata
+        and add to relevant metadata.
+        Queries are a list of names and answers a list of
+        (name, type, ttl, value) tuples as parsed by
+        dns_experimental.DNS.parse_dns
         """
         #*** TBD: Need to add security to this... Checks are
         #*** needed to ensure that the answer is a response
         #*** to a query, and that the relevant fields match
         #*** to ensure response is not spoofed.
         for qname in queries:
-            self.logger.debug("dns_query=%s", qname.name)
-        for answer in answers:
-            if answer.type == 1:
-                #*** DNS A Record:
-                answer_ip = socket.inet_ntoa(answer.rdata)
-                answer_name = answer.name
-                answer_ttl = answer.ttl
+            self.logger.debug("dns_query=%s", qname)
+        for answer_name, answer_type, answer_ttl, answer_value in answers:
+            if answer_type == 1 or answer_type == 28:
+                #*** DNS A or AAAA Record:
+                answer_ip = answer_value
                 self.logger.debug("dns_answer_name=%s dns_answer_A=%s "
                                 "answer_ttl=%s", 
                                 answer_name, answer_ip, answer_ttl)
-                #*** Make sure context key exists:
-                self.id_ip.setdefault(ctx, {})
-                if not answer_ip in self.id_ip[ctx]:
-                    #*** IP not in table, add it:
-                    self.id_ip[ctx].setdefault(answer_ip, {})
-                #*** Ensure 'service' key exists:
-                self.id_ip[ctx][answer_ip].setdefault('service', {})
-                #*** Check if know mapping to service:
-                if not answer_name in self.id_ip[ctx][answer_ip]['service']:
-                    #*** Add service name to this IP:
-                    self.id_ip[ctx][answer_ip]['service'][answer_name] = {}
-                #*** Update time last seen and set source attribution:
-                svc = self.id_ip[ctx][answer_ip]['service'][answer_name]
-                svc['last_seen'] = time.time()
-                svc['ttl'] = answer_ttl
-                svc['source'] = 'dns'
                 #*** Check if service is a CNAME for another domain:
                 #*** Make sure context key exists:
                 self.id_service.setdefault(ctx, {})
                 if answer_name in self.id_service[ctx]:
+                    _source = 'dns_cname'
+                else:
+                    _source = 'dns'
+                #*** Update time last seen and set source attribution:
+                self._set_ip_service(ctx, answer_ip, answer_name,
+                                     answer_ttl, _source)
+                if _source == 'dns_cname':
                     #*** Add the original domain to the IP so that
                     #*** rules can be written for services without
                     #*** needing to understand CNAMES
-                    #*** Update the service that is the cname to ref this:
-                    svc['source'] = 'dns_cname'
                     #*** Could be multiple original domains for the cname:
                     odom_dict = self.id_service[ctx][answer_name]['domain']
                     for odom_value in odom_dict:
-                        ipsvcodom = self.id_ip[ctx][answer_ip]['service'] \
-                                                .setdefault(odom_value, {})
-                        ipsvcodom['last_seen'] = time.time()
-                        ipsvcodom['ttl'] = answer.ttl
-                        ipsvcodom['source'] = 'dns'
-            elif answer.type == 5:
+                        self._set_ip_service(ctx, answer_ip, odom_value,
+                                             answer_ttl, 'dns')
+            elif answer_type == 5:
                 #*** DNS CNAME Record:
-                answer_cname = answer.cname
-                answer_name = answer.name
+                answer_cname = answer_value
                 self.logger.debug("dns_answer_name=%s dns_answer_CNAME=%s", 
                                 answer_name, answer_cname)
-                svc_ctx = self.id_service.setdefault(ctx, {})
-                svc_cname = svc_ctx.setdefault(answer_cname, {})
-                svc_cname['type'] = 'dns_cname'
-                svc_cname_dom = svc_cname.setdefault('domain', {})
-                svc_cname_dom_a = svc_cname_dom.setdefault(answer.name, {})
-                svc_cname_dom_a['last_seen'] = time.time()
-                svc_cname_dom_a['ttl'] = answer.ttl
+                self._set_service_cname(ctx, answer_cname, answer_name,
+                                        answer_ttl)
             else:
                 #*** Not a type that we handle yet
                 pass
@@ -355,40 +476,20 @@ class IdentityInspect(object):
         Passed an IPv4 ARP reply MAC and IPv4 address and a context
         and add to relevant metadata
         """
-        #*** Make sure context key exists:
-        self.id_mac.setdefault(ctx, {})
-        if not arped_mac in self.id_mac[ctx]:
-            #*** MAC not in table, add it:
-            self.id_mac[ctx].setdefault(arped_mac, {})
-        #*** Ensure 'ip' key exists:
-        self.id_mac[ctx][arped_mac].setdefault('ip', {})
-        #*** Check if know mapping to IPv4 addr:
-        if not arped_ip in self.id_mac[ctx][arped_mac]['ip']:
-            #*** Add IP to this MAC:
-            self.id_mac[ctx][arped_mac]['ip'][arped_ip] = {}
-        #*** Update time last seen and set source attribution:
-        self.id_mac[ctx][arped_mac]['ip'][arped_ip]['last_seen'] = time.time()
-        self.id_mac[ctx][arped_mac]['ip'][arped_ip]['source'] = 'arp'
+        self._set_mac_ip(ctx, arped_mac, arped_ip)
 
-    def ip4_in(self, pkt):
+    def ip4_in(self, eth_src, ip4_src):
         """
-        Passed an IPv4 packet
+        Passed the source MAC and IPv4 addresses of an IPv4 packet
         and update NIC identity table (if required) with the IPv4
         address if the MAC address matches an entry
         """
-        pkt_eth = pkt.get_protocol(ethernet.ethernet)
-        pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
-        if pkt_ip4:
-            #*** Get the NIC identity table reference for the source
-            #*** MAC address (if it exists):
-            _nic_table_ref = self._get_nic_ref_by_MAC(pkt_eth.src)
-            if _nic_table_ref:
-                #*** Write the IP address to this table row:
-                self._set_nic_record_add_IP4_addr(_nic_table_ref, pkt_ip4.src)
-        else:
-            self.logger.warning("Passed an IPv4 packet that did not parse"
-                                "properly")
-            return(0)
+        #*** Get the NIC identity table reference for the source
+        #*** MAC address (if it exists):
+        _nic_table_ref = self._get_nic_ref_by_MAC(eth_src)
+        if _nic_table_ref:
+            #*** Write the IP address to this table row:
+            self._set_nic_record_add_IP4_addr(_nic_table_ref, ip4_src)
 
     def get_identity_nic_table(self):
         """
@@ -402,39 +503,20 @@ class IdentityInspect(object):
         """
         return self._sys_identity_table
 
-    def get_augmented_fm_table(self, _flows):
-        """
-        Return the flow metadata table augmented with
-        appropriate identity metadata
-        """
-        _result_dict = {}
-        for idx in _flows:
-            flow = _flows[idx]
-            if 'ip_A' in flow:
-                ip = flow['ip_A']
-                #self.logger.debug("checking ip_A=%s", ip)
-                for ctx in self.id_ip:
-                    ip_ctx = self.id_ip[ctx]
-                    if ip:
-                        if ip in ip_ctx:
-                            ip_ctx_ip = ip_ctx[ip]
-                            #*** Found IP in id_ip, add any metadata to flow:
-                            if 'service' in ip_ctx_ip:
-                                flow['ip_A_services'] = ip_ctx_ip['service']
-            if 'ip_B' in flow:
-                ip = flow['ip_B']
-                #self.logger.debug("checking ip_B=%s", ip)
-                for ctx in self.id_ip:
-                    ip_ctx = self.id_ip[ctx]
-                    if ip:
-                        if ip in ip_ctx:
-                            ip_ctx_ip = ip_ctx[ip]
-                            #*** Found IP in id_ip, add any metadata to flow:
-                            if 'service' in ip_ctx_ip:
-                                flow['ip_B_services'] = ip_ctx_ip['service']
-            #*** Accumulate updated flows into results dict
-            _result_dict[idx] = flow
-        return _result_dict
+    def register_ip_change_callback(self, callback):
+        """
+        Register a function to be called with (ctx, ip) whenever
+        the id_ip record for an IP, or its services, are created or
+        deleted, so that holders of references can refresh them
+        """
+        self._ip_change_callbacks.append(callback)
+
+    def _notify_ip_change(self, ctx, ip):
+        """
+        Call the registered IP change callbacks for an IP
+        """
+        for callback in self._ip_change_callbacks:
+            callback(ctx, ip)
 
     def maintain_identity_tables(self):
         """
@@ -459,7 +541,7 @@ class IdentityInspect(object):
                     _for_deletion.append(_table_ref)
         #*** Now iterate over the list of references to delete:
         for _del_ref in _for_deletion:
-            del self._nic_identity_table[_del_ref]
+            self._del_nic_record(_del_ref)
         #*** Now do same for system identity table:
         _for_deletion = []
         for _table_ref in self._sys_identity_table:
@@ -473,75 +555,344 @@ class IdentityInspect(object):
                     _for_deletion.append(_table_ref)
         #*** Now iterate over the list of references to delete:
         for _del_ref in _for_deletion:
-            del self._sys_identity_table[_del_ref]
+            self._del_sys_record(_del_ref)
 
-        #*** Maintain the id_mac structure:
-        _for_deletion = []
-        self.logger.debug("Maintaining the id_mac structure")
-        for ctx in self.id_mac:
-            mac_ctx = self.id_mac[ctx]
-            for mac in mac_ctx:
-                mac_ctx_mac = mac_ctx[mac]
-                for ip in mac_ctx_mac['ip']:
-                    mac_ctx_mac_ip = mac_ctx_mac['ip'][ip]
-                    last_seen = mac_ctx_mac_ip['last_seen']
-                    #*** Has the ARP not been seen for more than max age?: 
-                    if (last_seen + self.arp_max) < _time:
-                        #*** Mark for deletion:
-                        del_dict = {'ctx': ctx, 'mac': mac, 'ip': ip}
-                        _for_deletion.append(del_dict)
-                        age = _time - last_seen
-                        self.logger.debug("marking ARP ip=%s mac=%s age=%s "
-                                     "seconds for deletion", ip, mac, age)
-        #*** Now iterate over the list of references to delete:
-        for _del_ref in _for_deletion:
-            ctx = _del_ref['ctx']
-            mac = _del_ref['mac']
-            ip = _del_ref['ip']
-            del self.id_mac[ctx][mac]['ip'][ip]
-            #*** TBD: check if that was the only IP for that MAC and if so
-            #*** delete the MAC:
-            if self.id_mac[ctx][mac]['ip'] == {}:
-                del self.id_mac[ctx][mac]['ip']
-                if self.id_mac[ctx][mac] == {}:
-                    del self.id_mac[ctx][mac]
-
-        #*** Maintain the id_ip structure:
-        _for_deletion = []
-        self.logger.debug("Maintaining the id_ip structure")
-        for ctx in self.id_ip:
-            ip_ctx = self.id_ip[ctx]
-            for ip in ip_ctx:
-                ip_ctx_ip = ip_ctx[ip]
-                if 'service' in ip_ctx_ip:
-                    for service in ip_ctx_ip['service']:
-                        ip_ctx_ip_svc = ip_ctx_ip['service'][service]
-                        self.logger.debug("service is %s", service)
-                        if ip_ctx_ip_svc['source'] == 'dns' or \
-                                        ip_ctx_ip_svc['source'] == 'dns_cname':
-                            self.logger.debug("source is dns or dns_cname")
-                            last_seen = ip_ctx_ip_svc['last_seen']
-                            ttl = ip_ctx_ip_svc['ttl']
-                            if (last_seen + ttl) < _time:
-                                #*** Mark for deletion:
-                                del_dict = {'ctx': ctx, 'ip': ip, 
-                                                 'service': service}
-                                _for_deletion.append(del_dict)
-                                self.logger.debug("marking IP del_dict=%s "
-                                     "for deletion", del_dict)
-        #*** Now iterate over the list of references to delete:
-        for _del_ref in _for_deletion:
-            ctx = _del_ref['ctx']
-            ip = _del_ref['ip']
-            service = _del_ref['service']
-            del self.id_ip[ctx][ip]['service'][service]
-            #*** also delete the IP address if no other services or other keys
-            #*** exist:
-            if self.id_ip[ctx][ip]['service'] == {}:
-                del self.id_ip[ctx][ip]['service']
-                if self.id_ip[ctx][ip] == {}:
-                    self.logger.debug("struct=id_ip deleting ip=%s", ip)
-                    del self.id_ip[ctx][ip]
+        #*** Expire ARP, DNS and CNAME entries whose deadlines have passed:
+        self._expire_deadlines(_time)
+
+    def _set_mac_ip(self, ctx, mac, ip, last_seen=None):
+        """
+        Passed a context, MAC address, IPv4 address and optionally the
+        time it was last seen (defaults to now) and record the ARP
+        learnt mapping in the id_mac structure
+        """
+        if last_seen is None:
+            last_seen = time.time()
+        #*** Make sure context, MAC and 'ip' keys exist:
+        mac_ctx_mac = self.id_mac.setdefault(ctx, {}).setdefault(mac, {})
+        mac_ip = mac_ctx_mac.setdefault('ip', {}).setdefault(ip, {})
+        #*** Update time last seen and set source attribution:
+        mac_ip['last_seen'] = last_seen
+        mac_ip['source'] = 'arp'
+        self._schedule_expiry('arp', (ctx, mac, ip), last_seen + self.arp_max)
+        if self.journal:
+            self.journal(('arp', ctx, mac, ip, last_seen))
+
+    def _set_service_cname(self, ctx, cname, domain, ttl, last_seen=None):
+        """
+        Passed a context, a CNAME, the domain that it is an alias for,
+        a TTL and optionally the time it was last seen (defaults to now)
+        and record the mapping in the id_service structure
+        """
+        if last_seen is None:
+            last_seen = time.time()
+        svc_cname = self.id_service.setdefault(ctx, {}).setdefault(cname, {})
+        svc_cname['type'] = 'dns_cname'
+        svc_cname_dom = svc_cname.setdefault('domain', {})
+        svc_cname_dom_a = svc_cname_dom.setdefault(domain, {})
+        svc_cname_dom_a['last_seen'] = last_seen
+        svc_cname_dom_a['ttl'] = ttl
+        self._schedule_expiry('cname', (ctx, cname, domain), last_seen + ttl)
+        if self.journal:
+            self.journal(('cname', ctx, cname, domain, ttl, last_seen))
+
+    def _set_ip_service(self, ctx, ip, service, ttl, source, last_seen=None):
+        """
+        Passed a context, IP address, service name, TTL, source and
+        optionally the time it was last seen (defaults to now) and
+        record the service against the IP in the id_ip structure and
+        the service trie. Return the id_ip service record
+        """
+        if last_seen is None:
+            last_seen = time.time()
+        #*** Make sure context, IP and 'service' keys exist:
+        ip_ctx_ip = self.id_ip.setdefault(ctx, {}).setdefault(ip, {})
+        _new_services = not 'service' in ip_ctx_ip
+        svc = ip_ctx_ip.setdefault('service', {}).setdefault(service, {})
+        #*** Update time last seen and set source attribution:
+        svc['last_seen'] = last_seen
+        svc['ttl'] = ttl
+        svc['source'] = source
+        if self.journal:
+            self.journal(('dns', ctx, ip, service, ttl, source, last_seen))
+        self._service_trie_insert(ctx, service, ip, svc['last_seen'] + ttl)
+        self.id_service_ips.setdefault(ctx, {}).setdefault(service, {})[ip] = \
+                                                      svc['last_seen'] + ttl
+        if _new_services:
+            self._notify_ip_change(ctx, ip)
+        self._schedule_expiry('dns', (ctx, ip, service),
+                              svc['last_seen'] + ttl)
+        return svc
+
+    def get_snapshot_records(self):
+        """
+        Generator of records that describe the current identity state,
+        in the same form as journal records, for persistence. Iterates
+        over copies of keys so identity can keep being updated between
+        records (which the journal also captures)
+        """
+        for ctx in list(self.id_mac.keys()):
+            for mac, mac_ctx_mac in list(self.id_mac.get(ctx, {}).items()):
+                for ip, mac_ip in list(mac_ctx_mac.get('ip', {}).items()):
+                    yield ('arp', ctx, mac, ip, mac_ip['last_seen'])
+        for ctx in list(self.id_service.keys()):
+            for cname, svc_cname in \
+                               list(self.id_service.get(ctx, {}).items()):
+                for domain, dom in list(svc_cname.get('domain', {}).items()):
+                    yield ('cname', ctx, cname, domain, dom['ttl'],
+                                                        dom['last_seen'])
+        for ctx in list(self.id_ip.keys()):
+            for ip, ip_ctx_ip in list(self.id_ip.get(ctx, {}).items()):
+                for hostname, node in list(ip_ctx_ip.get('node', {}).items()):
+                    yield ('dhcp', ctx, node.get('mac'), ip, hostname,
+                                    node.get('lease'), node.get('last_seen'))
+                for service, svc in \
+                                 list(ip_ctx_ip.get('service', {}).items()):
+                    yield ('dns', ctx, ip, service, svc['ttl'],
+                                        svc['source'], svc['last_seen'])
+        for nic_ref in list(self._nic_identity_table.keys()):
+            yield ('nic', nic_ref, dict(self._nic_identity_table[nic_ref]))
+        for sys_ref in list(self._sys_identity_table.keys()):
+            yield ('sys', sys_ref, dict(self._sys_identity_table[sys_ref]))
+
+    def apply_record(self, record, _time):
+        """
+        Passed a persisted identity record and the current time and
+        apply the record to identity state, unless it has expired.
+        Return True if applied, otherwise False
+        """
+        kind = record[0]
+        if kind == 'arp':
+            ctx, mac, ip, last_seen = record[1:]
+            if last_seen + self.arp_max < _time:
+                return False
+            self._set_mac_ip(ctx, mac, ip, last_seen)
+        elif kind == 'cname':
+            ctx, cname, domain, ttl, last_seen = record[1:]
+            if last_seen + ttl < _time:
+                return False
+            self._set_service_cname(ctx, cname, domain, ttl, last_seen)
+        elif kind == 'dns':
+            ctx, ip, service, ttl, source, last_seen = record[1:]
+            if last_seen + ttl < _time:
+                return False
+            self._set_ip_service(ctx, ip, service, ttl, source, last_seen)
+        elif kind == 'dhcp':
+            ctx, mac, ip, hostname, lease_time, last_seen = record[1:]
+            if lease_time and last_seen + lease_time < _time:
+                return False
+            self.dhcp_in(mac, ip, hostname, ctx, lease_time, last_seen)
+        elif kind == 'nic':
+            nic_ref, nic_record = record[1:]
+            if _time - nic_record.get('time_last', 0) > self.max_age_nic:
+                return False
+            self._nic_identity_table[nic_ref].update(nic_record)
+            self._nic_ref_by_mac.setdefault(nic_record.get('mac_addr'),
+                                            nic_ref)
+            self._nic_id_ref = max(self._nic_id_ref, nic_ref + 1)
+        elif kind == 'sys':
+            sys_ref, sys_record = record[1:]
+            if _time - sys_record.get('time_last', 0) > self.max_age_sys:
+                return False
+            self._sys_identity_table[sys_ref].update(sys_record)
+            self._sys_ref_by_chassisid.setdefault(
+                                   sys_record.get('chassis_id'), sys_ref)
+            self._sys_refs_by_systemname.setdefault(
+                          sys_record.get('system_name'), set()).add(sys_ref)
+            self._sys_ref_by_systemname_re = {}
+            self._sys_id_ref = max(self._sys_id_ref, sys_ref + 1)
+        else:
+            self.logger.warning("Unknown identity record kind=%s", kind)
+            return False
+        return True
+
+    def _schedule_expiry(self, kind, key, deadline):
+        """
+        Passed a kind of entry ('arp', 'dns', 'cname' or 'dhcp'), its key and
+        expiry deadline and make sure the expiry heap will look at it by
+        that deadline. Refreshes that push the deadline later don't touch
+        the heap as the pending entry is rechecked when it comes due
+        """
+        _pending = self._expiry_pending.get((kind, key))
+        if _pending is None or deadline < _pending:
+            self._expiry_pending[(kind, key)] = deadline
+            heapq.heappush(self._expiry_heap, (deadline, kind, key))
+
+    def _expiry_deadline(self, kind, key):
+        """
+        Return the current expiry deadline of an entry or None if the
+        entry no longer exists
+        """
+        try:
+            if kind == 'arp':
+                ctx, mac, ip = key
+                return self.id_mac[ctx][mac]['ip'][ip]['last_seen'] + \
+                                                                self.arp_max
+            elif kind == 'dns':
+                ctx, ip, service = key
+                svc = self.id_ip[ctx][ip]['service'][service]
+                if svc['source'] == 'dns' or svc['source'] == 'dns_cname':
+                    return svc['last_seen'] + svc['ttl']
+                return None
+            elif kind == 'cname':
+                ctx, cname, domain = key
+                dom = self.id_service[ctx][cname]['domain'][domain]
+                return dom['last_seen'] + dom['ttl']
+            elif kind == 'dhcp':
+                ctx, ip, hostname = key
+                node = self.id_ip[ctx][ip]['node'][hostname]
+                if 'lease' in node:
+                    return node['last_seen'] + node['lease']
+                return None
+        except KeyError:
+            return None
+        return None
+
+    def _expire_deadlines(self, _time):
+        """
+        Pop entries off the expiry heap that are due by the passed time
+        and delete those that have not been refreshed since they were
+        scheduled. Refreshed entries are rescheduled at their new
+        deadline. Cost is proportional to the entries that come due
+        """
+        _heap = self._expiry_heap
+        while _heap and _heap[0][0] < _time:
+            deadline, kind, key = heapq.heappop(_heap)
+            if self._expiry_pending.get((kind, key)) != deadline:
+                #*** Superseded by an earlier deadline that was pushed later:
+                continue
+            del self._expiry_pending[(kind, key)]
+            _deadline = self._expiry_deadline(kind, key)
+            if _deadline is None:
+                #*** Entry has already gone:
+                continue
+            if _deadline >= _time:
+                #*** Entry was refreshed, so look at it again later:
+                self._schedule_expiry(kind, key, _deadline)
+                continue
+            self.logger.debug("event=expire kind=%s key=%s age=%s", kind,
+                              key, _time - _deadline)
+            if kind == 'arp':
+                self._del_id_mac_ip(*key)
+            elif kind == 'dns':
+                self._del_id_ip_service(*key)
+            elif kind == 'cname':
+                self._del_id_service_domain(*key)
+            elif kind == 'dhcp':
+                self._del_id_ip_node(*key)
+
+    def _del_id_mac_ip(self, ctx, mac, ip):
+        """
+        Delete an ARP learnt IP from a MAC in the id_mac structure and
+        the MAC too if nothing else is left for it
+        """
+        del self.id_mac[ctx][mac]['ip'][ip]
+        if self.id_mac[ctx][mac]['ip'] == {}:
+            del self.id_mac[ctx][mac]['ip']
+            if self.id_mac[ctx][mac] == {}:
+                del self.id_mac[ctx][mac]
+
+    def _del_id_ip_service(self, ctx, ip, service):
+        """
+        Delete a service from an IP in the id_ip structure and the
+        service trie, and the IP too if nothing else is left for it
+        """
+        del self.id_ip[ctx][ip]['service'][service]
+        self._service_trie_remove(ctx, service, ip)
+        _service_ips = self.id_service_ips[ctx][service]
+        del _service_ips[ip]
+        if not _service_ips:
+            del self.id_service_ips[ctx][service]
+        if self.id_ip[ctx][ip]['service'] == {}:
+            del self.id_ip[ctx][ip]['service']
+            if self.id_ip[ctx][ip] == {}:
+                self.logger.debug("struct=id_ip deleting ip=%s", ip)
+                del self.id_ip[ctx][ip]
+            self._notify_ip_change(ctx, ip)
+
+    def _del_id_ip_node(self, ctx, ip, hostname):
+        """
+        Delete a DHCP host name from an IP in the id_ip structure, and
+        the IP too if nothing else is left for it
+        """
+        del self.id_ip[ctx][ip]['node'][hostname]
+        if self.id_ip[ctx][ip]['node'] == {}:
+            del self.id_ip[ctx][ip]['node']
+            if self.id_ip[ctx][ip] == {}:
+                self.logger.debug("struct=id_ip deleting ip=%s", ip)
+                del self.id_ip[ctx][ip]
+            self._notify_ip_change(ctx, ip)
+
+    def _del_id_service_domain(self, ctx, cname, domain):
+        """
+        Delete an original domain from a CNAME in the id_service
+        structure and the CNAME too if it has no domains left
+        """
+        del self.id_service[ctx][cname]['domain'][domain]
+        if self.id_service[ctx][cname]['domain'] == {}:
+            del self.id_service[ctx][cname]
+
+    def _service_trie_insert(self, ctx, service, ip, deadline):
+        """
+        Insert a service name for an IP into the context's service trie.
+        The IP and deadline are recorded on every node along the path
+        of reversed labels, so a node knows all IPs under its domain
+        """
+        _node = self.id_service_trie.setdefault(ctx, {'labels': {},
+                                                      'ips': {}})
+        for _label in _dns_labels(service):
+            _node = _node['labels'].setdefault(_label, {'labels': {},
+                                                        'ips': {}})
+            _node['ips'].setdefault(ip, {})[service] = deadline
+
+    def _service_trie_remove(self, ctx, service, ip):
+        """
+        Remove a service name for an IP from the context's service trie,
+        pruning nodes that no longer hold anything
+        """
+        _node = self.id_service_trie.get(ctx)
+        if not _node:
+            return
+        _path = []
+        for _label in _dns_labels(service):
+            if _label not in _node['labels']:
+                return
+            _path.append((_node, _label))
+            _node = _node['labels'][_label]
+            _services = _node['ips'].get(ip)
+            if _services:
+                _services.pop(service, None)
+                if not _services:
+                    del _node['ips'][ip]
+        #*** Prune empty nodes from the bottom up:
+        for _parent, _label in reversed(_path):
+            _child = _parent['labels'][_label]
+            if _child['ips'] or _child['labels']:
+                break
+            del _parent['labels'][_label]
+
+    def _service_trie_match(self, ctx, domain, ip):
+        """
+        Passed a context, a domain and an IP address and return True
+        if the IP has a current service that is the domain or a
+        subdomain of it, otherwise False. Cost is proportional to the
+        number of labels in the domain
+        """
+        _node = self.id_service_trie.get(ctx)
+        if not _node:
+            return False
+        for _label in _dns_labels(domain):
+            _node = _node['labels'].get(_label)
+            if not _node:
+                return False
+        _services = _node['ips'].get(ip)
+        if not _services:
+            return False
+        _time = time.time()
+        for _deadline in _services.values():
+            if _deadline > _time:
+                return True
+        return False
 
     def _get_sys_ref_by_chassisid(self, chassis_id_text):
         """
@@ -550,11 +901,7 @@ class IdentityInspect(object):
         If it does, return the table reference otherwise
         return 0
         """
-        for table_ref in self._sys_identity_table:
-            if (chassis_id_text == self._sys_identity_table[table_ref] \
-                                ['chassis_id']):
-                return(table_ref)
-        return(0)
+        return self._sys_ref_by_chassisid.get(chassis_id_text, 0)
         
     def _get_sys_ref_by_systemname(self, policy_attr, systemname):
         """
@@ -564,17 +911,23 @@ class IdentityInspect(object):
         return 0
         """
         if policy_attr == 'identity_lldp_systemname': 
-            for table_ref in self._sys_identity_table:
-                if (systemname == self._sys_identity_table[table_ref] \
-                                            ['system_name']):
-                    return(table_ref)
+            _sys_refs = self._sys_refs_by_systemname.get(systemname)
+            if _sys_refs:
+                #*** Oldest record wins if several systems share a name:
+                return(min(_sys_refs))
             return(0)
         elif policy_attr == 'identity_lldp_systemname_re':
+            #*** Answer is memoised until the system table changes:
+            if systemname in self._sys_ref_by_systemname_re:
+                return self._sys_ref_by_systemname_re[systemname]
+            _result = 0
             for table_ref in self._sys_identity_table:
-                if (re.match(systemname, self._sys_identity_table[table_ref] \
-                                            ['system_name'])):
-                    return(table_ref)
-            return(0)
+                if self._regex_match(systemname,
+                           self._sys_identity_table[table_ref]['system_name']):
+                    _result = table_ref
+                    break
+            self._sys_ref_by_systemname_re[systemname] = _result
+            return(_result)
         else:
             return(0)           
         
@@ -585,11 +938,7 @@ class IdentityInspect(object):
         Check if the MAC address is recorded in the
         table and if so, return the table reference.
         """       
-        for table_ref in self._nic_identity_table:
-            if (mac_addr == self._nic_identity_table[table_ref]['mac_addr']):
-                self.logger.debug("Matched on nic table_ref id=%s", table_ref)
-                return(table_ref)
-        return(0)
+        return self._nic_ref_by_mac.get(mac_addr, 0)
 
     def _get_nic_MAC_addr(self, table_ref):
         """
@@ -617,23 +966,23 @@ class IdentityInspect(object):
         result = self._sys_identity_table[sys_ref]['nic_table_ref']
         return(result)
         
-    def _set_sys_record_new_chassisid(self, chassis_id_text, system_name, pkt, 
-                                                      dpid, inport):
+    def _set_sys_record_new_chassisid(self, chassis_id_text, system_name,
+                                      eth_src, ip4_src, dpid, inport):
         """
         Record a new system identity into the system identity table.
         Passed an LLDP Chassis ID in text format, an LLDP system name,
-        a packet, a Data Path ID (dpid)
+        the packet source MAC and IPv4 (or None) addresses, a Data
+        Path ID (dpid)
         and in port and write a row describing this identity into the
         system identity table. Check the NIC identity table and update
         this too if required.
         """
-        eth = pkt.get_protocol(ethernet.ethernet)
-        pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
         #*** Check to see if a NIC identity table record exists
         #*** and if not create one:
-        _nic_table_ref = self._get_nic_ref_by_MAC(eth.src)
+        _nic_table_ref = self._get_nic_ref_by_MAC(eth_src)
         if not _nic_table_ref:
-            _nic_table_ref = self._set_nic_record_new(pkt, dpid, inport)
+            _nic_table_ref = self._set_nic_record_new(eth_src, ip4_src, dpid,
+                                                      inport)
         #*** Write a new row into the system identity table:
         self._sys_identity_table[self._sys_id_ref] = \
             {
@@ -643,6 +992,12 @@ class IdentityInspect(object):
             'time_first' : time.time(),
             'time_last' : time.time()
         }         
+        #*** Index the new row:
+        self._sys_ref_by_systemname_re = {}
+        self._sys_ref_by_chassisid.setdefault(chassis_id_text,
+                                              self._sys_id_ref)
+        self._sys_refs_by_systemname.setdefault(system_name, set()). \
+                                                    add(self._sys_id_ref)
         #*** Update the NIC table ref with a reference back to the system 
         #*** identity table:
         self._set_nic_record_add_sys_ref(_nic_table_ref, self._sys_id_ref)
@@ -652,18 +1007,17 @@ class IdentityInspect(object):
         #*** increment table ref:
         self._sys_id_ref += 1
         
-    def _set_nic_record_new(self, pkt, dpid, inport):
+    def _set_nic_record_new(self, eth_src, ip4_src, dpid, inport):
         """
-        Create a new NIC identity record and return
-        the table reference
+        Passed a source MAC and IPv4 (or None) address, a Data Path
+        ID (dpid) and in port, create a new NIC identity record and
+        return the table reference
         """
-        eth = pkt.get_protocol(ethernet.ethernet)
-        pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
         #*** add the source MAC address:
-        self._nic_identity_table[self._nic_id_ref]['mac_addr'] = eth.src
+        self._nic_identity_table[self._nic_id_ref]['mac_addr'] = eth_src
         #*** add the source IP (if we have one):
-        if (pkt_ip4):
-            self._nic_identity_table[self._nic_id_ref]['ip4_addr'] =  pkt_ip4.src
+        if (ip4_src):
+            self._nic_identity_table[self._nic_id_ref]['ip4_addr'] = ip4_src
         #*** add details about the switch port:
         self._nic_identity_table[self._nic_id_ref]['dpid'] = dpid
         self._nic_identity_table[self._nic_id_ref]['inport'] = inport
@@ -672,6 +1026,8 @@ class IdentityInspect(object):
         self._nic_identity_table[self._nic_id_ref]['time_last'] = time.time()
         #*** record table ref:
         table_ref = self._nic_id_ref
+        #*** Index the new row:
+        self._nic_ref_by_mac.setdefault(eth_src, table_ref)
         self.logger.debug("Adding new NIC identity table entry: %s ref: %s",
                           self._nic_identity_table[table_ref], table_ref)        
         #*** increment table ref:
@@ -700,3 +1056,37 @@ class IdentityInspect(object):
         #*** Update timestamp:
         self._nic_identity_table[nic_ref]['time_last'] = time.time()       
 
+    def _del_sys_record(self, sys_ref):
+        """
+        Delete a system identity record and remove it from the
+        system identity table indexes
+        """
+        _record = self._sys_identity_table[sys_ref]
+        _chassis_id = _record.get('chassis_id')
+        if self._sys_ref_by_chassisid.get(_chassis_id) == sys_ref:
+            del self._sys_ref_by_chassisid[_chassis_id]
+        _system_name = _record.get('system_name')
+        _sys_refs = self._sys_refs_by_systemname.get(_system_name)
+        if _sys_refs:
+            _sys_refs.discard(sys_ref)
+            if not _sys_refs:
+                del self._sys_refs_by_systemname[_system_name]
+        self._sys_ref_by_systemname_re = {}
+        del self._sys_identity_table[sys_ref]
+
+    def _del_nic_record(self, nic_ref):
+        """
+        Delete a NIC identity record and remove it from the
+        NIC identity table index
+        """
+        _mac_addr = self._nic_identity_table[nic_ref].get('mac_addr')
+        if self._nic_ref_by_mac.get(_mac_addr) == nic_ref:
+            del self._nic_ref_by_mac[_mac_addr]
+        del self._nic_identity_table[nic_ref]
+
+def _dns_labels(name):
+    """
+    Passed a DNS name and return its labels in reverse order (top level
+    domain first), lower case and ignoring leading and trailing dots
+    """
+    return name.lower().strip('.').split('.')[::-1]
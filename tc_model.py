@@ -0,0 +1,302 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#*** nmeta - Network Metadata - TC Trained Model Classification Class
+#***                                 and Methods
+
+"""
+This module is part of the nmeta suite running on top of Ryu SDN controller
+to provide network identity and flow (traffic classification) metadata.
+It scores flow feature vectors against decision tree or logistic
+regression models that have been trained offline, in vectorised batches
+with NumPy.
+"""
+
+import logging
+import logging.handlers
+import sys
+import os
+import json
+
+#*** NumPy is only needed when a model is loaded:
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#*** nmeta imports:
+import tc_features
+
+#*** Types of model that can be loaded:
+MODEL_TYPES = ('tree', 'logistic')
+
+class ModelClassify(object):
+    """
+    This class is instantiated by tc_statistical.py and provides methods
+    to load a trained model from a JSON file and to classify a batch of
+    flow feature vectors with it.
+    .
+    Models are JSON objects with keys:
+      type: 'tree' or 'logistic'
+      features: names of the features in the vector (see
+                tc_features.FEATURES)
+      actions: list of the actions for each class (i.e.
+               {"set_qos_tag": "QoS_treatment=low_priority"})
+    Tree models also have key 'nodes' with equal length lists 'feature',
+    'threshold', 'left', 'right' and 'class'. Node 0 is the root, and
+    leaf nodes have a feature of -1. A vector goes left if its feature
+    value is less than or equal to the threshold.
+    Logistic models also have keys 'weights', 'bias' and (optional)
+    'threshold' (default 0.5). A probability at or over the threshold
+    is class 1, otherwise class 0.
+    .
+    A loaded model is replaced with a single assignment so that a batch
+    being scored, which takes its own reference, never sees a mix of two
+    models
+    """
+    def __init__(self, _config):
+        #*** Get logging config values from config class:
+        _logging_level_s = _config.get_value \
+                                    ('tc_model_logging_level_s')
+        _logging_level_c = _config.get_value \
+                                    ('tc_model_logging_level_c')
+        _syslog_enabled = _config.get_value('syslog_enabled')
+        _loghost = _config.get_value('loghost')
+        _logport = _config.get_value('logport')
+        _logfacility = _config.get_value('logfacility')
+        _syslog_format = _config.get_value('syslog_format')
+        _console_log_enabled = _config.get_value('console_log_enabled')
+        _console_format = _config.get_value('console_format')
+        #*** Set up Logging:
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        #*** Syslog:
+        if _syslog_enabled:
+            #*** Log to syslog on host specified in config.yaml:
+            self.syslog_handler = logging.handlers.SysLogHandler(address=(
+                                                _loghost, _logport),
+                                                facility=_logfacility)
+            syslog_formatter = logging.Formatter(_syslog_format)
+            self.syslog_handler.setFormatter(syslog_formatter)
+            self.syslog_handler.setLevel(_logging_level_s)
+            #*** Add syslog log handler to logger:
+            self.logger.addHandler(self.syslog_handler)
+        #*** Console logging:
+        if _console_log_enabled:
+            #*** Log to the console:
+            self.console_handler = logging.StreamHandler()
+            console_formatter = logging.Formatter(_console_format)
+            self.console_handler.setFormatter(console_formatter)
+            self.console_handler.setLevel(_logging_level_c)
+            #*** Add console log handler to logger:
+            self.logger.addHandler(self.console_handler)
+
+        #*** Model file from config, relative to the nmeta directory, or
+        #*** '' for no model:
+        self.model_file = _config.get_value('statistical_model_file')
+        if self.model_file:
+            self.model_file = os.path.join(os.path.dirname(__file__),
+                                           self.model_file)
+        #*** The compiled model currently in use, or None:
+        self.model = None
+        self.stats = {'loads': 0, 'load_errors': 0, 'batches': 0,
+                      'flows': 0}
+        if self.model_file:
+            self.load_model(self.model_file)
+
+    def load_model(self, model_file=None):
+        """
+        Load a model from a JSON file (default is the file it was last
+        loaded from) and, if it is good, swap it in for the model in use.
+        Return 1 if loaded, otherwise log the error, keep the model in
+        use and return 0
+        """
+        if model_file is None:
+            model_file = self.model_file
+        try:
+            with open(model_file, 'r') as _file:
+                _spec = json.load(_file)
+            _model = self._compile_model(_spec)
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self.logger.error("Failed to load model file=%s "
+                            "Exception %s, %s, %s", model_file,
+                             exc_type, exc_value, exc_traceback)
+            self.stats['load_errors'] += 1
+            return 0
+        _model['file'] = model_file
+        self.model_file = model_file
+        #*** Atomic swap:
+        self.model = _model
+        self.stats['loads'] += 1
+        self.logger.info("event=model_loaded file=%s type=%s features=%s "
+                         "classes=%s", model_file, _model['type'],
+                         _model['features'], len(_model['actions']))
+        return 1
+
+    def classify(self, vectors, model=None):
+        """
+        Passed a list of flow feature vectors (lists of floats in the
+        order of the model features) and (optional) the model to use
+        (default is the model in use) and return a list of the actions
+        of the class of each vector
+        """
+        if model is None:
+            model = self.model
+        if not vectors:
+            return []
+        self.stats['batches'] += 1
+        self.stats['flows'] += len(vectors)
+        return classify_vectors(model, vectors)
+
+    def get_model_info(self):
+        """
+        Return a dictionary describing the model in use and loading
+        statistics
+        """
+        _model = self.model
+        _info = dict(self.stats)
+        if _model:
+            _info['file'] = _model['file']
+            _info['type'] = _model['type']
+            _info['features'] = _model['features']
+            _info['actions'] = _model['actions']
+        else:
+            _info['file'] = self.model_file
+            _info['type'] = None
+        return _info
+
+    def _compile_model(self, spec):
+        """
+        Passed a model specification (as loaded from JSON), check it and
+        return it compiled to NumPy arrays. Raises ValueError if it is
+        not a valid model
+        """
+        if np is None:
+            raise ValueError("NumPy is needed to use trained models")
+        _type = spec.get('type')
+        if not _type in MODEL_TYPES:
+            raise ValueError("Unknown model type %s" % _type)
+        _features = spec.get('features')
+        if not _features:
+            raise ValueError("Model has no features")
+        for _name in _features:
+            if not _name in tc_features.FEATURES:
+                raise ValueError("Unknown feature %s" % _name)
+        _actions = spec.get('actions')
+        if not _actions or not all(isinstance(_action, dict)
+                                                for _action in _actions):
+            raise ValueError("Model actions must be a list of dictionaries")
+        _model = {'type': _type,
+                  'features': [str(_name) for _name in _features],
+                  'actions': _actions}
+        if _type == 'tree':
+            _nodes = spec.get('nodes', {})
+            for _key in ('feature', 'left', 'right', 'class'):
+                _model[_key] = np.asarray(_nodes.get(_key, []),
+                                          dtype=np.intp)
+            _model['threshold'] = np.asarray(_nodes.get('threshold', []),
+                                             dtype=np.float64)
+            _model['depth'] = self._tree_depth(_model, len(_features),
+                                               len(_actions))
+        else:
+            _model['weights'] = np.asarray(spec.get('weights', []),
+                                           dtype=np.float64)
+            if len(_model['weights']) != len(_features):
+                raise ValueError("Model needs one weight per feature")
+            if len(_actions) != 2:
+                raise ValueError("Logistic models have two classes")
+            _model['bias'] = float(spec.get('bias', 0))
+            _model['threshold'] = float(spec.get('threshold', 0.5))
+        return _model
+
+    def _tree_depth(self, model, features, classes):
+        """
+        Passed compiled tree node arrays, the number of features and the
+        number of classes. Check that the nodes form a tree from the root
+        and return its depth. Raises ValueError if they don't
+        """
+        _nodes = len(model['feature'])
+        if not _nodes:
+            raise ValueError("Tree has no nodes")
+        for _key in ('threshold', 'left', 'right', 'class'):
+            if len(model[_key]) != _nodes:
+                raise ValueError("Tree node lists differ in length")
+        _depth = 0
+        _seen = set()
+        _level = [0]
+        while _level:
+            _next_level = []
+            for _node in _level:
+                if _node in _seen:
+                    raise ValueError("Tree node %s reached twice" % _node)
+                _seen.add(_node)
+                if model['feature'][_node] < 0:
+                    if not 0 <= model['class'][_node] < classes:
+                        raise ValueError("Tree leaf %s has no action" %
+                                                                    _node)
+                    continue
+                if model['feature'][_node] >= features:
+                    raise ValueError("Tree node %s feature out of range" %
+                                                                    _node)
+                for _child in (model['left'][_node], model['right'][_node]):
+                    if not 0 <= _child < _nodes:
+                        raise ValueError("Tree node %s child out of range" %
+                                                                    _node)
+                    _next_level.append(int(_child))
+            if _next_level:
+                _depth += 1
+            _level = _next_level
+        return _depth
+
+def classify_vectors(model, vectors):
+    """
+    Passed a compiled model and a list of flow feature vectors and
+    return a list of the actions of the class of each vector. A module
+    function so that it can be run in a worker process (see tc_async.py)
+    """
+    _vectors = np.asarray(vectors, dtype=np.float64)
+    if model['type'] == 'tree':
+        _classes = _classify_tree(model, _vectors)
+    else:
+        _classes = _classify_logistic(model, _vectors)
+    return [model['actions'][_class] for _class in _classes.tolist()]
+
+def _classify_tree(model, vectors):
+    """
+    Passed a compiled tree model and a 2D array of vectors and
+    return an array of class numbers. All vectors descend the tree
+    together one level per step
+    """
+    _rows = np.arange(len(vectors))
+    _node = np.zeros(len(vectors), dtype=np.intp)
+    for _ in xrange(model['depth']):
+        _feature = model['feature'][_node]
+        _leaf = _feature < 0
+        if _leaf.all():
+            break
+        _values = vectors[_rows, np.where(_leaf, 0, _feature)]
+        _next = np.where(_values <= model['threshold'][_node],
+                         model['left'][_node], model['right'][_node])
+        _node = np.where(_leaf, _node, _next)
+    return model['class'][_node]
+
+def _classify_logistic(model, vectors):
+    """
+    Passed a compiled logistic model and a 2D array of vectors and
+    return an array of class numbers
+    """
+    _z = vectors.dot(model['weights']) + model['bias']
+    _probability = 1.0 / (1.0 + np.exp(-_z))
+    return (_probability >= model['threshold']).astype(np.intp)
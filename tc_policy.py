@@ -27,6 +27,7 @@ import logging.handlers
 
 import sys
 import os
+import time
 
 #*** Packet-related imports:
 from ryu.lib.packet import ethernet
@@ -35,15 +36,16 @@ from ryu.lib.packet import ipv4
 from ryu.lib.packet import ipv6
 from ryu.lib.packet import udp
 from ryu.lib.packet import tcp
+from ryu.lib import hub
 
 #*** nmeta imports:
 import tc_static
 import tc_identity
+import dns_experimental
+import dhcp_scanner
 import tc_statistical
 import tc_payload
 
-#*** Import dpkt for DNS extraction, as not native to Ryu:
-import dpkt
 
 #*** YAML for config and policy file parsing:
 import yaml
@@ -66,8 +68,10 @@ TC_CONFIG_CONDITIONS = {'eth_src': 'MACAddress',
                                'identity_lldp_systemname_re': 'String',
                                'identity_service_dns': 'String',
                                'identity_service_dns_re': 'String',
+                               'identity_service_dns_suffix': 'String',
                                'payload_type': 'String',
                                'statistical_qos_bandwidth_1': 'String',
+                               'statistical_model': 'String',
                                'match_type': 'MatchType',
                                'conditions_list': 'PolicyConditions'}
 TC_CONFIG_ACTIONS = ('set_qos_tag',
@@ -76,6 +80,48 @@ TC_CONFIG_ACTIONS = ('set_qos_tag',
 TC_CONFIG_MATCH_TYPES = ('any',
                          'all',
                          'statistical')
+#*** Static cost class of each condition attribute, used to order the
+#*** evaluation of conditions within a stanza so that cheap checks run
+#*** first (lower is cheaper). Attributes not listed fall back to the cost
+#*** for their type prefix, see _condition_cost():
+TC_CONDITION_COST = {'eth_src': 1,
+                     'eth_dst': 1,
+                     'eth_type': 1,
+                     'tcp_src': 1,
+                     'tcp_dst': 1,
+                     'ip_src': 2,
+                     'ip_dst': 2,
+                     'identity_lldp_systemname': 3,
+                     'identity_service_dns': 3,
+                     'identity_service_dns_suffix': 3,
+                     'identity_lldp_systemname_re': 4,
+                     'identity_service_dns_re': 4,
+                     'conditions_list': 5,
+                     'payload_type': 6,
+                     'statistical_qos_bandwidth_1': 7,
+                     'statistical_model': 7}
+TC_CONDITION_TYPE_COST = {'identity': 4,
+                          'payload': 6,
+                          'statistical': 7}
+#*** Condition types that keep state about the packets that they see, so
+#*** must not have conditions moved from one side of them to the other:
+TC_STATEFUL_CONDITION_TYPES = ('payload',
+                               'statistical')
+#*** Minimum number of evaluations of a condition before its observed
+#*** selectivity is used to refine ordering within a cost class:
+TC_REORDER_MIN_EVALUATIONS = 100
+#*** Condition attributes that can be expressed directly as OpenFlow
+#*** matches and so compiled into static match boxes:
+TC_STATIC_CONDITIONS = ('eth_src',
+                        'eth_dst',
+                        'eth_type',
+                        'ip_src',
+                        'ip_dst',
+                        'tcp_src',
+                        'tcp_dst')
+#*** Flow entry priority above which proactive flow entries are installed.
+#*** Must be higher than the priority used for reactive flow entries:
+PROACTIVE_PRIORITY_BASE = 1000
 #*** Keys that must exist under 'identity' in the policy:
 IDENTITY_KEYS = ('arp',
                  'lldp',
@@ -149,12 +195,39 @@ class TrafficClassificationPolicy(object):
         #*** Instantiate Classes:
         self.static = tc_static.StaticInspect(_config)
         self.identity = tc_identity.IdentityInspect(_config)
+        self.dns_parser = dns_experimental.DNS(_config)
+        self.dhcp_parser = dhcp_scanner.DHCP(_config)
+        #*** Bounded queue of identity records harvested from packets,
+        #*** applied to identity by identity_worker. A maximum of 0
+        #*** applies them inline instead:
+        self.identity_queue_max = _config.get_value('identity_queue_max')
+        self.identity_queue = hub.Queue()
+        self._identity_queue_stats = {'enqueued': 0,
+                                      'dropped': 0,
+                                      'processed': 0,
+                                      'errors': 0,
+                                      'max_backlog': 0}
         self.payload = tc_payload.PayloadInspect(_config)
         self.statistical = tc_statistical.StatisticalInspect \
                                 (_config)
         #*** Run a test on the ingested traffic classification policy to ensure
         #*** that it is good:
         self.validate_policy()
+        #*** Drop provably unreachable rules from the runtime ruleset:
+        self.policy_prune_unreachable = _config.get_value \
+                                             ('policy_prune_unreachable')
+        #*** Per-rule and per-condition evaluation counters:
+        self.policy_stats_enabled = _config.get_value('policy_stats_enabled')
+        self.reset_policy_stats()
+        #*** Compile the order in which conditions in each stanza are
+        #*** evaluated, cheapest first:
+        self._stanza_order = {}
+        self.compile_condition_order()
+        #*** Compile identity regexes once rather than on every packet:
+        self.compile_identity_regexes()
+        #*** Compile rules that only use static conditions into match boxes
+        #*** and proactive flow entries:
+        self.compile_static_rules()
 
     def validate_policy(self):
         """
@@ -360,13 +433,20 @@ class TrafficClassificationPolicy(object):
             #*** and if so pass to the identity module to process:
             pkt_eth = pkt.get_protocol(ethernet.ethernet)
             if pkt_eth.ethertype == 35020:
-                self.identity.lldp_in(pkt, dpid, inport)
+                _lldp = self.identity.lldp_extract(pkt)
+                if _lldp:
+                    pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
+                    self._identity_in(('lldp_in', _lldp[0], _lldp[1],
+                                       pkt_eth.src,
+                                       pkt_ip4.src if pkt_ip4 else None,
+                                       dpid, inport))
         #*** Check to see if it is an IPv4 packet
         #*** and if so pass to the identity module to process:
         pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
         pkt_ip6 = pkt.get_protocol(ipv6.ipv6)
         if pkt_ip4:
-            self.identity.ip4_in(pkt)
+            pkt_eth = pkt.get_protocol(ethernet.ethernet)
+            self._identity_in(('ip4_in', pkt_eth.src, pkt_ip4.src))
         #*** EXPERIMENTAL AND UNDER CONSTRUCTION...
         #*** context is future-proofing for when the system will support 
         #*** multiple contexts. For now just set to 'default':
@@ -382,79 +462,76 @@ class TrafficClassificationPolicy(object):
                 #*** It's an ARP, but is it a reply (opcode 2) for IPv4?:
                 if pkt_arp.opcode == 2 and pkt_arp.proto == 2048:
                     self.logger.debug("event=ARP reply arp=%s", pkt_arp)
-                    self.identity.arp_reply_in \
-                                (pkt_arp.src_ip, pkt_arp.src_mac, context)
+                    self._identity_in(('arp_reply_in', pkt_arp.src_ip,
+                                       pkt_arp.src_mac, context))
 
         if self._main_policy['identity']['dhcp'] == 1:
-            #*** Check to see if it is an IPv4 DHCP ACK
-            #***  and if so harvest the information:
-            #*** Use dpkt as Ryu library doesn't appear to work???
+            #*** Check to see if it is an IPv4 DHCP REQUEST or ACK
+            #***  and if so harvest the information. Only ACKs update
+            #***  identity, with the host name from the REQUEST if the
+            #***  ACK doesn't carry one:
             if pkt_udp:
                 if pkt_udp.src_port == 67 or pkt_udp.dst_port == 67:
-                    pkt_dhcp = 0
-                    #*** Use dpkt to parse UDP DNS data:
-                    try:
-                        pkt_dhcp = dpkt.dhcp.DHCP(pkt.protocols[-1])
-                    except:
-                        exc_type, exc_value, exc_traceback = sys.exc_info()
-                        self.logger.error("DHCP extraction failed "
-                            "Exception %s, %s, %s",
-                             exc_type, exc_value, exc_traceback)
-                    if pkt_dhcp:
-                        if pkt_dhcp.opts:
-                            #*** Iterate through options looking for 12:
-                            for opt in pkt_dhcp.opts:
-                                if opt[0] == 12:
-                                    #*** Found option 12 so grab the host name:
-                                    dhcp_hostname = opt[1]
-                                    self.logger.debug("dhcp host name is %s", 
-                                                          dhcp_hostname)
-                                    if pkt_ip4:
-                                        ip = pkt_ip4.src
-                                    elif pkt_ip6:
-                                        ip = pkt_ip6.src
-                                    else:
-                                        ip = 0
-                                    #*** Call identity class with hostname etc:
-                                    self.identity.dhcp_in(pkt_eth.src,
-                                                          ip,
-                                                          dhcp_hostname,
-                                                          context)
+                    #*** Ryu decodes DHCP messages it can parse, so scan
+                    #*** the UDP payload from the packet bytes instead:
+                    _payload = pkt.protocols[-1]
+                    if not isinstance(_payload, str):
+                        _payload = str(pkt.data[-(pkt_udp.total_length
+                                                  - udp.udp._MIN_LEN):])
+                    dhcp = self.dhcp_parser.parse_dhcp(_payload)
+                    if dhcp:
+                        self.logger.debug("event=dhcp message_type=%s "
+                                          "chaddr=%s hostname=%s",
+                                          dhcp['message_type'],
+                                          dhcp['chaddr'], dhcp['hostname'])
+                        if dhcp['message_type'] == dhcp_scanner.DHCP_REQUEST:
+                            self._identity_in(('dhcp_request_in',
+                                               dhcp['chaddr'],
+                                               dhcp['hostname']))
+                        elif dhcp['message_type'] == dhcp_scanner.DHCP_ACK:
+                            _lease_time = dhcp['lease_time']
+                            if _lease_time == \
+                                          dhcp_scanner.DHCP_LEASE_INFINITE:
+                                _lease_time = None
+                            self._identity_in(('dhcp_in', dhcp['chaddr'],
+                                               dhcp['yiaddr'],
+                                               dhcp['hostname'],
+                                               context, _lease_time))
 
         if self._main_policy['identity']['dns'] == 1:
-            #*** Check to see if it is an IPv4 DNS packet
-            #***  and if so pass to the identity module to process
-            #*** At the time of writing there isn't a DNS parser in Ryu
-            #***  so do some dodgy stuff here in the interim...
+            #*** Check to see if it is a DNS response
+            #***  and if so pass to the identity module to process.
+            #*** Only responses are parsed, and only the parts that
+            #*** identity uses:
             dns = 0
             if pkt_udp:
-                if pkt_udp.src_port == 53 or pkt_udp.dst_port == 53:
-                    #*** Use dpkt to parse UDP DNS data:
-                    try:
-                        dns = dpkt.dns.DNS(pkt.protocols[-1])
-                    except:
-                        exc_type, exc_value, exc_traceback = sys.exc_info()
-                        self.logger.error("DNS extraction failed "
-                            "Exception %s, %s, %s",
-                             exc_type, exc_value, exc_traceback)
+                if pkt_udp.src_port == 53 and \
+                                     isinstance(pkt.protocols[-1], str):
+                    dns = self.dns_parser.parse_dns(pkt.protocols[-1])
             if pkt_tcp:
-                if pkt_tcp.src_port == 53 or pkt_tcp.dst_port == 53:
-                    #*** Use dpkt to parse TCP DNS data:
-                    try:
-                        dns = dpkt.dns.DNS(pkt.protocols[-1])
-                    except:
-                        exc_type, exc_value, exc_traceback = sys.exc_info()
-                        self.logger.error("DNS extraction failed "
-                            "Exception %s, %s, %s",
-                             exc_type, exc_value, exc_traceback)
+                if pkt_tcp.src_port == 53 and \
+                                     isinstance(pkt.protocols[-1], str):
+                    dns = self.dns_parser.parse_dns(pkt.protocols[-1],
+                                                    tcp=1)
             if dns:
                 #*** Call identity class with DNS parameters:
-                self.identity.dns_reply_in(dns.qd, dns.an, context)
+                self._identity_in(('dns_reply_in', tuple(dns['queries']),
+                                   tuple(dns['answers']), context))
 
         #*** Check against TC policy:
-        for tc_rule in self.tc_ruleset:
-            #*** Check the rule:
-            _result_dict = self._check_rule(pkt, tc_rule, context)
+        for idx, tc_rule in self._runtime_ruleset:
+            #*** Check the rule, recording evaluation counters if enabled:
+            if self.policy_stats_enabled:
+                _rule_stats = self._policy_stats['rules'][idx]
+                _start_time = time.time()
+                _result_dict = self._check_rule(pkt, tc_rule, context,
+                                                _rule_stats)
+                _rule_stats['time'] += time.time() - _start_time
+                _rule_stats['evaluations'] += 1
+                if _result_dict['match']:
+                    _rule_stats['matches'] += 1
+            else:
+                _result_dict = self._check_rule(pkt, tc_rule, context)
             if _result_dict['match']:
                 self.logger.debug("Matched policy rule")
                 #*** Need to merge the actions configured on the rule
@@ -479,19 +556,26 @@ class TrafficClassificationPolicy(object):
                     'actions': False}
         return _result_dict
 
-    def _check_rule(self, pkt, rule, ctx):
+    def _check_rule(self, pkt, rule, ctx, rule_stats=None):
         """
         Passed a main_policy.yaml tc_rule.
         Check to see if packet matches conditions as per the
         rule.
+        Optionally passed the policy stats dictionary for the rule, in
+        which case per-condition counters are recorded.
         Return a results dictionary
         """
         _result_dict = {'match':True, 'continue_to_inspect':False,
                     'actions': False}
         self.rule_match_type = rule['match_type']
+        _stanza_stats = None
         #*** Iterate through the conditions list:
-        for condition_stanza in rule['conditions_list']:
-            _result = self._check_conditions(pkt, condition_stanza, ctx)
+        for stanza_idx, condition_stanza in \
+                                      enumerate(rule['conditions_list']):
+            if rule_stats:
+                _stanza_stats = rule_stats['conditions'][stanza_idx]
+            _result = self._check_conditions(pkt, condition_stanza, ctx,
+                                             _stanza_stats)
             _match = _result['match']
             #*** Decide what to do based on match result and match type:
             if _match and self.rule_match_type == "any":
@@ -520,7 +604,7 @@ class TrafficClassificationPolicy(object):
             _result_dict['match'] = False
             return _result_dict
 
-    def _check_conditions(self, pkt, conditions, ctx):
+    def _check_conditions(self, pkt, conditions, ctx, stanza_stats=None):
         """
         Passed a packet-in packet and a conditions stanza (part of a 
         conditions list).
@@ -531,13 +615,22 @@ class TrafficClassificationPolicy(object):
         match is made and false if end of matching is reached.
         A match_type of 'all' will return false as soon as an invalid
         match is made and true if end of matching is reached.
+        If passed the policy stats dictionary for the stanza then
+        record evaluations, matches and time per condition.
         """
         #*** initial settings for results dictionary:
         _result_dict = {'match':True, 'continue_to_inspect':False,
                     'actions': False}
         self.match_type = conditions['match_type']
+        #*** Use the compiled evaluation order for stanzas in the policy,
+        #*** otherwise work it out:
+        _order = self._stanza_order.get(id(conditions))
+        if _order is None:
+            _order = self._order_conditions(conditions)
+        _match = False
+        policy_attr = None
         #*** Loop through conditions checking match:
-        for policy_attr in conditions.keys():
+        for policy_attr in _order:
             policy_value = conditions[policy_attr]
             #*** Policy Attribute Type is for non-static classifiers to
             #*** hold the attribute prefix (i.e. identity).
@@ -548,6 +641,11 @@ class TrafficClassificationPolicy(object):
                 policy_attr_type = policy_attr.split("_")
                 policy_attr_type = policy_attr_type[0]
             _match = False
+            if stanza_stats and policy_attr in stanza_stats:
+                _cond_stats = stanza_stats[policy_attr]
+                _start_time = time.time()
+            else:
+                _cond_stats = None
             #*** Main if/elif/else check on condition attribute type:
             if policy_attr_type == "identity":
                 _match = self.identity.check_identity(policy_attr, 
@@ -567,9 +665,6 @@ class TrafficClassificationPolicy(object):
                 #***  results that conflict?
                 _result_dict["continue_to_inspect"] = \
                                     _nested_dict["continue_to_inspect"]
-            elif policy_attr == "match_type":
-                #*** Nothing to do:
-                pass
 
             # haidlir's code
             elif policy_attr_type == "statistical":
@@ -582,6 +677,11 @@ class TrafficClassificationPolicy(object):
                 #*** default to doing a Static Classification match:
                 _match = self.static.check_static(policy_attr,
                                                         policy_value, pkt)
+            if _cond_stats:
+                _cond_stats['time'] += time.time() - _start_time
+                _cond_stats['evaluations'] += 1
+                if _match:
+                    _cond_stats['matches'] += 1
             #*** Decide what to do based on match result and match type:
             if _match and self.match_type == "any":
                 _result_dict["match"] = True
@@ -608,3 +708,547 @@ class TrafficClassificationPolicy(object):
             _result_dict["match"] = False
             return _result_dict
 
+
+    def compile_condition_order(self, use_stats=0):
+        """
+        Work out the order in which to evaluate the conditions in each
+        conditions stanza of the policy, cheapest cost class first.
+        If use_stats is set then, within a cost class, order by observed
+        selectivity from the policy evaluation counters.
+        The match_type attribute is not evaluated so is left out.
+        """
+        _stanza_order = {}
+        for idx, tc_rule in enumerate(self.tc_ruleset):
+            for stanza_idx, stanza in \
+                               enumerate(tc_rule.get('conditions_list', [])):
+                _stanza_stats = None
+                if use_stats and self.policy_stats_enabled:
+                    _stanza_stats = self._policy_stats['rules'][idx]\
+                                                   ['conditions'][stanza_idx]
+                _stanza_order[id(stanza)] = self._order_conditions(stanza,
+                                                           _stanza_stats)
+                self.logger.debug("event=condition_order rule=%s stanza=%s "
+                                  "order=%s", idx, stanza_idx,
+                                  _stanza_order[id(stanza)])
+        #*** Swap in the new order in one go:
+        self._stanza_order = _stanza_order
+
+    def compile_identity_regexes(self):
+        """
+        Collect the regular expressions used by identity conditions in
+        the policy and have the identity module compile them
+        """
+        _patterns = set()
+        for tc_rule in self.tc_ruleset:
+            for stanza in tc_rule.get('conditions_list', []):
+                for policy_attr, policy_value in stanza.items():
+                    if policy_attr in ('identity_lldp_systemname_re',
+                                       'identity_service_dns_re'):
+                        _patterns.add(policy_value)
+        self.identity.compile_regexes(_patterns)
+
+    def _order_conditions(self, conditions, stanza_stats=None):
+        """
+        Passed a conditions stanza and return a list of its condition
+        attributes in evaluation order. Conditions are sorted by cost
+        class, but only within the runs between stateful conditions
+        (payload, statistical) as moving a condition past one of those
+        would change which packets that classifier gets to see.
+        """
+        _match_type = conditions.get('match_type')
+        _order = []
+        _segment = []
+        for policy_attr in conditions.keys():
+            if policy_attr == 'match_type':
+                continue
+            if self._is_stateful_condition(policy_attr,
+                                           conditions[policy_attr]):
+                _order.extend(self._sort_conditions(_segment, _match_type,
+                                                    stanza_stats))
+                _order.append(policy_attr)
+                _segment = []
+            else:
+                _segment.append(policy_attr)
+        _order.extend(self._sort_conditions(_segment, _match_type,
+                                            stanza_stats))
+        return _order
+
+    def _sort_conditions(self, policy_attrs, match_type, stanza_stats):
+        """
+        Passed a list of condition attributes that are safe to reorder
+        and return them sorted by cost class. If there are enough
+        evaluation counters then conditions in the same cost class are
+        sorted so that the one most likely to end the stanza evaluation
+        (fail for 'all', match for 'any') goes first
+        """
+        def _sort_key(policy_attr):
+            _selectivity = 0
+            if stanza_stats and policy_attr in stanza_stats:
+                _cond_stats = stanza_stats[policy_attr]
+                if _cond_stats['evaluations'] >= TC_REORDER_MIN_EVALUATIONS:
+                    _selectivity = float(_cond_stats['matches']) / \
+                                                 _cond_stats['evaluations']
+                    if match_type == 'any':
+                        _selectivity = -_selectivity
+            return (_condition_cost(policy_attr), _selectivity)
+        return sorted(policy_attrs, key=_sort_key)
+
+    def _is_stateful_condition(self, policy_attr, policy_value):
+        """
+        Return True if a condition (or any condition nested within it)
+        is of a type that keeps state about the packets it sees
+        """
+        if policy_attr[0:10] == 'conditions':
+            if isinstance(policy_value, list):
+                for list_item in policy_value:
+                    if isinstance(list_item, dict):
+                        for _attr, _value in list_item.items():
+                            if self._is_stateful_condition(_attr, _value):
+                                return True
+            elif isinstance(policy_value, dict):
+                for _attr, _value in policy_value.items():
+                    if self._is_stateful_condition(_attr, _value):
+                        return True
+            return False
+        return policy_attr.split("_")[0] in TC_STATEFUL_CONDITION_TYPES
+
+    def compile_static_rules(self):
+        """
+        Compile each rule in the policy that only uses static conditions
+        into a list of match boxes. A box is a dictionary of condition
+        attribute to normalised value (integers for MACs, EtherTypes and
+        ports, (first, last) integer tuples for IPv4 address space) that
+        must all match, and a rule matches if any of its boxes match.
+        Rules that use any non-static condition compile to None.
+        Also builds the list of proactive flow entries, see
+        _compile_proactive_flows()
+        """
+        self.compiled_static = {}
+        for idx, tc_rule in enumerate(self.tc_ruleset):
+            self.compiled_static[idx] = self._compile_static_rule(tc_rule)
+            self.logger.debug("event=compile_static rule=%s boxes=%s", idx,
+                              self.compiled_static[idx])
+        self.analyze_policy()
+        self._compile_proactive_flows()
+
+    def _compile_static_rule(self, tc_rule):
+        """
+        Passed a tc_rule and return a list of match boxes that the rule
+        is equivalent to, or None if it can't be compiled
+        """
+        _match_type = tc_rule.get('match_type')
+        if _match_type not in ('any', 'all'):
+            return None
+        _rule_boxes = None
+        for stanza in tc_rule.get('conditions_list', []):
+            _stanza_boxes = self._compile_static_stanza(stanza)
+            if _stanza_boxes is None:
+                return None
+            if _rule_boxes is None:
+                _rule_boxes = _stanza_boxes
+            elif _match_type == 'any':
+                _rule_boxes = _rule_boxes + _stanza_boxes
+            else:
+                #*** All stanzas must match, so intersect every combination:
+                _rule_boxes = [_box for _box in
+                                  (_intersect_boxes(_box_a, _box_b)
+                                   for _box_a in _rule_boxes
+                                   for _box_b in _stanza_boxes)
+                                  if _box is not None]
+        return _rule_boxes
+
+    def _compile_static_stanza(self, stanza):
+        """
+        Passed a conditions stanza and return a list of match boxes that
+        it is equivalent to, or None if it can't be compiled
+        """
+        _match_type = stanza.get('match_type')
+        if _match_type not in ('any', 'all'):
+            return None
+        _boxes = []
+        for policy_attr, policy_value in stanza.items():
+            if policy_attr == 'match_type':
+                continue
+            if not policy_attr in TC_STATIC_CONDITIONS:
+                return None
+            _boxes.append(self._compile_static_condition(policy_attr,
+                                                         policy_value))
+        if _match_type == 'any':
+            return [_box for _box in _boxes if _box is not None]
+        #*** match_type is all:
+        if not _boxes:
+            return []
+        _result = {}
+        for _box in _boxes:
+            if _box is None:
+                return []
+            _result = _intersect_boxes(_result, _box)
+            if _result is None:
+                return []
+        return [_result]
+
+    def _compile_static_condition(self, policy_attr, policy_value):
+        """
+        Passed a static condition and return a match box for it, or
+        None if it can never match a packet. Mirrors the semantics
+        of tc_static.check_static()
+        """
+        if policy_attr in ('eth_src', 'eth_dst'):
+            _value = self.static.mac_to_int(policy_value)
+        elif policy_attr == 'eth_type':
+            _value = self.static.ethertype_to_int(policy_value)
+        elif policy_attr in ('ip_src', 'ip_dst'):
+            _range = self.static.ip_space_to_range(policy_value)
+            #*** Only IPv4 packets are checked against IP conditions:
+            if not _range or _range[0] != 4:
+                return None
+            _value = (_range[1], _range[2])
+        else:
+            #*** TCP ports are compared to the packet as integers:
+            if not isinstance(policy_value, int):
+                return None
+            _value = policy_value
+        if _value is None:
+            return None
+        return {policy_attr: _value}
+
+    def analyze_policy(self):
+        """
+        Analyse the compiled static rules for anomalies and report them
+        with their rule indices:
+         - shadowed: every packet the rule matches is matched by earlier
+           rules that have different actions, so the rule never applies
+         - redundant: every packet the rule matches is matched by earlier
+           rules that all have the same actions
+         - conflicting: the rule overlaps an earlier rule that has
+           different actions, so the earlier rule wins for the overlap
+        Shadowed and redundant rules are unreachable and, if configured,
+        are left out of the runtime ruleset (the policy file is not
+        changed). Only static rules can prove another rule unreachable,
+        as the result of other rules depends on more than the headers
+        """
+        self.policy_analysis = {'shadowed': [], 'redundant': [],
+                                'conflicting': [], 'pruned': []}
+        for idx, tc_rule in enumerate(self.tc_ruleset):
+            _boxes = self.compiled_static[idx]
+            if _boxes is None:
+                continue
+            _covered_by = set()
+            _overlaps = set()
+            _uncovered = False
+            for _box in _boxes:
+                _covering_rule = None
+                for _prev_idx in range(idx):
+                    _prev_boxes = self.compiled_static[_prev_idx]
+                    if _prev_boxes is None:
+                        continue
+                    for _prev_box in _prev_boxes:
+                        if _box_within(_box, _prev_box):
+                            _covering_rule = _prev_idx
+                            break
+                        if _intersect_boxes(_box, _prev_box) is not None:
+                            _overlaps.add(_prev_idx)
+                    if _covering_rule is not None:
+                        break
+                if _covering_rule is None:
+                    _uncovered = True
+                else:
+                    _covered_by.add(_covering_rule)
+            _actions = tc_rule.get('actions')
+            if not _uncovered:
+                #*** Rule is unreachable:
+                _by = sorted(_covered_by)
+                if all(self.tc_ruleset[_prev_idx].get('actions') == _actions
+                                                for _prev_idx in _by):
+                    self.policy_analysis['redundant'].append({'rule': idx,
+                                                               'by': _by})
+                    self.logger.warning("event=policy_analysis rule=%s is "
+                                        "redundant with rules=%s", idx, _by)
+                else:
+                    self.policy_analysis['shadowed'].append({'rule': idx,
+                                                              'by': _by})
+                    self.logger.warning("event=policy_analysis rule=%s is "
+                                        "shadowed by rules=%s", idx, _by)
+                if self.policy_prune_unreachable:
+                    self.policy_analysis['pruned'].append(idx)
+                continue
+            _with = sorted(_prev_idx for _prev_idx in _overlaps | _covered_by
+                           if self.tc_ruleset[_prev_idx].get('actions') !=
+                                                                  _actions)
+            if _with:
+                self.policy_analysis['conflicting'].append({'rule': idx,
+                                                            'with': _with})
+                self.logger.warning("event=policy_analysis rule=%s "
+                                    "conflicts with rules=%s", idx, _with)
+        #*** Build the ruleset that packets are checked against, keeping
+        #*** the policy rule index for counters and reporting:
+        self._runtime_ruleset = [(idx, tc_rule) for idx, tc_rule in
+                                 enumerate(self.tc_ruleset)
+                                 if not idx in self.policy_analysis['pruned']]
+        if self.policy_analysis['pruned']:
+            self.logger.info("event=policy_pruned rules=%s",
+                             self.policy_analysis['pruned'])
+
+    def get_policy_analysis(self):
+        """
+        Return the results of the policy anomaly analysis
+        """
+        return self.policy_analysis
+
+    def _compile_proactive_flows(self):
+        """
+        Build the list of flow entries that can be installed on switches
+        proactively. Rules are first-match, so only the leading run of
+        static-only rules can be pushed down without changing which
+        rule traffic would match. Each rule gets a priority below the
+        rules before it. Also builds the list of matches that must still
+        be sent to the controller for identity harvesting
+        """
+        self.proactive_flows = []
+        _leading_rules = []
+        for idx, tc_rule in enumerate(self.tc_ruleset):
+            if self.compiled_static[idx] is None:
+                break
+            _leading_rules.append(idx)
+        for idx in _leading_rules:
+            if idx in self.policy_analysis['pruned']:
+                continue
+            _priority = PROACTIVE_PRIORITY_BASE + len(_leading_rules) - idx
+            _actions = self.tc_ruleset[idx]['actions']
+            if not isinstance(_actions, dict):
+                _actions = False
+            for _box in self.compiled_static[idx]:
+                for _match in self._box_to_matches(_box):
+                    self.proactive_flows.append({'rule': idx,
+                                                 'priority': _priority,
+                                                 'match': _match,
+                                                 'actions': _actions})
+        self.logger.info("event=compile_proactive rules=%s flow_entries=%s",
+                         len(_leading_rules), len(self.proactive_flows))
+        #*** Identity harvesting needs to see these packets:
+        self.proactive_punts = []
+        _identity = self._main_policy['identity']
+        if _identity['arp'] == 1:
+            self.proactive_punts.append({'eth_type': 0x0806})
+        if _identity['lldp'] == 1:
+            self.proactive_punts.append({'eth_type': 0x88cc})
+        if _identity['dhcp'] == 1:
+            for _field in ('udp_src', 'udp_dst'):
+                self.proactive_punts.append({'eth_type': 0x0800,
+                                             'ip_proto': 17, _field: 67})
+        if _identity['dns'] == 1:
+            for _eth_type in (0x0800, 0x86dd):
+                for _ip_proto, _field in ((17, 'udp_src'), (17, 'udp_dst'),
+                                          (6, 'tcp_src'), (6, 'tcp_dst')):
+                    self.proactive_punts.append({'eth_type': _eth_type,
+                                                 'ip_proto': _ip_proto,
+                                                 _field: 53})
+        self.proactive_punt_priority = PROACTIVE_PRIORITY_BASE + \
+                                                 len(_leading_rules) + 1
+
+    def _box_to_matches(self, box):
+        """
+        Passed a match box and return a list of OpenFlow match keyword
+        dictionaries (OpenFlow 1.3 attribute names) that together
+        match exactly the same packets. IP address ranges are split
+        into masked matches and TCP conditions need an EtherType and
+        IP protocol as prerequisites
+        """
+        _base = {}
+        for _attr in ('eth_src', 'eth_dst'):
+            if _attr in box:
+                _base[_attr] = _int_to_mac(box[_attr])
+        if 'tcp_src' in box or 'tcp_dst' in box:
+            _base['ip_proto'] = 6
+            for _attr in ('tcp_src', 'tcp_dst'):
+                if _attr in box:
+                    _base[_attr] = box[_attr]
+        if 'eth_type' in box:
+            _eth_types = [box['eth_type']]
+        elif 'ip_src' in box or 'ip_dst' in box:
+            _eth_types = [0x0800]
+        elif 'ip_proto' in _base:
+            #*** TCP conditions match over IPv4 and IPv6:
+            _eth_types = [0x0800, 0x86dd]
+        else:
+            _eth_types = [None]
+        _matches = []
+        for _eth_type in _eth_types:
+            _match = dict(_base)
+            if _eth_type is not None:
+                _match['eth_type'] = _eth_type
+            _matches.append(_match)
+        for _attr, _of_attr in (('ip_src', 'ipv4_src'),
+                                ('ip_dst', 'ipv4_dst')):
+            if _attr in box:
+                _masks = self.static.ip_range_to_masks(4, box[_attr][0],
+                                                       box[_attr][1])
+                _matches = [dict(_match.items() + [(_of_attr, _mask)])
+                            for _match in _matches for _mask in _masks]
+        return _matches
+
+    def reset_policy_stats(self):
+        """
+        Reset (or initialise) the per-rule and per-condition evaluation
+        counters. Rows are pre-built for every rule, conditions stanza
+        and condition so that the packet path only does lookups
+        """
+        self._policy_stats = {'reset_time': time.time(), 'rules': {}}
+        for idx, tc_rule in enumerate(self.tc_ruleset):
+            _rule_stats = {'comment': tc_rule.get('comment', ''),
+                           'evaluations': 0, 'matches': 0, 'time': 0.0,
+                           'conditions': {}}
+            for stanza_idx, stanza in \
+                               enumerate(tc_rule.get('conditions_list', [])):
+                _rule_stats['conditions'][stanza_idx] = {}
+                for policy_attr in stanza.keys():
+                    if policy_attr == 'match_type':
+                        continue
+                    _rule_stats['conditions'][stanza_idx][policy_attr] = \
+                                {'evaluations': 0, 'matches': 0, 'time': 0.0}
+            self._policy_stats['rules'][idx] = _rule_stats
+        self.logger.debug("event=reset_policy_stats rules=%s",
+                          len(self._policy_stats['rules']))
+
+    def _identity_in(self, record):
+        """
+        Passed an identity record, a tuple of the name of an identity
+        method and its arguments, and queue it for identity_worker.
+        If the queue is full the record is dropped. If queueing is
+        turned off the record is applied straight away
+        """
+        if not self.identity_queue_max:
+            self.process_identity_record(record)
+            return
+        _backlog = self.identity_queue.qsize()
+        if _backlog >= self.identity_queue_max:
+            self._identity_queue_stats['dropped'] += 1
+            return
+        self.identity_queue.put(record)
+        self._identity_queue_stats['enqueued'] += 1
+        if _backlog + 1 > self._identity_queue_stats['max_backlog']:
+            self._identity_queue_stats['max_backlog'] = _backlog + 1
+
+    def process_identity_record(self, record):
+        """
+        Apply an identity record to the identity module
+        """
+        getattr(self.identity, record[0])(*record[1:])
+
+    def identity_worker(self):
+        """
+        Loop applying identity records from the identity queue.
+        Runs as a green thread
+        """
+        while True:
+            record = self.identity_queue.get()
+            try:
+                self.process_identity_record(record)
+            except:
+                #*** Log the error and carry on with the next record:
+                self._identity_queue_stats['errors'] += 1
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self.logger.error("Identity record=%s failed "
+                            "Exception %s, %s, %s", record[0],
+                             exc_type, exc_value, exc_traceback)
+            else:
+                self._identity_queue_stats['processed'] += 1
+
+    def get_identity_queue_stats(self):
+        """
+        Return the identity queue counters with the current backlog
+        """
+        _result = dict(self._identity_queue_stats)
+        _result['backlog'] = self.identity_queue.qsize()
+        _result['queue_max'] = self.identity_queue_max
+        return _result
+
+    def get_policy_stats(self):
+        """
+        Return the per-rule and per-condition evaluation counters,
+        with average evaluation time (seconds) added for convenience
+        """
+        for _rule_stats in self._policy_stats['rules'].values():
+            _rule_stats['avg_time'] = _avg_time(_rule_stats)
+            for _stanza_stats in _rule_stats['conditions'].values():
+                for _cond_stats in _stanza_stats.values():
+                    _cond_stats['avg_time'] = _avg_time(_cond_stats)
+        self._policy_stats['enabled'] = self.policy_stats_enabled
+        self._policy_stats['interval'] = time.time() - \
+                                             self._policy_stats['reset_time']
+        return self._policy_stats
+
+def _condition_cost(policy_attr):
+    """
+    Passed a condition attribute and return its cost class
+    """
+    if policy_attr in TC_CONDITION_COST:
+        return TC_CONDITION_COST[policy_attr]
+    return TC_CONDITION_TYPE_COST.get(policy_attr.split("_")[0], 1)
+
+def _intersect_boxes(box_a, box_b):
+    """
+    Passed two match boxes and return a match box that matches only
+    packets that both match, or None if no packet can match both
+    """
+    _result = dict(box_a)
+    for _attr, _value in box_b.items():
+        if not _attr in _result:
+            _result[_attr] = _value
+        elif _attr in ('ip_src', 'ip_dst'):
+            _first = max(_result[_attr][0], _value[0])
+            _last = min(_result[_attr][1], _value[1])
+            if _first > _last:
+                return None
+            _result[_attr] = (_first, _last)
+        elif _result[_attr] != _value:
+            return None
+    #*** IP conditions only match IPv4 and TCP conditions only match IP:
+    if ('ip_src' in _result or 'ip_dst' in _result) and \
+                          _result.get('eth_type', 0x0800) != 0x0800:
+        return None
+    if ('tcp_src' in _result or 'tcp_dst' in _result) and \
+                          _result.get('eth_type', 0x0800) not in \
+                          (0x0800, 0x86dd):
+        return None
+    return _result
+
+def _box_within(box_a, box_b):
+    """
+    Passed two match boxes and return True if every packet that
+    matches box_a also matches box_b. May return False for some cases
+    where it is true, but never returns True when it isn't
+    """
+    for _attr, _value in box_b.items():
+        if _attr in box_a:
+            if _attr in ('ip_src', 'ip_dst'):
+                if box_a[_attr][0] < _value[0] or \
+                                        box_a[_attr][1] > _value[1]:
+                    return False
+            elif box_a[_attr] != _value:
+                return False
+        elif _attr == 'eth_type' and ('ip_src' in box_a or
+                                      'ip_dst' in box_a):
+            #*** IP conditions imply IPv4:
+            if _value != 0x0800:
+                return False
+        else:
+            return False
+    return True
+
+def _int_to_mac(value):
+    """
+    Passed a MAC address as an integer and return it as a string
+    in colon separated hex
+    """
+    return ':'.join('%02x' % ((value >> shift) & 0xff)
+                    for shift in range(40, -8, -8))
+
+def _avg_time(stats):
+    """
+    Passed a policy stats counters dictionary and return the average
+    evaluation time, or 0 if there have been no evaluations
+    """
+    if stats['evaluations']:
+        return stats['time'] / stats['evaluations']
+    return 0
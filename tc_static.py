@@ -29,6 +29,7 @@ from netaddr import IPAddress
 from netaddr import IPNetwork
 from netaddr import EUI
 from netaddr import iter_iprange
+from netaddr import iprange_to_cidrs
 
 #*** Ryu imports:
 from ryu.lib import addrconv
@@ -308,6 +309,9 @@ class StaticInspect(object):
         Return 1 for both the same EtherType and 0 for different
         Values can be hex or decimal and are 2 bytes in length
         """
+        #*** EtherTypes from packets are integers, so normalise to strings:
+        value_to_check1 = str(value_to_check1)
+        value_to_check2 = str(value_to_check2)
         #*** Normalise any hex to decimal integers:
         if value_to_check1[:2] == '0x':
             #*** Looks like hex:
@@ -414,3 +418,69 @@ class StaticInspect(object):
             return 1
         else:
             return 0
+
+    def mac_to_int(self, value):
+        """
+        Passed a MAC address and return it as an integer, or
+        None if it is not a valid MAC address
+        """
+        try:
+            return int(EUI(value))
+        except:
+            self.logger.debug("Check of "
+                    "mac_to_int on %s raised an exception", value)
+            return None
+
+    def ethertype_to_int(self, value):
+        """
+        Passed an EtherType (hex as 0x* or decimal) and return it as
+        an integer, or None if it is not valid
+        """
+        value = str(value)
+        try:
+            if value[:2] == '0x':
+                return int(value, 16)
+            return int(value)
+        except:
+            self.logger.debug("Check of "
+                    "ethertype_to_int on %s raised an exception", value)
+            return None
+
+    def ip_space_to_range(self, ip_space):
+        """
+        Passed an IP address space (single address, CIDR network or
+        range) and return a tuple of (IP version, first address as
+        integer, last address as integer), or None if it is not valid
+        """
+        try:
+            if "/" in ip_space:
+                ip_space_object = IPNetwork(ip_space)
+                return (ip_space_object.version, ip_space_object.first,
+                                                 ip_space_object.last)
+            elif "-" in ip_space:
+                ip_range = ip_space.split("-")
+                if len(ip_range) != 2:
+                    return None
+                first = IPAddress(ip_range[0])
+                last = IPAddress(ip_range[1])
+                if first.version != last.version or first > last:
+                    return None
+                return (first.version, first.value, last.value)
+            else:
+                ip_addr_object = IPAddress(ip_space)
+                return (ip_addr_object.version, ip_addr_object.value,
+                                                ip_addr_object.value)
+        except:
+            self.logger.debug("Check of "
+                    "ip_space_to_range on %s raised an exception", ip_space)
+            return None
+
+    def ip_range_to_masks(self, version, first, last):
+        """
+        Passed an IP version and first and last addresses as integers
+        and return a list of (address, netmask) string tuples that
+        exactly cover the range, suitable for masked OpenFlow matches
+        """
+        return [(str(cidr.ip), str(cidr.netmask)) for cidr in
+                          iprange_to_cidrs(IPAddress(first, version),
+                                           IPAddress(last, version))]
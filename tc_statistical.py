@@ -21,11 +21,15 @@ to provide network identity and flow (traffic classification) metadata
 
 import logging
 import logging.handlers
+import sys
 import struct
 import time
+import math
+import collections
 
 #*** Ryu imports:
 from ryu.lib import addrconv
+from ryu.lib import hub
 from ryu.lib.packet import packet
 from ryu.lib.packet import ethernet
 from ryu.lib.packet import lldp
@@ -35,6 +39,24 @@ from ryu.lib.packet import udp
 
 #*** nmeta imports:
 import nmisc
+import tc_features
+import tc_model
+
+#*** IP protocol numbers used in FCIP table keys:
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+
+#*** Sequential classification evidence. Log likelihood ratios of a
+#*** packet size for a bandwidth hog flow (over an interactive flow):
+HOG_SIZE_THRESHOLD = 1200
+HOG_LLR_LARGE = math.log(0.8 / 0.1)
+HOG_LLR_SMALL = math.log(0.2 / 0.9)
+#*** ...and for a BitTorrent flow (over a Skype or other UDP flow):
+P2P_SIZE_BT = 48
+P2P_SIZES_SKYPE = (31, 56)
+P2P_LLR_BT = math.log(0.5 / 0.02)
+P2P_LLR_SKYPE = math.log(0.02 / 0.3)
+P2P_LLR_OTHER = math.log(0.48 / 0.68)
 
 class StatisticalInspect(object):
     """
@@ -82,8 +104,50 @@ class StatisticalInspect(object):
 
         #*** Instantiate the Flow Classification In Progress (FCIP) Table:
         self._fcip_table = nmisc.AutoVivification()
+        #*** Index of FCIP table refs keyed by canonical bidirectional
+        #*** 5-tuple so that lookups don't scan the table:
+        self._fcip_index = {}
         #*** Initialise FCIP Tables unique reference number:
         self._fcip_ref = 1
+        #*** Number of packets to keep raw features of per FCIP table row:
+        self.fcip_buffer_packets = _config.get_value \
+                                    ('statistical_fcip_buffer_packets')
+        #*** Classify bandwidth hogs from flow entry counters instead:
+        self.counter_mode = _config.get_value('statistical_counter_mode')
+        #*** Flows waiting to have their flow entry registered for counter
+        #*** classification, keyed by canonical key, with request time:
+        self._counter_requests = {}
+        #*** Trained model classifier, with the number of packets of a
+        #*** flow to accumulate before scoring it and the seconds between
+        #*** scoring batches of finalised flows:
+        self.model = tc_model.ModelClassify(_config)
+        self.model_packets = _config.get_value('statistical_model_packets')
+        self.model_batch_interval = _config.get_value \
+                                    ('statistical_model_batch_interval')
+        #*** FCIP table refs of flows finalised since the last batch:
+        self._model_pending = []
+        #*** Asynchronous classifier (tc_async.py) to score batches in
+        #*** worker processes, set by nmeta.py:
+        self.async_classify = None
+        #*** Cache of verdicts by classifier and server endpoint, least
+        #*** recently updated first, so new flows to an endpoint that
+        #*** keeps getting the same verdict skip inspection:
+        self._verdict_cache = collections.OrderedDict()
+        self.verdict_cache_max = _config.get_value \
+                                    ('statistical_verdict_cache_max')
+        self.verdict_cache_ttl = _config.get_value \
+                                    ('statistical_verdict_cache_ttl')
+        self.verdict_cache_agree = _config.get_value \
+                                    ('statistical_verdict_cache_agree')
+        self.verdict_cache_sample = _config.get_value \
+                                    ('statistical_verdict_cache_sample')
+        self._verdict_cache_stats = {'hits': 0, 'misses': 0, 'samples': 0,
+                                     'disagreements': 0, 'evictions': 0}
+        #*** Sequential decision parameters by policy value:
+        self._sequential_cache = {}
+        #*** Histograms of packets inspected before deciding, by
+        #*** classifier:
+        self._decision_packets = {}
         #*** Do you want really verbose debugging?
         self.extra_debugging = 1
         
@@ -96,12 +160,18 @@ class StatisticalInspect(object):
         self.logger.debug("check_statistical was "
                            "called")
         if policy_attr == "statistical_qos_bandwidth_1":
+            if self.counter_mode:
+                #*** Classify from flow entry counters instead of packets:
+                return self._statistical_counter_request(pkt)
             #*** call the function for this particular statistical classifier
-            results_dict = self._statistical_qos_bandwidth_1(pkt)
+            results_dict = self._statistical_qos_bandwidth_1(pkt,
+                                                            policy_value)
             return results_dict
         elif policy_attr == "statistical_voip_p2p":
-            results_dict = self._statistical_voip_p2p(pkt)
+            results_dict = self._statistical_voip_p2p(pkt, policy_value)
             # return results_dict
+        elif policy_attr == "statistical_model":
+            return self._statistical_model(pkt)
         else:
             self.logger.error("Policy attribute "
                               "%s did not match", policy_attr)
@@ -109,21 +179,26 @@ class StatisticalInspect(object):
                      'actions':'none'}        
         return False
 
-    def _statistical_qos_bandwidth_1(self, pkt):
+    def _statistical_qos_bandwidth_1(self, pkt, policy_value=True):
         """
         A really basic statistical classifier to demonstrate ability
         to differentiate 'bandwidth hog' flows from ones that are 
         more interactive so that appropriate classification metadata
         can be passed to QoS for differential treatment.
-        This function is passed a packet and returns a dictionary of 
-        results. Only works on TCP.
+        This function is passed a packet and the policy value and
+        returns a dictionary of results, including the confidence of
+        the classification so far. Only works on TCP.
+        If the policy value sets sequential decision thresholds (see
+        _sequential_params) the flow is classified as soon as the
+        evidence from packet sizes crosses a threshold, otherwise
+        after the maximum number of packets.
         """
+        _sequential = self._sequential_params(policy_value)
         #*** Maximum packets to accumulate in a flow before making a 
         #***  classification:
         _max_packets = 5
-        #*** Thresholds used in calculations:
-        _max_packet_size_threshold = 1200
-        _interpacket_ratio_threshold = 0.25
+        if _sequential:
+            _max_packets = _sequential['max_packets']
         #*** Initialise variables
         _continue_to_inspect = True
         _actions = 0
@@ -142,219 +217,460 @@ class StatisticalInspect(object):
                 #*** Not finalised so add to table row:
                 _flow_packet_count = self._fcip_add_to_existing(pkt, _table_ref)
                 #*** Note that _flow_packet_count will be 0 if a duplicate packet
-                if _flow_packet_count > (_max_packets - 1):
-                    #*** Reached our maximum packet count so do some classification:
-                    self.logger.debug("Reached max packets count")
-                    #*** Set the flow to be finalised so no more packets will be added: 
-                    self._fcip_finalise(_table_ref)
+                _decision = None
+                if _flow_packet_count:
+                    _decision = self._sequential_update(_table_ref,
+                                        self._hog_evidence(pkt), _sequential)
+                if _decision is not None or \
+                                    _flow_packet_count > (_max_packets - 1):
                     #*** Set result value to say that flow can be installed to switch now
                     #*** as we don't need to see any more packets to classify it:
-                    _continue_to_inspect = False                        
-                    #*** Call functions to get statistics to make decisions on:
-                    _max_packet_size = self._calc_max_packet_size(_table_ref)
-                    _max_interpacket_interval = self._calc_max_interpacket_interval(_table_ref)
-                    _min_interpacket_interval = self._calc_min_interpacket_interval(_table_ref)
-                    #*** Avoid possible divide by zero error:
-                    if (_max_interpacket_interval and _min_interpacket_interval):
-                        #*** Ratio between largest directional interpacket delta and smallest
-                        #*** Use a ratio as it accounts for base RTT:
-                        _interpacket_ratio = float(_min_interpacket_interval) / float(_max_interpacket_interval)
-                    else:
-                        _interpacket_ratio = 0
-                    self.logger.debug("_max_packet_size is %s", _max_packet_size)
-                    self.logger.debug("_interpacket_ratio is %s", _interpacket_ratio)
-                    #*** Decide actions based on the statistics:
-                    if (_max_packet_size > _max_packet_size_threshold and 
-                            _interpacket_ratio < _interpacket_ratio_threshold):
-                        #*** This traffic looks like a bandwidth hog so set to low priority:
-                        _actions = { 'set_qos_tag': "QoS_treatment=low_priority" }
-                    else:
-                        #*** Doesn't look like bandwidth hog so default priority:
-                        _actions = { 'set_qos_tag': "QoS_treatment=default_priority" }
-                    self.logger.debug("Decided on actions %s", _actions)
-                    #*** Install actions into table so that subsequent packets of same flow
-                    #*** get same actions when seeing finalised entry:
-                    self._fcip_table[_table_ref]["actions"] = _actions
+                    _continue_to_inspect = False
+                    _actions = self._qos_bandwidth_1_finalise(_table_ref,
+                                            _flow_packet_count, _decision)
             else:
                 #*** It's a finalised flow so we don't want to touch it,
                 #*** but we do want to grab the actions if there are any
                 _actions = self._fcip_table[_table_ref]["actions"]
                 return {'valid':True, 'continue_to_inspect':False, 
-                'actions':_actions}
+                'actions':_actions,
+                'confidence':self._fcip_table[_table_ref]["confidence"]}
         else:
+            #*** Flows to a server that reliably gets the same verdict
+            #*** aren't inspected:
+            _actions = self._verdict_cache_check(
+                                        "statistical_qos_bandwidth_1", pkt)
+            if _actions:
+                self._verdict_cache_row(self._fcip_add_new(pkt), _actions)
+                return {'valid':True, 'continue_to_inspect':False,
+                        'actions':_actions}
             #*** It's not a flow we're classifying so start a new entry:
-            self._fcip_add_new(pkt)
+            _table_ref = self._fcip_add_new(pkt)
+            _decision = self._sequential_update(_table_ref,
+                                        self._hog_evidence(pkt), _sequential)
+            if _decision is not None:
+                _continue_to_inspect = False
+                _actions = self._qos_bandwidth_1_finalise(_table_ref, 1,
+                                                          _decision)
         return {'valid':True, 'continue_to_inspect':_continue_to_inspect, 
+                    'actions':_actions,
+                    'confidence':self._fcip_table[_table_ref]["confidence"]}
+
+    def _qos_bandwidth_1_finalise(self, table_ref, packets, decision):
+        """
+        Passed a FCIP table ref of a flow being classified by
+        statistical_qos_bandwidth_1, the number of packets seen and the
+        sequential decision (1 for bandwidth hog, 0 for not, None to
+        decide from the flow statistics). Finalise the flow and return
+        the actions decided on
+        """
+        #*** Thresholds used in calculations:
+        _max_packet_size_threshold = HOG_SIZE_THRESHOLD
+        _interpacket_ratio_threshold = 0.25
+        self.logger.debug("Deciding after %s packets", packets)
+        #*** Set the flow to be finalised so no more packets will be added: 
+        self._fcip_finalise(table_ref)
+        self._record_decision("statistical_qos_bandwidth_1", packets)
+        if decision is None:
+            #*** Get statistics to make decisions on:
+            _features = self._fcip_table[table_ref]["features"]
+            _max_packet_size = _features.get_max_packet_size()
+            _max_interpacket_interval = _features.get_max_interpacket_interval()
+            _min_interpacket_interval = _features.get_min_interpacket_interval()
+            #*** Avoid possible divide by zero error:
+            if (_max_interpacket_interval and _min_interpacket_interval):
+                #*** Ratio between largest directional interpacket delta and smallest
+                #*** Use a ratio as it accounts for base RTT:
+                _interpacket_ratio = float(_min_interpacket_interval) / float(_max_interpacket_interval)
+            else:
+                _interpacket_ratio = 0
+            self.logger.debug("_max_packet_size is %s", _max_packet_size)
+            self.logger.debug("_interpacket_ratio is %s", _interpacket_ratio)
+            decision = (_max_packet_size > _max_packet_size_threshold and
+                        _interpacket_ratio < _interpacket_ratio_threshold)
+        #*** Decide actions based on the statistics:
+        if decision:
+            #*** This traffic looks like a bandwidth hog so set to low priority:
+            _actions = { 'set_qos_tag': "QoS_treatment=low_priority" }
+        else:
+            #*** Doesn't look like bandwidth hog so default priority:
+            _actions = { 'set_qos_tag': "QoS_treatment=default_priority" }
+        self.logger.debug("Decided on actions %s", _actions)
+        #*** Install actions into table so that subsequent packets of same flow
+        #*** get same actions when seeing finalised entry:
+        self._fcip_table[table_ref]["actions"] = _actions
+        self._verdict_cache_add("statistical_qos_bandwidth_1", table_ref,
+                                _actions)
+        return _actions
+
+    def _hog_evidence(self, pkt):
+        """
+        Passed a TCP packet and return the log likelihood ratio of its
+        size for a bandwidth hog flow over an interactive one
+        """
+        if pkt.get_protocol(ipv4.ipv4).total_length > HOG_SIZE_THRESHOLD:
+            return HOG_LLR_LARGE
+        return HOG_LLR_SMALL
+
+    def _sequential_params(self, policy_value):
+        """
+        Passed the policy value of a statistical condition and return
+        a dictionary of sequential probability ratio test (SPRT)
+        parameters if it sets them, otherwise None. Values that set them
+        are strings like:
+            sprt alpha=0.01 beta=0.01 max_packets=5
+        where alpha is the acceptable rate of false positives, beta of
+        false negatives and max_packets the most packets to inspect
+        before deciding anyway. Results are memoised per policy value
+        """
+        try:
+            return self._sequential_cache[policy_value]
+        except (KeyError, TypeError):
+            pass
+        _params = None
+        if isinstance(policy_value, basestring) and \
+                                    policy_value.split()[:1] == ['sprt']:
+            try:
+                _params = {'alpha': 0.01, 'beta': 0.01, 'max_packets': 5}
+                for _setting in policy_value.split()[1:]:
+                    _name, _value = _setting.split('=')
+                    if not _name in _params:
+                        raise ValueError("Unknown setting %s" % _name)
+                    _params[_name] = type(_params[_name])(_value)
+                if not (0 < _params['alpha'] < 1 and
+                        0 < _params['beta'] < 1 and
+                        _params['max_packets'] > 0):
+                    raise ValueError("Setting out of range")
+                #*** Wald's thresholds on the log likelihood ratio:
+                _params['upper'] = math.log((1 - _params['beta']) /
+                                             _params['alpha'])
+                _params['lower'] = math.log(_params['beta'] /
+                                             (1 - _params['alpha']))
+            except:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self.logger.error("Invalid sequential policy value=%s "
+                            "Exception %s, %s, %s", policy_value,
+                             exc_type, exc_value, exc_traceback)
+                _params = None
+        try:
+            self._sequential_cache[policy_value] = _params
+        except TypeError:
+            #*** Not hashable so can't be memoised:
+            pass
+        return _params
+
+    def _sequential_update(self, table_ref, evidence, params):
+        """
+        Passed a FCIP table ref, the log likelihood ratio of the packet
+        just added to the flow and sequential parameters (or None). Add
+        the evidence to the flow, update the confidence of the flow (the
+        probability of the more likely class) and return 1 if the
+        evidence has crossed the upper threshold, 0 if it has crossed the
+        lower threshold, or None if neither or there are no parameters
+        """
+        _row = self._fcip_table[table_ref]
+        _llr = (_row["llr"] or 0) + evidence
+        _row["llr"] = _llr
+        _row["confidence"] = 1.0 / (1.0 + math.exp(-abs(_llr)))
+        if not params:
+            return None
+        if _llr >= params['upper']:
+            return 1
+        if _llr <= params['lower']:
+            return 0
+        return None
+
+    def _record_decision(self, classifier, packets):
+        """
+        Passed the name of a classifier and the number of packets that
+        it inspected in a flow before deciding, and count it
+        """
+        _histogram = self._decision_packets.setdefault(classifier, {})
+        _histogram[packets] = _histogram.get(packets, 0) + 1
+
+    def get_decision_stats(self):
+        """
+        Return, per classifier, the number of flows decided, the mean
+        number of packets inspected per flow and a histogram of
+        packets inspected to number of flows
+        """
+        _stats = {}
+        for _classifier, _histogram in self._decision_packets.iteritems():
+            _flows = sum(_histogram.values())
+            _packets = sum(_packets * _count
+                              for _packets, _count in _histogram.iteritems())
+            _stats[_classifier] = {'flows': _flows,
+                                   'mean_packets': float(_packets) / _flows,
+                                   'histogram': dict(_histogram)}
+        return _stats
+
+    def _statistical_model(self, pkt):
+        """
+        Statistical classifier that uses a model trained offline (see
+        tc_model.py). Accumulates features of TCP and UDP flows and,
+        once a flow has enough packets, finalises it and queues it to
+        be scored in the next batch by score_model_batch. Packets of the
+        flow seen after scoring get the actions of the model class.
+        This function is passed a packet and returns a dictionary of
+        results
+        """
+        _actions = 0
+        if not self.model.model or not pkt.get_protocol(ipv4.ipv4):
+            #*** No model loaded so nothing to classify with, or not IPv4:
+            return {'valid':True, 'continue_to_inspect':False,
                     'actions':_actions}
-            
-    def _calc_max_packet_size(self, table_ref):
-        """
-        Review packet sizes in a flow and return the largest one
-        """
-        _max_size = 0
-        for _packet_number in self._fcip_table[table_ref]["ip_total_length"]:
-            _size = self._fcip_table[table_ref]["ip_total_length"][_packet_number]
-            if _size > _max_size:
-                _max_size = _size
-        return _max_size
-
-    def _calc_max_window_growth(self, table_ref):
-        """
-        Review TCP window sizes and return the largest growth ratio out
-        of forward and reverse window sizes when comparing intial and
-        final TCP window sizes
-        """
-        #*** Note: this may not handle flows well that we haven't seen SYNs
-        #*** for and thus the window is not scaled...
-        _first_forward = 0
-        _first_reverse = 0
-        _max_forward = 0
-        _max_reverse = 0
-        for _packet_number in self._fcip_table[table_ref]["window_size"]:
-            _size = self._fcip_table[table_ref]["window_size"][_packet_number]
-            _direction = self._fcip_table[table_ref]["direction"][_packet_number]
-            if _direction == "forward":
-                if not _first_forward:
-                    _first_forward = _size
-                if _size > _max_forward:
-                    _max_forward = _size
-            if _direction == "reverse":
-                if not _first_reverse:
-                    _first_reverse = _size
-                if _size > _max_reverse:
-                    _max_reverse = _size
-        if _first_forward and _max_forward:
-            _forward_ratio = float(_max_forward) / float(_first_forward)
-        if _first_reverse and _max_reverse:
-            _reverse_ratio = float(_max_reverse) / float(_first_reverse)
-        if _forward_ratio > _reverse_ratio:
-            return _forward_ratio
-        elif _reverse_ratio > _forward_ratio:
-            return _reverse_ratio
+        if pkt.get_protocol(tcp.tcp):
+            _table_ref = self._fcip_check(pkt, "statistical_model")
+            _add_to_existing = self._fcip_add_to_existing
+            _add_new = self._fcip_add_new
+        elif pkt.get_protocol(udp.udp):
+            _table_ref = self._udp_fcip_check(pkt, "statistical_model")
+            _add_to_existing = self._udp_fcip_add_to_existing
+            _add_new = self._udp_fcip_add_new
         else:
-            #*** It's a draw!
-            return _forward_ratio
-
-    def _calc_max_interpacket_interval(self, table_ref):
-        """
-        Review packet arrival times for each direction in 
-        a flow and return the size of the largest inter-
-        packet interval (from either direction) in seconds
-        """
-        _max_interpacket = 0
-        _previous_reverse = 0
-        _previous_forward = 0
-        for _packet_number in self._fcip_table[table_ref]["arrival_time"]:
-            _arrival_time = self._fcip_table[table_ref]["arrival_time"][_packet_number]
-            _direction = self._fcip_table[table_ref]["direction"][_packet_number]
-            if _direction == 'forward' and _previous_forward:
-                _interpacket_interval = _arrival_time - _previous_forward
-                if not _max_interpacket:
-                    _max_interpacket = _interpacket_interval
-                elif _interpacket_interval > _max_interpacket:
-                    _max_interpacket = _interpacket_interval
-                else:
-                    #*** nothing to see here, move on
-                    pass
-                _previous_forward = _arrival_time
-            elif _direction == 'reverse' and _previous_reverse:
-                _interpacket_interval = _arrival_time - _previous_reverse
-                if not _max_interpacket:
-                    _max_interpacket = _interpacket_interval
-                elif _interpacket_interval > _max_interpacket:
-                    _max_interpacket = _interpacket_interval
-                else:
-                    #*** nothing to see here, move on
-                    pass
-                _previous_reverse = _arrival_time
-            elif _direction == 'forward':
-                #*** First time we've seen a forward packet so set previous for next time
-                _previous_forward = _arrival_time
-            elif _direction == 'reverse':
-                #*** First time we've seen a reverse packet so set previous for next time
-                _previous_reverse = _arrival_time
-            else:
-                #*** should never hit this...
-                self.logger.error("Strange condition encountered")
-        if not _max_interpacket:
+            return {'valid':True, 'continue_to_inspect':False,
+                    'actions':_actions}
+        if not _table_ref:
+            _cached = self._verdict_cache_check("statistical_model", pkt)
+            if _cached:
+                self._verdict_cache_row(_add_new(pkt, "statistical_model"),
+                                        _cached)
+                return {'valid':True, 'continue_to_inspect':False,
+                        'actions':_cached}
+            #*** It's not a flow we're classifying so start a new entry:
+            _add_new(pkt, "statistical_model")
+            return {'valid':True, 'continue_to_inspect':True,
+                    'actions':_actions}
+        if self._fcip_is_finalised(_table_ref):
+            #*** Actions are 0 until the flow has been scored:
+            return {'valid':True, 'continue_to_inspect':False,
+                    'actions':self._fcip_table[_table_ref]["actions"]}
+        #*** Note that the packet count will be 0 if a duplicate packet:
+        if _add_to_existing(pkt, _table_ref) >= self.model_packets:
+            self.logger.debug("Reached model packets count")
+            self._fcip_finalise(_table_ref)
+            self._record_decision("statistical_model",
+                        self._fcip_table[_table_ref]["number_of_packets"])
+            self._model_pending.append(_table_ref)
+            return {'valid':True, 'continue_to_inspect':False,
+                    'actions':_actions}
+        return {'valid':True, 'continue_to_inspect':True,
+                'actions':_actions}
+
+    def score_model_batch(self):
+        """
+        Score all flows finalised by the model classifier since the last
+        batch with one call to the model, and store the actions of each
+        in its FCIP table row. The batch is scored in a worker process if
+        there is an asynchronous classifier, otherwise inline. Returns the
+        number of flows scored (or submitted to be scored)
+        """
+        if not self._model_pending:
+            return 0
+        #*** Flows may have been tidied out of the table since finalising:
+        _table_refs = [_table_ref for _table_ref in self._model_pending
+                                        if _table_ref in self._fcip_table]
+        self._model_pending = []
+        #*** Use the same model for the whole batch even if it is swapped:
+        _model = self.model.model
+        if not _table_refs or not _model:
             return 0
+        _vectors = [self._fcip_table[_table_ref]["features"].
+                            get_feature_vector(_model['features'])
+                            for _table_ref in _table_refs]
+        _keys = [self._fcip_table[_table_ref]["fcip_key"]
+                            for _table_ref in _table_refs]
+        if self.async_classify and self.async_classify.running():
+            #*** Workers are sent the model once, and jobs are kept small
+            #*** as they are sent from the packet-in green thread:
+            _max_batch = self.async_classify.max_batch
+            for _start in xrange(0, len(_keys), _max_batch):
+                self.async_classify.submit(_keys[_start:_start + _max_batch],
+                        tc_model.classify_vectors,
+                        (_vectors[_start:_start + _max_batch],),
+                        self.model_verdicts, (('model', _model),))
+            self.logger.debug("event=model_batch_submitted flows=%s",
+                              len(_keys))
+            return len(_keys)
+        self.model_verdicts(_keys, self.model.classify(_vectors, _model))
+        self.logger.debug("event=model_batch flows=%s", len(_table_refs))
+        return len(_table_refs)
+
+    def model_verdicts(self, keys, results):
+        """
+        Passed the FCIP index keys of flows scored by the model and the
+        actions for each, and store the actions in their FCIP table rows
+        """
+        for _key, _actions in zip(keys, results):
+            _table_ref = self._fcip_index.get(_key)
+            if not _table_ref:
+                continue
+            self._fcip_table[_table_ref]["actions"] = _actions
+            self._verdict_cache_add("statistical_model", _table_ref,
+                                    _actions)
+
+    def get_deferred_flow(self, pkt):
+        """
+        Passed a packet that a flow entry is being installed for and
+        return the FCIP index key of its flow if the flow is being
+        classified by statistical_model in worker processes and has no
+        verdict yet, so the flow entry should be re-marked when the
+        verdict arrives, otherwise None
+        """
+        if not (self.async_classify and self.async_classify.enabled):
+            return None
+        if not pkt.get_protocol(ipv4.ipv4):
+            return None
+        if pkt.get_protocol(tcp.tcp):
+            _table_ref = self._fcip_check(pkt, "statistical_model")
+        elif pkt.get_protocol(udp.udp):
+            _table_ref = self._udp_fcip_check(pkt, "statistical_model")
         else:
-            return _max_interpacket
-
-    def _calc_min_interpacket_interval(self, table_ref):
-        """
-        Review packet arrival times for each direction in 
-        a flow and return the size of the smallest inter-
-        packet interval (from either direction) in seconds
-        """
-        _min_interpacket = 0
-        _previous_reverse = 0
-        _previous_forward = 0
-        for _packet_number in self._fcip_table[table_ref]["arrival_time"]:
-            _arrival_time = self._fcip_table[table_ref]["arrival_time"][_packet_number]
-            _direction = self._fcip_table[table_ref]["direction"][_packet_number]
-            if _direction == 'forward' and _previous_forward:
-                _interpacket_interval = _arrival_time - _previous_forward
-                if not _min_interpacket:
-                    _min_interpacket = _interpacket_interval
-                elif _interpacket_interval < _min_interpacket:
-                    _min_interpacket = _interpacket_interval
-                else:
-                    #*** nothing to see here, move on
-                    pass
-                _previous_forward = _arrival_time
-            elif _direction == 'reverse' and _previous_reverse:
-                _interpacket_interval = _arrival_time - _previous_reverse
-                if not _min_interpacket:
-                    _min_interpacket = _interpacket_interval
-                elif _interpacket_interval < _min_interpacket:
-                    _min_interpacket = _interpacket_interval
-                else:
-                    #*** nothing to see here, move on
-                    pass
-                _previous_reverse = _arrival_time
-            elif _direction == 'forward':
-                #*** First time we've seen a forward packet so set previous for next time
-                _previous_forward = _arrival_time
-            elif _direction == 'reverse':
-                #*** First time we've seen a reverse packet so set previous for next time
-                _previous_reverse = _arrival_time
-            else:
-                #*** should never hit this...
-                self.logger.error("Strange condition encountered")
-        if not _min_interpacket:
+            return None
+        if not _table_ref or self._fcip_table[_table_ref]["actions"]:
+            return None
+        return self._fcip_table[_table_ref]["fcip_key"]
+
+    def model_worker(self):
+        """
+        Loop scoring batches of flows finalised by the model classifier.
+        Runs as a green thread
+        """
+        while True:
+            hub.sleep(self.model_batch_interval)
+            try:
+                self.score_model_batch()
+            except:
+                #*** Log the error and keep going:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self.logger.error("Model batch failed "
+                            "Exception %s, %s, %s",
+                             exc_type, exc_value, exc_traceback)
+
+    def _verdict_cache_check(self, classifier, pkt):
+        """
+        Passed the name of a classifier and the first packet of a flow
+        that has no FCIP row and return the cached actions for the
+        server endpoint (destination IP, port and protocol) of the flow
+        if the cache is confident of them, otherwise 0. Every
+        verdict_cache_sample'th hit on an entry returns 0 so the flow
+        is inspected to re-verify the entry
+        """
+        if not self.verdict_cache_max:
+            return 0
+        _key = (classifier,) + self._verdict_endpoint(pkt)
+        _entry = self._verdict_cache.get(_key)
+        if not _entry or _entry['confidence'] < self.verdict_cache_agree:
+            self._verdict_cache_stats['misses'] += 1
+            return 0
+        if time.time() - _entry['time_last'] > self.verdict_cache_ttl:
+            del self._verdict_cache[_key]
+            self._verdict_cache_stats['misses'] += 1
             return 0
+        _entry['hits'] += 1
+        if self.verdict_cache_sample and \
+                            not _entry['hits'] % self.verdict_cache_sample:
+            self._verdict_cache_stats['samples'] += 1
+            return 0
+        self._verdict_cache_stats['hits'] += 1
+        return _entry['actions']
+
+    def _verdict_cache_row(self, table_ref, actions):
+        """
+        Passed the FCIP table ref of a flow just added for a packet that
+        the verdict cache had actions for, and finalise the row with
+        them. Later packets of the flow, in either direction, then get
+        the actions from the row rather than consulting the cache (and
+        counting as hits) again. Confidence is None as the flow wasn't
+        inspected
+        """
+        self._fcip_finalise(table_ref)
+        self._fcip_table[table_ref]["actions"] = actions
+        self._fcip_table[table_ref]["confidence"] = None
+
+    def _verdict_cache_add(self, classifier, table_ref, actions):
+        """
+        Passed the name of a classifier, the FCIP table ref of a flow
+        that it has classified and the actions it decided on and update
+        the verdict cache entry for the server endpoint of the flow.
+        Agreeing verdicts raise the confidence of the entry and a
+        different verdict replaces it
+        """
+        if not self.verdict_cache_max:
+            return
+        _row = self._fcip_table[table_ref]
+        if "tcp_B" in _row:
+            _port, _proto = _row["tcp_B"], IP_PROTO_TCP
         else:
-            return _min_interpacket
-            
-    def _calc_last_interpacket_interval(self, table_ref):
-        """
-        Interval from last packet arrival times for same  
-        direction in flow in seconds
-        """
-        _previous_reverse = 0
-        _previous_forward = 0
-        _interpacket_interval = 0
-        for _packet_number in self._fcip_table[table_ref]["arrival_time"]:
-            _arrival_time = self._fcip_table[table_ref]["arrival_time"][_packet_number]
-            _direction = self._fcip_table[table_ref]["direction"][_packet_number]
-            if _direction == 'forward' and _previous_forward:
-                _interpacket_interval = _arrival_time - _previous_forward
-                _previous_forward = _arrival_time
-            elif _direction == 'reverse' and _previous_reverse:
-                _interpacket_interval = _arrival_time - _previous_reverse
-                _previous_reverse = _arrival_time
-            elif _direction == 'forward':
-                #*** First time we've seen a forward packet so set previous for next time
-                _previous_forward = _arrival_time
-            elif _direction == 'reverse':
-                #*** First time we've seen a reverse packet so set previous for next time
-                _previous_reverse = _arrival_time
-            else:
-                #*** should never hit this...
-                self.logger.error("Strange condition encountered")
-        return _interpacket_interval
-            
+            _port, _proto = _row["udp_B"], IP_PROTO_UDP
+        _key = (classifier, _row["ip_B"], _port, _proto)
+        #*** Re-inserting keeps the cache in order of last update:
+        _entry = self._verdict_cache.pop(_key, None)
+        if _entry and _entry['actions'] == actions:
+            _entry['confidence'] += 1
+        else:
+            if _entry:
+                self._verdict_cache_stats['disagreements'] += 1
+                self.logger.debug("event=verdict_changed endpoint=%s "
+                                  "actions=%s", _key, actions)
+            _entry = {'actions': actions, 'confidence': 1, 'hits': 0}
+        _entry['time_last'] = time.time()
+        self._verdict_cache[_key] = _entry
+        if len(self._verdict_cache) > self.verdict_cache_max:
+            self._verdict_cache.popitem(last=False)
+            self._verdict_cache_stats['evictions'] += 1
+
+    def _verdict_endpoint(self, pkt):
+        """
+        Passed the first packet of a flow and return the server endpoint
+        of the flow as (destination IP, destination port, protocol)
+        """
+        _pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
+        _pkt_tcp = pkt.get_protocol(tcp.tcp)
+        if _pkt_tcp:
+            return (_pkt_ip4.dst, _pkt_tcp.dst_port, IP_PROTO_TCP)
+        return (_pkt_ip4.dst, pkt.get_protocol(udp.udp).dst_port,
+                IP_PROTO_UDP)
+
+    def get_verdict_cache_stats(self):
+        """
+        Return the verdict cache counters with the number of entries
+        """
+        _stats = dict(self._verdict_cache_stats)
+        _stats['entries'] = len(self._verdict_cache)
+        return _stats
+
+    def _statistical_counter_request(self, pkt):
+        """
+        Passed a packet and, if it is TCP over IPv4, note that its flow
+        entry should be classified from its counters, so there is no
+        need to inspect any more packets. Returns a results dictionary
+        """
+        _pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
+        _pkt_tcp = pkt.get_protocol(tcp.tcp)
+        if _pkt_ip4 and _pkt_tcp:
+            self._counter_requests[fcip_key(IP_PROTO_TCP, _pkt_ip4.src,
+                                _pkt_tcp.src_port, _pkt_ip4.dst,
+                                _pkt_tcp.dst_port)] = time.time()
+        return {'valid':True, 'continue_to_inspect':False, 'actions':0}
+
+    def pop_counter_request(self, pkt):
+        """
+        Passed a packet that a flow entry is being installed for and
+        return True if the flow should be classified from its counters,
+        otherwise False. The request is removed
+        """
+        _pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
+        _pkt_tcp = pkt.get_protocol(tcp.tcp)
+        if not (_pkt_ip4 and _pkt_tcp):
+            return False
+        _key = fcip_key(IP_PROTO_TCP, _pkt_ip4.src, _pkt_tcp.src_port,
+                        _pkt_ip4.dst, _pkt_tcp.dst_port)
+        if _key in self._counter_requests:
+            del self._counter_requests[_key]
+            return True
+        return False
+
     def _fcip_finalise(self, table_ref):
         """
         Passed a table row (flow reference) and set it as finalised
@@ -373,10 +689,12 @@ class StatisticalInspect(object):
         else:
             return 0
 
-    def _fcip_check(self, pkt):
+    def _fcip_check(self, pkt, classifier=None):
         """
         Checks if a packet is part of a flow in the
         Flow Classification In Progress (FCIP) table.
+        Passed the name of the classifier if it keeps its own
+        rows (see _fcip_index_key).
         Returns False if not in table.
         Returns a table reference if it is in the table
         """
@@ -386,19 +704,15 @@ class StatisticalInspect(object):
         _ip_B = _pkt_ip4.dst
         _tcp_A = _pkt_tcp.src_port
         _tcp_B = _pkt_tcp.dst_port
-        for _table_ref in self._fcip_table:
-            _ip_match = self._fcip_check_ip(_table_ref, _ip_A, _ip_B)
-            if _ip_match:
-                #*** Matched IP address pair in either direction
-                #*** Now check for TCP port match (with consideration to
-                #*** directionality):
-                _tcp_match = self._fcip_check_tcp(_table_ref, _ip_match, _tcp_A, _tcp_B)
-                if _tcp_match:
-                    #*** Matched IP and TCP parameters so return
-                    #*** the table reference:
-                    self.logger.debug("Matched a flow "
-                                      "we're already classifying...")
-                    return _table_ref
+        #*** Key is the same for both directions of the flow:
+        _table_ref = self._fcip_index.get(self._fcip_index_key(
+                    fcip_key(IP_PROTO_TCP, _ip_A, _tcp_A, _ip_B, _tcp_B),
+                    classifier))
+        if _table_ref:
+            self.logger.debug("Matched a flow "
+                              "we're already classifying...")
+            return _table_ref
+        return False
                 
     def _fcip_check_ip(self, table_ref, ip_A, ip_B):
         """
@@ -416,35 +730,16 @@ class StatisticalInspect(object):
         else:
             return False
 
-    def _fcip_check_tcp(self, table_ref, ip_match, tcp_A, tcp_B):
-        """
-        Checks if source/destination tcp ports match against
-        a given table entry same order that IP addresses matched 
-        in.
-        .
-        Also deduplicates for same packet passing through multiple
-        switches by checking the TCP acknowledgement number
-        .
-        Returns True (1) for a match and False (0) for no match
-        """        
-        if (ip_match == 'forward' and tcp_A == self._fcip_table[table_ref]["tcp_A"]
-            and tcp_B == self._fcip_table[table_ref]["tcp_B"]):
-                return True
-        elif (ip_match == 'reverse' and tcp_A == self._fcip_table[table_ref]["tcp_B"]
-            and tcp_B == self._fcip_table[table_ref]["tcp_A"]):
-                return True
-        else:
-            return False
-            
-    def _fcip_add_new(self, pkt):
+    def _fcip_add_new(self, pkt, classifier=None):
         """
         Passed a packet that is a new flow and add to the
         Flow Classification In Progress (FCIP) table.
+        Passed the name of the classifier if it keeps its own
+        rows (see _fcip_index_key).
+        Returns the table reference of the new entry
         """        
         _pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
         _pkt_tcp = pkt.get_protocol(tcp.tcp) 
-        #*** Direction for first packet is always forward:
-        self._fcip_table[self._fcip_ref]["direction"][1] = "forward"
         #*** Initial setting of variable that stops more packets being added:
         self._fcip_table[self._fcip_ref]["finalised"] = 0
         #*** Allow actions to be stored for reference on finalised flows:
@@ -454,24 +749,28 @@ class StatisticalInspect(object):
         self._fcip_table[self._fcip_ref]["ip_B"] = _pkt_ip4.dst
         self._fcip_table[self._fcip_ref]["tcp_A"] = _pkt_tcp.src_port
         self._fcip_table[self._fcip_ref]["tcp_B"] = _pkt_tcp.dst_port        
-        #*** This could do with improvement - would be subject to variability
-        #*** due to time taken for packet to reach the controller and
-        #*** processing time on the controller. But, it'll do for the moment:
-        self._fcip_table[self._fcip_ref]["arrival_time"][1] = time.time()
-        #*** Add packet size:
-        self._fcip_table[self._fcip_ref]["ip_total_length"][1] = _pkt_ip4.total_length
-        #*** Add TCP parameters like window size, ack number and bits
-        #***  (aka TCP flags):
+        self._fcip_index_add(self._fcip_index_key(fcip_key(IP_PROTO_TCP,
+                   _pkt_ip4.src, _pkt_tcp.src_port, _pkt_ip4.dst,
+                   _pkt_tcp.dst_port), classifier))
         if self._tcp_syn_flag(_pkt_tcp.bits):
-            #*** Packet has TCP SYN flag set:
-            self._fcip_table[self._fcip_ref]["TCP_SYN"][1] = "SYN"
             #*** To calculate TCP Window size we need to know the TCP window
             #*** scale shift count as per RFC1323. Parse this from the TCP SYN:
             _tcp_window_shift =  self._tcp_window_scale(_pkt_tcp.option)
             self._fcip_table[self._fcip_ref]["window_scale"]["forward"] = _tcp_window_shift
-        self._fcip_table[self._fcip_ref]["window_size"][1] = _pkt_tcp.window_size
-        self._fcip_table[self._fcip_ref]["ack"][1] = _pkt_tcp.ack
-        self._fcip_table[self._fcip_ref]["bits"][1] = _pkt_tcp.bits
+        #*** This could do with improvement - would be subject to variability
+        #*** due to time taken for packet to reach the controller and
+        #*** processing time on the controller. But, it'll do for the moment:
+        _arrival_time = time.time()
+        self._fcip_table[self._fcip_ref]["time_last"] = _arrival_time
+        #*** Start accumulating flow statistics. Direction for first packet
+        #*** is always forward:
+        _features = tc_features.FlowAccumulator()
+        _features.update("forward", _arrival_time, _pkt_ip4.total_length,
+                         _pkt_tcp.window_size,
+                         self._tcp_signature(_pkt_ip4, _pkt_tcp))
+        self._fcip_table[self._fcip_ref]["features"] = _features
+        self._fcip_buffer_add(self._fcip_ref, "forward", _arrival_time,
+                              _pkt_ip4.total_length, _pkt_tcp.window_size)
         #*** Number of packets is 1 as this is the first packet in the flow:
         self._fcip_table[self._fcip_ref]["number_of_packets"] = 1
         if self.extra_debugging:
@@ -479,6 +778,7 @@ class StatisticalInspect(object):
                                self._fcip_table[self._fcip_ref])
         #*** increment table ref ready for next time we use it:
         self._fcip_ref += 1
+        return self._fcip_ref - 1
 
     def _fcip_add_to_existing(self, pkt, table_ref):
         """
@@ -505,20 +805,12 @@ class StatisticalInspect(object):
         self.logger.debug("_packet_number is %s", _packet_number)        
         #*** Update number of packets:
         self._fcip_table[table_ref]["number_of_packets"] = _packet_number
-        #*** Work out directionality and add to the table:
+        #*** Work out directionality:
         _direction = self._fcip_check_ip(table_ref, _ip_A, _ip_B)
-        self._fcip_table[table_ref]["direction"][_packet_number] = _direction
-        #*** This could do with improvement - would be subject to variability
-        #*** due to time taken for packet to reach the controller and processing
-        #*** time on the controller. But, it'll do for the moment:
-        self._fcip_table[table_ref]["arrival_time"][_packet_number] = time.time()
-        #*** Add packet size:
-        self._fcip_table[table_ref]["ip_total_length"][_packet_number] = _pkt_ip4.total_length
-        #*** Add TCP parameters like window size, ack number and bits (aka TCP flags):
+        #*** Work out TCP window size:
         _tcp_window_size = _pkt_tcp.window_size
         if self._tcp_syn_flag(_pkt_tcp.bits):
             #*** Packet has TCP SYN flag set:
-            self._fcip_table[table_ref]["TCP_SYN"][_packet_number] = "SYN"
             if _direction == "reverse":
                 #*** Get the reverse direction TCP window scale:
                 _tcp_window_shift =  self._tcp_window_scale(_pkt_tcp.option)
@@ -529,21 +821,26 @@ class StatisticalInspect(object):
                 _tcp_window_size = _tcp_window_size << self._fcip_table[table_ref]["window_scale"]["forward"]
             if (_direction == "reverse" and self._fcip_table[table_ref]["window_scale"]["reverse"]):
                 _tcp_window_size = _tcp_window_size << self._fcip_table[table_ref]["window_scale"]["reverse"]
-        self._fcip_table[table_ref]["window_size"][_packet_number] = _tcp_window_size
-        self._fcip_table[table_ref]["ack"][_packet_number] = _pkt_tcp.ack
-        self._fcip_table[table_ref]["bits"][_packet_number] = _pkt_tcp.bits
+        #*** This could do with improvement - would be subject to variability
+        #*** due to time taken for packet to reach the controller and processing
+        #*** time on the controller. But, it'll do for the moment:
+        _arrival_time = time.time()
+        self._fcip_table[table_ref]["time_last"] = _arrival_time
+        #*** Update the flow statistics:
+        _features = self._fcip_table[table_ref]["features"]
+        _features.update(_direction, _arrival_time, _pkt_ip4.total_length,
+                         _tcp_window_size,
+                         self._tcp_signature(_pkt_ip4, _pkt_tcp))
+        self._fcip_buffer_add(table_ref, _direction, _arrival_time,
+                              _pkt_ip4.total_length, _tcp_window_size)
         if self.extra_debugging:
-            self.logger.debug("updated with packet %s: %s", 
-                              _packet_number, self._fcip_table[table_ref])
-            #*** Extra data for easy recording of statistical results for analysis charts:
-            _max_packet_size = self._calc_max_packet_size(table_ref)
-            self._fcip_table[table_ref]["max_packet_size"][_packet_number] = _max_packet_size
-            _max_window_growth_ratio = self._calc_max_window_growth(table_ref)
-            self._fcip_table[table_ref]["max_window_growth_ratio"][_packet_number] = _max_window_growth_ratio
-            _min_interpacket_interval = self._calc_min_interpacket_interval(table_ref)
-            self._fcip_table[table_ref]["min_interpacket"][_packet_number] = _min_interpacket_interval
-            _calc_last_interpacket_interval = self._calc_last_interpacket_interval(table_ref)
-            self._fcip_table[table_ref]["last_interpacket"][_packet_number] = _calc_last_interpacket_interval
+            self.logger.debug("updated with packet %s: max_packet_size=%s "
+                              "max_window_growth_ratio=%s min_interpacket=%s "
+                              "last_interpacket=%s", _packet_number,
+                              _features.get_max_packet_size(),
+                              _features.get_max_window_growth(),
+                              _features.get_min_interpacket_interval(),
+                              _features.last_interval)
         return _packet_number
         
     def _fcip_check_duplicate(self, pkt, table_ref):
@@ -553,20 +850,32 @@ class StatisticalInspect(object):
         table row.
         Check to see if this packet is a duplicate of
         any of the packets already included in this table
-        row and if it is a duplicate return True otherwise
-        False
+        row (in constant time, see tc_features.DuplicateFilter)
+        and if it is a duplicate return True otherwise False
         """        
         _pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
         _pkt_tcp = pkt.get_protocol(tcp.tcp)
-        #*** iterate through table row checking for duplicate values
-        for _packet_number in xrange(1, (self._fcip_table[table_ref]["number_of_packets"]+1)):
-            if (self._fcip_table[table_ref]["window_size"][_packet_number] == _pkt_tcp.window_size
-            and self._fcip_table[table_ref]["ack"][_packet_number] == _pkt_tcp.ack
-            and self._fcip_table[table_ref]["bits"][_packet_number] == _pkt_tcp.bits):
-                if self.extra_debugging:
-                    self.logger.debug("DUPLICATE PACKET")
-                return True
+        if self._fcip_table[table_ref]["features"].is_duplicate(
+                                    self._tcp_signature(_pkt_ip4, _pkt_tcp)):
+            if self.extra_debugging:
+                self.logger.debug("DUPLICATE PACKET")
+            return True
         return False
+
+    def _tcp_signature(self, pkt_ip4, pkt_tcp):
+        """
+        Passed IPv4 and TCP headers and return the values that identify
+        a duplicate of the packet (sequence number, ack number, IP total
+        length and bits)
+        """
+        return (pkt_tcp.seq, pkt_tcp.ack, pkt_ip4.total_length, pkt_tcp.bits)
+
+    def _udp_signature(self, pkt_ip4, pkt_udp):
+        """
+        Passed IPv4 and UDP headers and return the values that identify
+        a duplicate of the packet (IP identification and UDP checksum)
+        """
+        return (pkt_ip4.identification, pkt_udp.csum)
         
     def _tcp_syn_flag(self, bits):
         """
@@ -638,18 +947,72 @@ class StatisticalInspect(object):
                     _for_deletion.append(_table_ref)
         #*** Now iterate over the list of references to delete:
         for _del_ref in _for_deletion:
+            _key = self._fcip_table[_del_ref]["fcip_key"]
+            if self._fcip_index.get(_key) == _del_ref:
+                del self._fcip_index[_key]
             del self._fcip_table[_del_ref]
+        #*** Expire verdict cache entries, oldest first:
+        while self._verdict_cache:
+            _key, _entry = next(self._verdict_cache.iteritems())
+            if _time - _entry['time_last'] <= self.verdict_cache_ttl:
+                break
+            del self._verdict_cache[_key]
+        #*** Forget counter classification requests that weren't taken up:
+        for _key, _requested in self._counter_requests.items():
+            if (_time - _requested > max_age_fcip):
+                del self._counter_requests[_key]
+
+    def _fcip_buffer_add(self, table_ref, direction, arrival_time, size,
+                            window_size=0):
+        """
+        Passed a FCIP table ref and the raw features of a packet added
+        to the row and, if raw features are being kept, add them to the
+        row's feature buffer (created on the first packet)
+        """
+        if not self.fcip_buffer_packets:
+            return
+        if not "packets" in self._fcip_table[table_ref]:
+            self._fcip_table[table_ref]["packets"] = \
+                    tc_features.FlowFeatureBuffer(self.fcip_buffer_packets)
+        self._fcip_table[table_ref]["packets"].append(direction,
+                                        arrival_time, size, window_size)
+
+    def _fcip_index_key(self, key, classifier):
+        """
+        Passed the canonical key of a flow and the name of a classifier
+        that keeps its own FCIP rows for flows (or None) and return the
+        key of the flow in the FCIP index. statistical_qos_bandwidth_1
+        (TCP) and statistical_voip_p2p (UDP) share canonical keys, while
+        statistical_model rows are keyed by name too so that its flows
+        don't collide with theirs when a policy uses both
+        """
+        if classifier:
+            return (classifier,) + key
+        return key
+
+    def _fcip_index_add(self, key):
+        """
+        Passed the index key of a new flow and index it against
+        the FCIP table ref that is being added. The key is kept in the
+        table row so that the index entry can be removed with the row
+        """
+        self._fcip_table[self._fcip_ref]["fcip_key"] = key
+        self._fcip_index[key] = self._fcip_ref
 
-    def _statistical_voip_p2p(self, pkt):
+    def _statistical_voip_p2p(self, pkt, policy_value=True):
         """
-        Statistical Classifier for VoIP and P2P Traffic
+        Statistical Classifier for VoIP and P2P Traffic.
+        Passed a packet and the policy value and returns a dictionary
+        of results, including the confidence of the classification so
+        far. Sequential decision thresholds can be set in the policy
+        value as for statistical_qos_bandwidth_1
         """
+        _sequential = self._sequential_params(policy_value)
         #*** Maximum packets to accumulate in a flow before making a 
         #***  classification:
         _max_packets = 5
-        #*** Thresholds used in calculations:
-        # _max_packet_size_threshold = 1200
-        # _interpacket_ratio_threshold = 0.25
+        if _sequential:
+            _max_packets = _sequential['max_packets']
         #*** Initialise variables
         _continue_to_inspect = True
         _actions = 0
@@ -671,56 +1034,104 @@ class StatisticalInspect(object):
                 #*** Not finalised so add to table row:
                 _flow_packet_count = self._udp_fcip_add_to_existing(pkt, _table_ref)
                 #*** Note that _flow_packet_count will be 0 if a duplicate packet
-                if _flow_packet_count > (_max_packets - 1):
-                    #*** Reached our maximum packet count so do some classification:
-                    self.logger.debug("Reached max packets count")
-                    self.logger.info("finalised")
-                    # self.logger.info(self._fcip_table[_table_ref])
-                    #*** Set the flow to be finalised so no more packets will be added: 
-                    self._fcip_finalise(_table_ref)
+                _decision = None
+                if _flow_packet_count:
+                    _decision = self._sequential_update(_table_ref,
+                                        self._p2p_evidence(pkt), _sequential)
+                if _decision is not None or \
+                                    _flow_packet_count > (_max_packets - 1):
                     #*** Set result value to say that flow can be installed to switch now
                     #*** as we don't need to see any more packets to classify it:
-                    _continue_to_inspect = False                        
-                    #*** Decide actions based on the statistics:
-                    #*** For Bit Torrent Traffic
-                    _count_bt = 0
-                    for length in self._fcip_table[_table_ref]["ip_total_length"].values():
-                        if length == 48: _count_bt += 1
-                    if _count_bt > 2:
-                        #*** It looks like Bit Torrent Traffic
-                        self.logger.info("I Got Bit Torrent Traffic")
-                        _actions = { 'set_qos_tag': "QoS_treatment=low_priority" }
-                    #*** For Skype Traffic setup call
-                    _count_skype = 0
-                    for length in self._fcip_table[_table_ref]["ip_total_length"].values():
-                        if length == 31 or length == 56: _count_skype += 1
-                    if _count_skype > 2:
-                        #*** It looks like it will be a Skype Traffic
-                        self.logger.info("I Got Skype Traffic")
-                        _actions = { 'set_qos_tag': "QoS_treatment=default_priority" }
-                    else:
-                        #*** Default action for other traffic type
-                        _actions = { 'set_qos_tag': "QoS_treatment=default_priority" }
-                    self.logger.debug("Decided on actions %s", _actions)
-                    #*** Install actions into table so that subsequent packets of same flow
-                    #*** get same actions when seeing finalised entry:
-                    self._fcip_table[_table_ref]["actions"] = _actions
+                    _continue_to_inspect = False
+                    _actions = self._voip_p2p_finalise(_table_ref,
+                                            _flow_packet_count, _decision)
             else:
                 #*** It's a finalised flow so we don't want to touch it,
                 #*** but we do want to grab the actions if there are any
                 _actions = self._fcip_table[_table_ref]["actions"]
                 return {'valid':True, 'continue_to_inspect':False, 
-                'actions':_actions}
+                'actions':_actions,
+                'confidence':self._fcip_table[_table_ref]["confidence"]}
         else: 
+            _actions = self._verdict_cache_check("statistical_voip_p2p",
+                                                 pkt)
+            if _actions:
+                self._verdict_cache_row(self._udp_fcip_add_new(pkt),
+                                        _actions)
+                return {'valid':True, 'continue_to_inspect':False,
+                        'actions':_actions}
             #*** It's not a flow we're classifying so start a new entry:
-            self._udp_fcip_add_new(pkt)
+            _table_ref = self._udp_fcip_add_new(pkt)
+            _decision = self._sequential_update(_table_ref,
+                                        self._p2p_evidence(pkt), _sequential)
+            if _decision is not None:
+                _continue_to_inspect = False
+                _actions = self._voip_p2p_finalise(_table_ref, 1, _decision)
         return {'valid':True, 'continue_to_inspect':_continue_to_inspect, 
-                    'actions':_actions}
+                    'actions':_actions,
+                    'confidence':self._fcip_table[_table_ref]["confidence"]}
+
+    def _voip_p2p_finalise(self, table_ref, packets, decision):
+        """
+        Passed a FCIP table ref of a flow being classified by
+        statistical_voip_p2p, the number of packets seen and the
+        sequential decision (1 for BitTorrent, 0 for not, None to
+        decide from the flow statistics). Finalise the flow and return
+        the actions decided on
+        """
+        self.logger.debug("Deciding after %s packets", packets)
+        #*** Set the flow to be finalised so no more packets will be added: 
+        self._fcip_finalise(table_ref)
+        self._record_decision("statistical_voip_p2p", packets)
+        if decision == 1:
+            self.logger.info("I Got Bit Torrent Traffic")
+            _actions = { 'set_qos_tag': "QoS_treatment=low_priority" }
+        elif decision == 0:
+            _actions = { 'set_qos_tag': "QoS_treatment=default_priority" }
+        else:
+            #*** Decide actions based on the statistics:
+            _size_counts = self._fcip_table[table_ref]["features"].size_counts
+            #*** For Bit Torrent Traffic
+            _count_bt = _size_counts.get(P2P_SIZE_BT, 0)
+            if _count_bt > 2:
+                #*** It looks like Bit Torrent Traffic
+                self.logger.info("I Got Bit Torrent Traffic")
+                _actions = { 'set_qos_tag': "QoS_treatment=low_priority" }
+            #*** For Skype Traffic setup call
+            _count_skype = sum(_size_counts.get(_size, 0)
+                                            for _size in P2P_SIZES_SKYPE)
+            if _count_skype > 2:
+                #*** It looks like it will be a Skype Traffic
+                self.logger.info("I Got Skype Traffic")
+                _actions = { 'set_qos_tag': "QoS_treatment=default_priority" }
+            else:
+                #*** Default action for other traffic type
+                _actions = { 'set_qos_tag': "QoS_treatment=default_priority" }
+        self.logger.debug("Decided on actions %s", _actions)
+        #*** Install actions into table so that subsequent packets of same flow
+        #*** get same actions when seeing finalised entry:
+        self._fcip_table[table_ref]["actions"] = _actions
+        self._verdict_cache_add("statistical_voip_p2p", table_ref, _actions)
+        return _actions
 
-    def _udp_fcip_check(self, pkt):
+    def _p2p_evidence(self, pkt):
+        """
+        Passed a UDP packet and return the log likelihood ratio of its
+        size for a BitTorrent flow over a Skype or other flow
+        """
+        _size = pkt.get_protocol(ipv4.ipv4).total_length
+        if _size == P2P_SIZE_BT:
+            return P2P_LLR_BT
+        if _size in P2P_SIZES_SKYPE:
+            return P2P_LLR_SKYPE
+        return P2P_LLR_OTHER
+
+    def _udp_fcip_check(self, pkt, classifier=None):
         """
         Checks if a packet is part of a flow in the
         Flow Classification In Progress (FCIP) table.
+        Passed the name of the classifier if it keeps its own
+        rows (see _fcip_index_key).
         Returns False if not in table.
         Returns a table reference if it is in the table
         """       
@@ -730,35 +1141,15 @@ class StatisticalInspect(object):
         _ip_B = _pkt_ip4.dst
         _udp_A = _pkt_udp.src_port
         _udp_B = _pkt_udp.dst_port
-        for _table_ref in self._fcip_table:
-            _ip_match = self._fcip_check_ip(_table_ref, _ip_A, _ip_B)
-            if _ip_match:
-                #*** Matched IP address pair in either direction
-                #*** Now check for UDP port match (with consideration to
-                #*** directionality):
-                _udp_match = self._fcip_check_udp(_table_ref, _ip_match, _udp_A, _udp_B)
-                if _udp_match:
-                    #*** Matched IP and UDP parameters so return
-                    #*** the table reference:
-                    self.logger.debug("Matched a flow "
-                                      "we're already classifying...")
-                    return _table_ref
-
-    def _fcip_check_udp(self, table_ref, ip_match, udp_A, udp_B):
-        """
-        Checks if source/destination udp ports match against
-        a given table entry same order that IP addresses matched 
-        in.
-        Returns True (1) for a match and False (0) for no match
-        """        
-        if (ip_match == 'forward' and udp_A == self._fcip_table[table_ref]["udp_A"]
-            and udp_B == self._fcip_table[table_ref]["udp_B"]):
-                return True
-        elif (ip_match == 'reverse' and udp_A == self._fcip_table[table_ref]["udp_B"]
-            and udp_B == self._fcip_table[table_ref]["udp_A"]):
-                return True
-        else:
-            return False
+        #*** Key is the same for both directions of the flow:
+        _table_ref = self._fcip_index.get(self._fcip_index_key(
+                    fcip_key(IP_PROTO_UDP, _ip_A, _udp_A, _ip_B, _udp_B),
+                    classifier))
+        if _table_ref:
+            self.logger.debug("Matched a flow "
+                              "we're already classifying...")
+            return _table_ref
+        return False
 
     def _udp_fcip_add_to_existing(self, pkt, table_ref):
         """
@@ -785,28 +1176,26 @@ class StatisticalInspect(object):
         self.logger.debug("_packet_number is %s", _packet_number)        
         #*** Update number of packets:
         self._fcip_table[table_ref]["number_of_packets"] = _packet_number
-        #*** Work out directionality and add to the table:
+        #*** Work out directionality:
         _direction = self._fcip_check_ip(table_ref, _ip_A, _ip_B)
-        self._fcip_table[table_ref]["direction"][_packet_number] = _direction
         #*** This could do with improvement - would be subject to variability
         #*** due to time taken for packet to reach the controller and processing
         #*** time on the controller. But, it'll do for the moment:
-        self._fcip_table[table_ref]["arrival_time"][_packet_number] = time.time()
-        #*** Add packet size:
-        self._fcip_table[table_ref]["ip_total_length"][_packet_number] = _pkt_ip4.total_length
-        #*** Add UDP parameters like cheksum:
-        self._fcip_table[table_ref]["csum"][_packet_number] = _pkt_udp.csum
-        # self._fcip_table[table_ref]["udp_total_length"][_packet_number] = _pkt_udp.total_length -> (unnecessary)
+        _arrival_time = time.time()
+        self._fcip_table[table_ref]["time_last"] = _arrival_time
+        #*** Update the flow statistics:
+        _features = self._fcip_table[table_ref]["features"]
+        _features.update(_direction, _arrival_time, _pkt_ip4.total_length,
+                         signature=self._udp_signature(_pkt_ip4, _pkt_udp))
+        self._fcip_buffer_add(table_ref, _direction, _arrival_time,
+                              _pkt_ip4.total_length)
         if self.extra_debugging:
-            self.logger.debug("updated with packet %s: %s", 
-                              _packet_number, self._fcip_table[table_ref])
-            #*** Extra data for easy recording of statistical results for analysis charts:
-            _max_packet_size = self._calc_max_packet_size(table_ref)
-            self._fcip_table[table_ref]["max_packet_size"][_packet_number] = _max_packet_size
-            _min_interpacket_interval = self._calc_min_interpacket_interval(table_ref)
-            self._fcip_table[table_ref]["min_interpacket"][_packet_number] = _min_interpacket_interval
-            _calc_last_interpacket_interval = self._calc_last_interpacket_interval(table_ref)
-            self._fcip_table[table_ref]["last_interpacket"][_packet_number] = _calc_last_interpacket_interval
+            self.logger.debug("updated with packet %s: max_packet_size=%s "
+                              "min_interpacket=%s last_interpacket=%s",
+                              _packet_number,
+                              _features.get_max_packet_size(),
+                              _features.get_min_interpacket_interval(),
+                              _features.last_interval)
         return _packet_number
 
     def _udp_fcip_check_duplicate(self, pkt, table_ref):
@@ -816,29 +1205,29 @@ class StatisticalInspect(object):
         table row.
         Check to see if this packet is a duplicate of
         any of the packets already included in this table
-        row and if it is a duplicate return True otherwise
-        False
+        row (in constant time, see tc_features.DuplicateFilter)
+        and if it is a duplicate return True otherwise False
         """        
         _pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
         _pkt_udp = pkt.get_protocol(udp.udp)
-        #*** iterate through table row checking for duplicate values
-        for _packet_number in xrange(1, (self._fcip_table[table_ref]["number_of_packets"]+1)):
-            if (self._fcip_table[table_ref]["csum"][_packet_number] == _pkt_udp.csum):
-                if self.extra_debugging:
-                    self.logger.debug("DUPLICATE PACKET")
-                return True
+        if self._fcip_table[table_ref]["features"].is_duplicate(
+                                    self._udp_signature(_pkt_ip4, _pkt_udp)):
+            if self.extra_debugging:
+                self.logger.debug("DUPLICATE PACKET")
+            return True
         return False
 
-    def _udp_fcip_add_new(self, pkt):
+    def _udp_fcip_add_new(self, pkt, classifier=None):
         """
         Passed a packet that is a new flow and add to the
         Flow Classification In Progress (FCIP) table.
+        Passed the name of the classifier if it keeps its own
+        rows (see _fcip_index_key).
+        Returns the table reference of the new entry
         """
 
         _pkt_ip4 = pkt.get_protocol(ipv4.ipv4)
         _pkt_udp = pkt.get_protocol(udp.udp) 
-        #*** Direction for first packet is always forward:
-        self._fcip_table[self._fcip_ref]["direction"][1] = "forward"
         #*** Initial setting of variable that stops more packets being added:
         self._fcip_table[self._fcip_ref]["finalised"] = 0
         #*** Allow actions to be stored for reference on finalised flows:
@@ -848,14 +1237,22 @@ class StatisticalInspect(object):
         self._fcip_table[self._fcip_ref]["ip_B"] = _pkt_ip4.dst
         self._fcip_table[self._fcip_ref]["udp_A"] = _pkt_udp.src_port
         self._fcip_table[self._fcip_ref]["udp_B"] = _pkt_udp.dst_port        
+        self._fcip_index_add(self._fcip_index_key(fcip_key(IP_PROTO_UDP,
+                   _pkt_ip4.src, _pkt_udp.src_port, _pkt_ip4.dst,
+                   _pkt_udp.dst_port), classifier))
         #*** This could do with improvement - would be subject to variability
         #*** due to time taken for packet to reach the controller and
         #*** processing time on the controller. But, it'll do for the moment:
-        self._fcip_table[self._fcip_ref]["arrival_time"][1] = time.time()
-        #*** Add packet size:
-        self._fcip_table[self._fcip_ref]["ip_total_length"][1] = _pkt_ip4.total_length
-        #*** Add UDP parameters like checksum
-        self._fcip_table[self._fcip_ref]["csum"][1] = _pkt_udp.csum
+        _arrival_time = time.time()
+        self._fcip_table[self._fcip_ref]["time_last"] = _arrival_time
+        #*** Start accumulating flow statistics. Direction for first packet
+        #*** is always forward:
+        _features = tc_features.FlowAccumulator()
+        _features.update("forward", _arrival_time, _pkt_ip4.total_length,
+                         signature=self._udp_signature(_pkt_ip4, _pkt_udp))
+        self._fcip_table[self._fcip_ref]["features"] = _features
+        self._fcip_buffer_add(self._fcip_ref, "forward", _arrival_time,
+                              _pkt_ip4.total_length)
         #*** Number of packets is 1 as this is the first packet in the flow:
         self._fcip_table[self._fcip_ref]["number_of_packets"] = 1
         if self.extra_debugging:
@@ -863,117 +1260,15 @@ class StatisticalInspect(object):
                                self._fcip_table[self._fcip_ref])
         #*** increment table ref ready for next time we use it:
         self._fcip_ref += 1
+        return self._fcip_ref - 1
 
-    def _udp_calc_max_packet_size(self, table_ref):
-        """
-        Review packet sizes in a flow and return the largest one
-        for each direction
-        """
-        _max_size = nmisc.AutoVivification()
-        _max_size['forward'] = 0
-        _max_size['reverse'] = 0
-        for _packet_number in self._fcip_table[table_ref]["ip_total_length"]:
-            _size = self._fcip_table[table_ref]["ip_total_length"][_packet_number]
-            _direction = self._fcip_table[table_ref]["direction"][_packet_number]
-            if _size > _max_size[_direction]:
-                _max_size[_direction] = _size
-        _max_size['both'] = max(list(_max_size.values()))
-        return _max_size
-
-    def _udp_calc_max_interpacket_interval(self, table_ref):
-        """
-        Review packet arrival times for each direction in 
-        a flow and return the size of the largest inter-
-        packet interval (from either direction) in seconds
-        """
-        _max_interpacket = nmisc.AutoVivification()
-        _max_interpacket['forward'] = 0
-        _max_interpacket['reverse'] = 0
-        _previous_reverse = 0
-        _previous_forward = 0
-        for _packet_number in self._fcip_table[table_ref]["arrival_time"]:
-            _arrival_time = self._fcip_table[table_ref]["arrival_time"][_packet_number]
-            _direction = self._fcip_table[table_ref]["direction"][_packet_number]
-            if _direction == 'forward' and _previous_forward:
-                _interpacket_interval = _arrival_time - _previous_forward
-                if not _max_interpacket['forward']:
-                    _max_interpacket['forward'] = _interpacket_interval
-                elif _interpacket_interval > _max_interpacket['forward']:
-                    _max_interpacket['forward'] = _interpacket_interval
-                else:
-                    #*** nothing to see here, move on
-                    pass
-                _previous_forward = _arrival_time
-            elif _direction == 'reverse' and _previous_reverse:
-                _interpacket_interval = _arrival_time - _previous_reverse
-                if not _max_interpacket['reverse']:
-                    _max_interpacket['reverse'] = _interpacket_interval
-                elif _interpacket_interval > _max_interpacket['reverse']:
-                    _max_interpacket['reverse'] = _interpacket_interval
-                else:
-                    #*** nothing to see here, move on
-                    pass
-                _previous_reverse = _arrival_time
-            elif _direction == 'forward':
-                #*** First time we've seen a forward packet so set previous for next time
-                _previous_forward = _arrival_time
-            elif _direction == 'reverse':
-                #*** First time we've seen a reverse packet so set previous for next time
-                _previous_reverse = _arrival_time
-            else:
-                #*** should never hit this...
-                self.logger.error("Strange condition encountered")
-        if not _max_interpacket:
-            return 0
-        else:
-            _max_interpacket['both'] = max(list(_max_interpacket.values()))
-            return _max_interpacket
-
-    def _udp_calc_min_interpacket_interval(self, table_ref):
-        """
-        Review packet arrival times for each direction in 
-        a flow and return the size of the smallest inter-
-        packet interval (from either direction) in seconds
-        """
-        _min_interpacket = nmisc.AutoVivification()
-        _min_interpacket['forward'] = 0
-        _min_interpacket['reverse'] = 0
-        _previous_reverse = 0
-        _previous_forward = 0
-        for _packet_number in self._fcip_table[table_ref]["arrival_time"]:
-            _arrival_time = self._fcip_table[table_ref]["arrival_time"][_packet_number]
-            _direction = self._fcip_table[table_ref]["direction"][_packet_number]
-            if _direction == 'forward' and _previous_forward:
-                _interpacket_interval = _arrival_time - _previous_forward
-                if not _min_interpacket['forward']:
-                    _min_interpacket['forward'] = _interpacket_interval
-                elif _interpacket_interval < _min_interpacket['forward']:
-                    _min_interpacket['forward'] = _interpacket_interval
-                else:
-                    #*** nothing to see here, move on
-                    pass
-                _previous_forward = _arrival_time
-            elif _direction == 'reverse' and _previous_reverse:
-                _interpacket_interval = _arrival_time - _previous_reverse
-                if not _min_interpacket['reverse']:
-                    _min_interpacket['reverse'] = _interpacket_interval
-                elif _interpacket_interval < _min_interpacket['reverse']:
-                    _min_interpacket['reverse'] = _interpacket_interval
-                else:
-                    #*** nothing to see here, move on
-                    pass
-                _previous_reverse = _arrival_time
-            elif _direction == 'forward':
-                #*** First time we've seen a forward packet so set previous for next time
-                _previous_forward = _arrival_time
-            elif _direction == 'reverse':
-                #*** First time we've seen a reverse packet so set previous for next time
-                _previous_reverse = _arrival_time
-            else:
-                #*** should never hit this...
-                self.logger.error("Strange condition encountered")
-        if not _min_interpacket:
-            return 0
-        else:
-            _min_interpacket['both'] = min(list(_min_interpacket.values()))
-            return _min_interpacket
+def fcip_key(proto, ip_A, port_A, ip_B, port_B):
+    """
+    Passed an IP protocol number and the source and destination IP
+    addresses and ports of a packet and return a canonical key for
+    the flow that is the same for packets in either direction.
+    Direction of a packet is worked out against the row's ip_A/ip_B
+    """
+    if (ip_A, port_A) <= (ip_B, port_B):
+        return (proto, ip_A, port_A, ip_B, port_B)
+    return (proto, ip_B, port_B, ip_A, port_A)
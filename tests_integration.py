@@ -3,11 +3,35 @@ Nmeta Integration Tests
 .
 To run, type in nosetests in the nmeta directory
 """
+import time
+import os
+import json
+import tempfile
+import shutil
+import struct
+import socket
+
+import dpkt
+
 from ryu.ofproto import ether
-from ryu.lib.packet import ethernet, arp, packet, ipv4, tcp
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+from ryu.controller import ofp_event
+from ryu.app.wsgi import WSGIApplication
+from ryu.lib.packet import ethernet, arp, packet, ipv4, ipv6, tcp, udp
+from ryu.lib import hub
 
 #*** nmeta imports:
+import nmeta
 import tc_policy
+import tc_batch
+import flow
+import tc_identity
+import persist
+import tc_counters
+import tc_async
+import tc_model
+import switch_abstraction
+import qos
 import measure
 import config
 
@@ -28,6 +52,8 @@ conditions_all_mac = {'match_type': 'all', 'eth_src': '08:60:6e:7f:74:e7',
 conditions_any_ip = {'match_type': 'any', 'ip_dst': '192.168.57.12',
                          'ip_src': '192.168.56.32'}
 conditions_any_ssh = {'match_type': 'any', 'tcp_src': 22, 'tcp_dst': 22}
+conditions_all_ssh = {'match_type': 'all', 'ip_src': '10.0.0.1',
+                         'tcp_dst': 22}
 
 conditions_rule_nested_1 = {'comment': 'Audit Division SSH traffic', 
     'conditions_list': [{'match_type': 'any', 'tcp_src': 22, 'tcp_dst': 22}, 
@@ -71,6 +97,10 @@ def test_tc_check_conditions():
                              results_dict_match
     assert tc._check_conditions(pkt_arp, conditions_all_mac, ctx) == \
                              results_dict_no_match
+    assert tc._check_conditions(pkt_tcp_22, conditions_all_ssh, ctx) == \
+                             results_dict_match
+    assert tc._check_conditions(pkt_arp, conditions_all_ssh, ctx) == \
+                             results_dict_no_match
 
 #*** Test TC packet match against a rule stanza:
 def test_tc_check_rule():
@@ -85,6 +115,571 @@ def test_tc_check_rule():
     assert tc._check_rule(pkt_tcp_22, conditions_rule_nested_2, ctx) == \
                              results_dict_no_match
 
+#*** Test policy evaluation counters:
+def test_tc_policy_stats():
+    pkt_tcp_22 = build_packet_tcp_22()
+    tc.reset_policy_stats()
+    tc.check_policy(pkt_tcp_22, 1, 1)
+    rule_stats = tc.get_policy_stats()['rules'][0]
+    assert rule_stats['evaluations'] == 1
+    assert rule_stats['matches'] == 0
+    assert rule_stats['conditions'][0]['tcp_src']['evaluations'] == 1
+    assert rule_stats['conditions'][0]['tcp_dst']['evaluations'] == 1
+    assert rule_stats['conditions'][0]['tcp_dst']['matches'] == 0
+    tc.reset_policy_stats()
+    assert tc.get_policy_stats()['rules'][0]['evaluations'] == 0
+
+#*** Test batch classification agrees with per-packet classification:
+def test_tc_batch_classify():
+    pkts = [build_packet_ARP(), build_packet_tcp_22(),
+            build_packet_tcp_6633()]
+    batch = tc_batch.BatchClassify(_config, tc)
+    rule_index, actions = batch.classify(tc_batch.packets_to_headers(pkts))
+    assert rule_index[2] == 0
+    for idx, pkt in enumerate(pkts):
+        if rule_index[idx] == tc_batch.RULE_UNDETERMINED:
+            continue
+        result = tc.check_policy(pkt, 1, 1)
+        assert result['match'] == (rule_index[idx] >= 0)
+        assert result['actions'] == actions[idx]
+
+#*** Test DHCP REQUEST and ACK packets are harvested by check_policy:
+def test_tc_check_policy_dhcp():
+    saved_dhcp = tc._main_policy['identity']['dhcp']
+    saved_queue_max = tc.identity_queue_max
+    tc._main_policy['identity']['dhcp'] = 1
+    tc.identity_queue_max = 0
+    try:
+        tc.check_policy(build_packet_dhcp(dpkt.dhcp.DHCPREQUEST,
+                    [(dpkt.dhcp.DHCP_OPT_HOSTNAME, 'host11')]), 1, 1)
+        tc.check_policy(build_packet_dhcp(dpkt.dhcp.DHCPACK,
+                    [(dpkt.dhcp.DHCP_OPT_LEASE_SEC,
+                      struct.pack('!I', 3600))]), 1, 2)
+        node = tc.identity.id_ip['default']['10.0.0.11']['node']
+        assert node['host11']['mac'] == '00:00:00:00:00:0b'
+        assert node['host11']['lease'] == 3600
+    finally:
+        tc._main_policy['identity']['dhcp'] = saved_dhcp
+        tc.identity_queue_max = saved_queue_max
+
+#*** Test identity table indexes stay in step with the tables:
+def test_identity_table_indexes():
+    identity = tc.identity
+    identity._set_sys_record_new_chassisid('00:00:00:00:00:99', 'sw99',
+                                           '00:00:00:00:00:01', '10.0.0.1',
+                                           1, 1)
+    sys_ref = identity._get_sys_ref_by_chassisid('00:00:00:00:00:99')
+    nic_ref = identity._get_nic_ref_by_MAC('00:00:00:00:00:01')
+    assert sys_ref
+    assert nic_ref == identity._get_sys_nic_ref(sys_ref)
+    assert identity._get_sys_ref_by_systemname('identity_lldp_systemname',
+                                                   'sw99') == sys_ref
+    #*** Age the records out and check the indexes follow:
+    identity._sys_identity_table[sys_ref]['time_last'] = 1
+    identity._nic_identity_table[nic_ref]['time_last'] = 1
+    identity.maintain_identity_tables()
+    assert identity._get_sys_ref_by_chassisid('00:00:00:00:00:99') == 0
+    assert identity._get_nic_ref_by_MAC('00:00:00:00:00:01') == 0
+    assert identity._get_sys_ref_by_systemname('identity_lldp_systemname',
+                                                   'sw99') == 0
+
+#*** Test flows pick up identity changes without a rebuild:
+class _FlowParent(object):
+    """
+    Stands in for the nmeta module as parent of FlowMetadata
+    """
+    tc_policy = tc
+
+def test_flow_identity_incremental():
+    flowmetadata = flow.FlowMetadata(_FlowParent(), _config)
+    tc.identity.register_ip_change_callback(flowmetadata.identity_changed)
+    flowmetadata._fm_add_new(build_packet_tcp_22(), {})
+    fm_flow = flowmetadata.get_fm_table()[1]
+    assert 'ip_B_services' not in fm_flow
+    tc.identity._set_ip_service(ctx, '10.0.0.2', 'ssh.example.com', 300,
+                                'dns')
+    assert 'ssh.example.com' in fm_flow['ip_B_services']
+    #*** Further services are seen through the same reference:
+    tc.identity._set_ip_service(ctx, '10.0.0.2', 'git.example.com', 300,
+                                'dns')
+    assert 'git.example.com' in fm_flow['ip_B_services']
+    tc.identity._del_id_ip_service(ctx, '10.0.0.2', 'ssh.example.com')
+    tc.identity._del_id_ip_service(ctx, '10.0.0.2', 'git.example.com')
+    assert 'ip_B_services' not in fm_flow
+    tc.identity._ip_change_callbacks.remove(flowmetadata.identity_changed)
+
+#*** Test identity state survives a restart through snapshot and journal:
+def test_identity_persist():
+    directory = tempfile.mkdtemp()
+    try:
+        identity = tc_identity.IdentityInspect(_config)
+        persister = persist.IdentityPersist(_config, identity)
+        persister.directory = directory
+        persister.restore()
+        persister._open_journal()
+        identity.journal = persister.journal
+        identity._set_ip_service(ctx, '10.0.0.9', 'a.example.com', 300, 'dns')
+        identity._set_ip_service(ctx, '10.0.0.9', 'gone.example.com', 1,
+                                 'dns', time.time() - 10)
+        identity.arp_reply_in('10.0.0.9', '00:00:00:00:00:09', ctx)
+        nic_ref = identity._set_nic_record_new('00:00:00:00:00:09',
+                                               '10.0.0.9', 1, 3)
+        persister.snapshot()
+        #*** Updates after the snapshot are recovered from the journal:
+        identity._set_service_cname(ctx, 'cdn.example.net', 'b.example.com',
+                                    300)
+        identity.dhcp_in('00:00:00:00:00:09', '10.0.0.9', 'host9', ctx)
+        persister.flush_journal()
+        #*** Files are JSON lines, and a partly written record ends a
+        #*** journal:
+        with open(os.path.join(directory, persist.SNAPSHOT_FILENAME)) as f:
+            records = [json.loads(line) for line in f]
+        assert records[0]['generation'] == persister._generation
+        assert ['nic', nic_ref] in [record[:2] for record in records[1:]]
+        persister._journal_file.write('["arp", "')
+        persister._journal_file.flush()
+        #*** Recover into a fresh identity instance:
+        identity2 = tc_identity.IdentityInspect(_config)
+        persister2 = persist.IdentityPersist(_config, identity2)
+        persister2.directory = directory
+        recovery = persister2.restore()
+        assert recovery['expired'] == 1
+        services = identity2.id_ip[ctx]['10.0.0.9']['service']
+        assert 'a.example.com' in services
+        assert 'gone.example.com' not in services
+        assert 'host9' in identity2.id_ip[ctx]['10.0.0.9']['node']
+        assert '10.0.0.9' in identity2.id_mac[ctx]['00:00:00:00:00:09']['ip']
+        assert 'b.example.com' in \
+                    identity2.id_service[ctx]['cdn.example.net']['domain']
+        assert identity2.get_service_ips(ctx, 'a.example.com').keys() == \
+                                                               ['10.0.0.9']
+        assert identity2._nic_identity_table[nic_ref]['inport'] == 3
+        assert identity2._get_nic_ref_by_MAC('00:00:00:00:00:09') == nic_ref
+    finally:
+        shutil.rmtree(directory)
+
+#*** Test identity harvesting is queued and applied by the worker:
+def test_identity_queue():
+    saved_queue_max = tc.identity_queue_max
+    tc.identity_queue_max = 1
+    try:
+        #*** Drain anything queued by earlier tests:
+        while tc.identity_queue.qsize():
+            tc.identity_queue.get()
+        stats = tc.get_identity_queue_stats()
+        tc.check_policy(build_packet_tcp_22(), 1, 1)
+        tc.check_policy(build_packet_tcp_22(), 1, 1)
+        stats2 = tc.get_identity_queue_stats()
+        assert stats2['backlog'] == 1
+        assert stats2['enqueued'] == stats['enqueued'] + 1
+        assert stats2['dropped'] == stats['dropped'] + 1
+        record = tc.identity_queue.get()
+        assert record == ('ip4_in', '00:00:00:00:00:01', '10.0.0.1')
+        tc.process_identity_record(record)
+        #*** Records that fail are counted as errors, not as processed:
+        tc.identity_queue.put(record)
+        tc.identity_queue.put(('no_such_method',))
+        worker = hub.spawn(tc.identity_worker)
+        for _ in range(100):
+            hub.sleep(0.01)
+            if not tc.identity_queue.qsize():
+                break
+        hub.kill(worker)
+        stats3 = tc.get_identity_queue_stats()
+        assert stats3['processed'] == stats2['processed'] + 1
+        assert stats3['errors'] == stats2['errors'] + 1
+    finally:
+        tc.identity_queue_max = saved_queue_max
+
+#*** Test FCIP lookups are indexed on a bidirectional 5-tuple:
+def test_statistical_fcip_index():
+    statistical = tc.statistical
+    #*** Raw features are only kept when turned on:
+    statistical._fcip_add_new(build_packet_tcp('10.1.0.1', '10.1.0.2',
+                                               999, 80, 0))
+    assert not 'packets' in statistical._fcip_table[statistical._fcip_check(
+                build_packet_tcp('10.1.0.1', '10.1.0.2', 999, 80, 0))]
+    saved_buffer_packets = statistical.fcip_buffer_packets
+    statistical.fcip_buffer_packets = 5
+    try:
+        for port in range(1000, 1100):
+            statistical._fcip_add_new(build_packet_tcp('10.1.0.1',
+                                                '10.1.0.2', port, 80, 0))
+        table_ref = statistical._fcip_check(build_packet_tcp('10.1.0.1',
+                                                  '10.1.0.2', 1050, 80, 0))
+        assert statistical._fcip_add_to_existing(build_packet_tcp('10.1.0.2',
+                                         '10.1.0.1', 80, 1050, 1), table_ref) == 2
+    finally:
+        statistical.fcip_buffer_packets = saved_buffer_packets
+    assert table_ref
+    #*** Reverse direction maps to the same row:
+    assert statistical._fcip_check(build_packet_tcp('10.1.0.2', '10.1.0.1',
+                                                   80, 1050, 1)) == table_ref
+    assert statistical._fcip_table[table_ref]['features'].packets_dir == \
+                                            {'forward': 1, 'reverse': 1}
+    assert statistical._fcip_table[table_ref]['packets'].column(
+                                    'directions') == ['forward', 'reverse']
+    assert not statistical._fcip_check(build_packet_tcp('10.1.0.1',
+                                                  '10.1.0.2', 1050, 81, 0))
+    #*** Aged rows are removed from the index too:
+    statistical.maintain_fcip_table(-1)
+    assert not statistical._fcip_check(build_packet_tcp('10.1.0.1',
+                                                  '10.1.0.2', 1050, 80, 0))
+    assert not statistical._fcip_index
+
+class _Datapath(object):
+    """
+    Stands in for a Ryu datapath where only the dpid is used
+    """
+    id = 1
+
+#*** Test flows are re-marked from their counters:
+def test_counter_classify():
+    counters = tc_counters.CounterClassify(_config,
+                      switch_abstraction.SwitchAbstract(_config),
+                      qos.QoS(_config))
+    #*** Flows are noted by the statistical classifier in counter mode:
+    saved_counter_mode = tc.statistical.counter_mode
+    tc.statistical.counter_mode = 1
+    try:
+        result = tc.statistical.check_statistical(
+                       'statistical_qos_bandwidth_1', 1, build_packet_tcp_22())
+        assert not result['continue_to_inspect']
+        assert tc.statistical.pop_counter_request(build_packet_tcp_22())
+        assert not tc.statistical.pop_counter_request(build_packet_tcp_22())
+    finally:
+        tc.statistical.counter_mode = saved_counter_mode
+    cookie = counters.new_cookie()
+    flow_record = counters.add_flow(_Datapath(), cookie, 2, 1)
+    #*** Small packets don't make a hog, however fast:
+    assert counters.update_flow(flow_record, 10000, 640000, 1.0) is None
+    assert flow_record['interval'] == 2
+    #*** Big packets at a high rate do:
+    assert counters.update_flow(flow_record, 12000, 3640000, 2.0) == 3
+    assert flow_record['interval'] == 1
+    flow_record['out_queue'] = 3
+    #*** And back to the original queue when the rate drops:
+    assert counters.update_flow(flow_record, 12010, 3655000, 3.0) == 1
+
+#*** Test the trained model classifier scores flows in a batch and that
+#*** the model can be swapped:
+def test_model_classify():
+    model = tc.statistical.model
+    assert model.load_model(os.path.join(os.path.dirname(__file__),
+                                'config', 'examples', 'statistical_model.json'))
+    for ack in range(5):
+        result = tc.statistical.check_statistical('statistical_model', 1,
+                   build_packet_tcp('10.2.0.1', '10.2.0.2', 2000, 80, ack))
+    assert not result['continue_to_inspect']
+    assert tc.statistical.score_model_batch() == 1
+    result = tc.statistical.check_statistical('statistical_model', 1,
+                   build_packet_tcp('10.2.0.1', '10.2.0.2', 2000, 80, 5))
+    assert result['actions'] == \
+                    {'set_qos_tag': 'QoS_treatment=default_priority'}
+    #*** Flows inspected by another classifier too are scored:
+    for ack in range(5):
+        packet_tcp = build_packet_tcp('10.2.0.1', '10.2.0.2', 2001, 80, ack)
+        tc.statistical.check_statistical('statistical_qos_bandwidth_1', 1,
+                                         packet_tcp)
+        result = tc.statistical.check_statistical('statistical_model', 1,
+                                                  packet_tcp)
+    assert not result['continue_to_inspect']
+    assert tc.statistical.score_model_batch() == 1
+    #*** Only IPv4 is classified:
+    packet_tcp6 = packet.Packet()
+    packet_tcp6.add_protocol(ethernet.ethernet(dst='00:00:00:00:00:02',
+                      src='00:00:00:00:00:01', ethertype=ether.ETH_TYPE_IPV6))
+    packet_tcp6.add_protocol(ipv6.ipv6(src='2001:db8::1', dst='2001:db8::2',
+                      nxt=6))
+    packet_tcp6.add_protocol(tcp.tcp(src_port=2000, dst_port=80))
+    packet_tcp6.serialize()
+    result = tc.statistical.check_statistical('statistical_model', 1,
+                                              packet_tcp6)
+    assert not result['continue_to_inspect']
+    #*** Vectors are scored together:
+    assert model.classify([[1500, 0.1], [1500, 0.5], [100, 0.1]]) == \
+                    [{'set_qos_tag': 'QoS_treatment=low_priority'},
+                     {'set_qos_tag': 'QoS_treatment=default_priority'},
+                     {'set_qos_tag': 'QoS_treatment=default_priority'}]
+    directory = tempfile.mkdtemp()
+    try:
+        model_file = os.path.join(directory, 'model.json')
+        with open(model_file, 'w') as model_json:
+            json.dump({'type': 'logistic', 'features': ['max_size'],
+                       'weights': [0.01], 'bias': -10,
+                       'actions': [{'set_qos_tag': 'QoS_treatment=high_priority'},
+                               {'set_qos_tag': 'QoS_treatment=low_priority'}]},
+                      model_json)
+        assert model.load_model(model_file)
+        assert model.classify([[500], [1500]]) == \
+                    [{'set_qos_tag': 'QoS_treatment=high_priority'},
+                     {'set_qos_tag': 'QoS_treatment=low_priority'}]
+        #*** A bad model doesn't replace the one in use:
+        with open(model_file, 'w') as model_json:
+            json.dump({'type': 'logistic', 'features': ['no_such_feature'],
+                       'weights': [1], 'actions': [{}, {}]}, model_json)
+        assert not model.load_model(model_file)
+        assert model.model['features'] == ['max_size']
+    finally:
+        shutil.rmtree(directory)
+        model.model = None
+
+#*** Test flows to a server skip inspection once verdicts agree:
+def test_verdict_cache():
+    statistical = tc.statistical
+    saved = (statistical.verdict_cache_agree, statistical.verdict_cache_sample)
+    statistical.verdict_cache_agree = 2
+    statistical.verdict_cache_sample = 3
+    default_priority = {'set_qos_tag': 'QoS_treatment=default_priority'}
+    try:
+        for port in (3000, 3001):
+            for ack in range(5):
+                result = statistical.check_statistical(
+                    'statistical_qos_bandwidth_1', 1,
+                    build_packet_tcp('10.3.0.1', '10.3.0.2', port, 443, ack))
+            assert result['actions'] == default_priority
+        #*** New flows to the server get the verdict straight away:
+        for port in (3002, 3003):
+            result = statistical.check_statistical(
+                    'statistical_qos_bandwidth_1', 1,
+                    build_packet_tcp('10.3.0.1', '10.3.0.2', port, 443, 0))
+            assert not result['continue_to_inspect']
+            assert result['actions'] == default_priority
+        #*** Later packets of a flow, in either direction, get the verdict
+        #*** from its FCIP row without hitting the cache again:
+        hits = statistical.get_verdict_cache_stats()['hits']
+        entries = statistical.get_verdict_cache_stats()['entries']
+        result = statistical.check_statistical(
+                    'statistical_qos_bandwidth_1', 1,
+                    build_packet_tcp('10.3.0.2', '10.3.0.1', 443, 3003, 1))
+        assert result['actions'] == default_priority
+        result = statistical.check_statistical(
+                    'statistical_qos_bandwidth_1', 1,
+                    build_packet_tcp('10.3.0.1', '10.3.0.2', 3003, 443, 2))
+        assert result['actions'] == default_priority
+        assert statistical.get_verdict_cache_stats()['hits'] == hits
+        assert statistical.get_verdict_cache_stats()['entries'] == entries
+        #*** Except samples, which are inspected:
+        result = statistical.check_statistical(
+                    'statistical_qos_bandwidth_1', 1,
+                    build_packet_tcp('10.3.0.1', '10.3.0.2', 3004, 443, 0))
+        assert result['continue_to_inspect']
+        #*** Other servers aren't affected:
+        result = statistical.check_statistical(
+                    'statistical_qos_bandwidth_1', 1,
+                    build_packet_tcp('10.3.0.1', '10.3.0.3', 3000, 443, 0))
+        assert result['continue_to_inspect']
+        stats = statistical.get_verdict_cache_stats()
+        assert stats['hits'] >= 2
+        assert stats['samples'] >= 1
+    finally:
+        statistical.verdict_cache_agree, statistical.verdict_cache_sample = \
+                                                                    saved
+
+#*** Test sequential classification decides early when the evidence
+#*** is strong enough:
+def test_sequential_classify():
+    statistical = tc.statistical
+    policy_value = 'sprt alpha=0.05 beta=0.05 max_packets=5'
+    params = statistical._sequential_params(policy_value)
+    assert params['max_packets'] == 5
+    assert round(params['upper'], 3) == 2.944
+    assert not statistical._sequential_params(True)
+    assert not statistical._sequential_params('sprt alpha=2')
+    #*** Small packets are evidence of an interactive flow:
+    for ack in range(3):
+        result = statistical.check_statistical('statistical_qos_bandwidth_1',
+                    policy_value,
+                    build_packet_tcp('10.4.0.1', '10.4.0.2', 4000, 22, ack))
+        if not result['continue_to_inspect']:
+            break
+    assert ack == 1
+    assert result['actions'] == \
+                    {'set_qos_tag': 'QoS_treatment=default_priority'}
+    assert result['confidence'] > 0.95
+    stats = statistical.get_decision_stats()['statistical_qos_bandwidth_1']
+    assert stats['histogram'][2] >= 1
+
+#*** Test jobs are classified in worker processes and fall back when
+#*** they can't be:
+def test_async_classify():
+    flowmetadata = flow.FlowMetadata(_FlowParent(), _config)
+    async_classify = tc_async.AsyncClassify(_config,
+                      switch_abstraction.SwitchAbstract(_config), flowmetadata)
+    model = tc.statistical.model
+    assert model.load_model(os.path.join(os.path.dirname(__file__),
+                                'config', 'examples', 'statistical_model.json'))
+    verdicts = {}
+    def callback(keys, results):
+        verdicts.update(zip(keys, results))
+    #*** No workers so classify inline:
+    assert not async_classify.submit(['a'], tc_model.classify_vectors,
+                        ([[1500, 0.1]],), callback, (('model', model.model),))
+    async_classify.enabled = 1
+    async_classify.start_workers()
+    try:
+        assert async_classify.running()
+        assert async_classify.submit(['a'], tc_model.classify_vectors,
+                        ([[1500, 0.1]],), callback, (('model', model.model),))
+        assert async_classify.submit(['b'], tc_model.classify_vectors,
+                        ([[100, 0.1]],), callback, (('model', model.model),))
+        #*** The model is sent to the worker once for both jobs:
+        assert async_classify._workers[0]['shared']['model'] is model.model
+        for _ in range(500):
+            async_classify.poll()
+            if len(verdicts) == 2:
+                break
+            time.sleep(0.01)
+        assert verdicts == {
+                    'a': {'set_qos_tag': 'QoS_treatment=low_priority'},
+                    'b': {'set_qos_tag': 'QoS_treatment=default_priority'}}
+        #*** Verdict waits for its flow entry, which keeps its queue:
+        queue = qos.QoS(_config).check_policy(verdicts['b'])
+        async_classify.add_flow('b', build_packet_tcp_22(), _Datapath(), 1,
+                                2, queue)
+        assert 'b' not in async_classify._verdicts
+        #*** Jobs that take too long get the fallback verdict:
+        async_classify.timeout = 0.1
+        assert async_classify.submit(['c'], time.sleep, (5,), callback)
+        time.sleep(0.2)
+        async_classify.poll()
+        assert verdicts['c'] == async_classify.fallback
+        assert async_classify.stats['timeouts'] == 1
+        assert len(async_classify._workers) == 1
+        #*** As do jobs that there is no room to queue:
+        async_classify.max_pending = 0
+        assert async_classify.submit(['d'], time.sleep, (5,), callback)
+        assert verdicts['d'] == async_classify.fallback
+        assert async_classify.get_async_stats()['rejected'] == 1
+    finally:
+        async_classify.stop_workers()
+        model.model = None
+
+#*** Packet-in handler tests:
+class _Datapath13(object):
+    """
+    Stands in for an OpenFlow 1.3 Ryu datapath, keeping the messages
+    sent to it
+    """
+    id = 1
+    ofproto = ofproto_v1_3
+    ofproto_parser = ofproto_v1_3_parser
+
+    def __init__(self):
+        self.sent = []
+
+    def send_msg(self, msg):
+        self.sent.append(msg)
+
+def build_packet_in(datapath, pkt, in_port=1, table_id=0):
+    """
+    Build a packet-in event for a packet from an OpenFlow 1.3 switch
+    """
+    msg = ofproto_v1_3_parser.OFPPacketIn(datapath,
+                buffer_id=ofproto_v1_3.OFP_NO_BUFFER, total_len=len(pkt.data),
+                reason=ofproto_v1_3.OFPR_NO_MATCH, table_id=table_id,
+                match=ofproto_v1_3_parser.OFPMatch(in_port=in_port),
+                data=pkt.data)
+    return ofp_event.EventOFPPacketIn(msg)
+
+def build_nmeta():
+    """
+    Build an nmeta app with forwarding that knows the destination MAC
+    of build_packet_tcp packets is on port 2
+    """
+    app = nmeta.NMeta(wsgi=WSGIApplication())
+    app.forwarding.mac_to_port[1] = {'00:00:00:00:00:02': 2}
+    return app
+
+#*** Test forwarding table misses for proactively classified traffic
+#*** aren't classified again:
+def test_packet_in_proactive_miss():
+    app = build_nmeta()
+    app.proactive_static_rules = 1
+    datapath = _Datapath13()
+    app._packet_in_handler(build_packet_in(datapath,
+                build_packet_tcp('10.5.0.1', '10.5.0.2', 5000, 80, 0),
+                table_id=nmeta.PROACTIVE_FORWARDING_TABLE))
+    assert not app.flowmetadata.get_fm_table()
+    flow_mod, packet_out = datapath.sent
+    assert flow_mod.table_id == nmeta.PROACTIVE_FORWARDING_TABLE
+    assert flow_mod.match['eth_dst'] == '00:00:00:00:00:02'
+    assert packet_out.actions[0].port == 2
+    #*** Table-miss packet-ins from table 0 are classified:
+    app._packet_in_handler(build_packet_in(datapath,
+                build_packet_tcp('10.5.0.1', '10.5.0.2', 5001, 80, 0)))
+    assert len(app.flowmetadata.get_fm_table()) == 1
+
+#*** Test flow entries of flows scored by workers are given a cookie on
+#*** their first packet and re-marked when the verdict arrives:
+def test_packet_in_async_remark():
+    check_packet_in_async_remark(lambda index: build_packet_tcp('10.6.0.1',
+                                            '10.6.0.2', 5000, 80, index))
+
+#*** Same for UDP flows, which get coarser flow entries:
+def test_packet_in_async_remark_udp():
+    check_packet_in_async_remark(lambda index: build_packet_udp('10.6.0.3',
+                                            '10.6.0.4', 5000, 5060, index))
+
+def check_packet_in_async_remark(build_packet):
+    """
+    Passed a function that builds the packets of a flow by index, send
+    the flow through the packet-in handler with a model scored in a
+    worker and check its flow entries are re-marked by cookie
+    """
+    app = build_nmeta()
+    saved_ruleset = app.tc_policy.tc_ruleset
+    app.tc_policy.tc_ruleset = [{'comment': 'Trained model',
+                    'match_type': 'any',
+                    'conditions_list': [{'match_type': 'any',
+                                         'statistical_model': 'on'}],
+                    'actions': {'pass_return_tags': True}}]
+    app.tc_policy.reset_policy_stats()
+    app.tc_policy.compile_condition_order()
+    app.tc_policy.compile_static_rules()
+    directory = tempfile.mkdtemp()
+    try:
+        #*** A model that always says low priority (queue 3):
+        model_file = os.path.join(directory, 'model.json')
+        with open(model_file, 'w') as model_json:
+            json.dump({'type': 'logistic', 'features': ['max_size'],
+                       'weights': [0], 'bias': 10,
+                       'actions': [
+                           {'set_qos_tag': 'QoS_treatment=default_priority'},
+                           {'set_qos_tag': 'QoS_treatment=low_priority'}]},
+                      model_json)
+        assert app.tc_policy.statistical.model.load_model(model_file)
+        app.async_classify.enabled = 1
+        app.async_classify.start_workers()
+        app.tc_policy.statistical.async_classify = app.async_classify
+        datapath = _Datapath13()
+        app._packet_in_handler(build_packet_in(datapath, build_packet(0)))
+        cookie = datapath.sent[0].cookie
+        assert cookie
+        key = app.tc_policy.statistical.get_deferred_flow(build_packet(0))
+        assert app.async_classify.flow_cookie(key) == cookie
+        #*** Later packets of the flow reuse the cookie:
+        for index in range(1, 5):
+            app._packet_in_handler(build_packet_in(datapath,
+                                                   build_packet(index)))
+        assert [msg.cookie for msg in datapath.sent
+                    if msg.__class__.__name__ == 'OFPFlowMod'] == [cookie] * 5
+        assert app.tc_policy.statistical.score_model_batch() == 1
+        for _ in range(500):
+            app.async_classify.poll()
+            if app.async_classify.stats['remarked']:
+                break
+            time.sleep(0.01)
+        assert app.async_classify.stats['remarked'] == 1
+        flow_mod = datapath.sent[-1]
+        assert flow_mod.command == ofproto_v1_3.OFPFC_MODIFY
+        assert flow_mod.cookie == cookie
+        assert flow_mod.instructions[0].actions[0].queue_id == 3
+    finally:
+        app.async_classify.stop_workers()
+        app.tc_policy.tc_ruleset = saved_ruleset
+        shutil.rmtree(directory)
+
 #*** Test Rate Measure Functions:
 def test_measure_rate():
     measure.record_rate_event('rate_test')
@@ -122,6 +717,91 @@ def build_packet_ARP():
     print repr(p.data)  # the on-wire packet
     return p
 
+def build_packet_tcp_6633():
+    """
+    Build an OpenFlow-like packet for use in tests.
+    """
+    e = ethernet.ethernet(dst='00:00:00:00:00:02',
+                      src='00:00:00:00:00:01',
+                      ethertype=2048)
+    i = ipv4.ipv4(version=4, header_length=5, tos=0, total_length=0,
+                    identification=0, flags=0, offset=0, ttl=255, proto=6,
+                    csum=0, src='10.0.0.1', dst='10.0.0.2', option=None)
+    t = tcp.tcp(src_port=41002, dst_port=6633, seq=1, ack=0, offset=5,
+                      bits=2, window_size=29200, csum=0, urgent=0, option=None)
+    p = packet.Packet()
+    p.add_protocol(e)
+    p.add_protocol(i)
+    p.add_protocol(t)
+    p.serialize()
+    return p
+
+def build_packet_tcp(ip_src, ip_dst, tcp_src, tcp_dst, ack):
+    """
+    Build a TCP packet between given addresses and ports for use in tests.
+    """
+    e = ethernet.ethernet(dst='00:00:00:00:00:02',
+                      src='00:00:00:00:00:01',
+                      ethertype=2048)
+    i = ipv4.ipv4(version=4, header_length=5, tos=0, total_length=0,
+                    identification=0, flags=0, offset=0, ttl=255, proto=6,
+                    csum=0, src=ip_src, dst=ip_dst, option=None)
+    t = tcp.tcp(src_port=tcp_src, dst_port=tcp_dst, seq=1, ack=ack, offset=5,
+                      bits=16, window_size=29200, csum=0, urgent=0, option=None)
+    p = packet.Packet()
+    p.add_protocol(e)
+    p.add_protocol(i)
+    p.add_protocol(t)
+    p.serialize()
+    return p
+
+def build_packet_udp(ip_src, ip_dst, udp_src, udp_dst, index):
+    """
+    Build a UDP packet between given addresses and ports for use in tests.
+    The index is used as the IP identification
+    """
+    e = ethernet.ethernet(dst='00:00:00:00:00:02',
+                      src='00:00:00:00:00:01',
+                      ethertype=2048)
+    i = ipv4.ipv4(version=4, header_length=5, tos=0, total_length=0,
+                    identification=index, flags=0, offset=0, ttl=255,
+                    proto=17, csum=0, src=ip_src, dst=ip_dst, option=None)
+    u = udp.udp(src_port=udp_src, dst_port=udp_dst, total_length=0, csum=0)
+    p = packet.Packet()
+    p.add_protocol(e)
+    p.add_protocol(i)
+    p.add_protocol(u)
+    p.add_protocol('\x00' * 160)
+    p.serialize()
+    return p
+
+def build_packet_dhcp(message_type, opts):
+    """
+    Build a DHCP packet for use in tests, client to server for a
+    REQUEST and server to client otherwise, parsed from its bytes as for
+    a packet-in
+    """
+    if message_type == dpkt.dhcp.DHCPREQUEST:
+        op, sport, dport = dpkt.dhcp.DHCP_OP_REQUEST, 68, 67
+    else:
+        op, sport, dport = dpkt.dhcp.DHCP_OP_REPLY, 67, 68
+    dhcp = dpkt.dhcp.DHCP(op=op,
+                          chaddr='\x00\x00\x00\x00\x00\x0b',
+                          yiaddr=struct.unpack('!I',
+                                       socket.inet_aton('10.0.0.11'))[0],
+                          opts=[(dpkt.dhcp.DHCP_OPT_MSGTYPE,
+                                 chr(message_type))] + opts)
+    u = dpkt.udp.UDP(sport=sport, dport=dport, data=str(dhcp))
+    u.ulen = len(u)
+    i = dpkt.ip.IP(src=socket.inet_aton('10.0.0.1'),
+                   dst=socket.inet_aton('10.0.0.11'), p=dpkt.ip.IP_PROTO_UDP,
+                   data=u)
+    i.len = len(i)
+    e = dpkt.ethernet.Ethernet(src='\x00\x00\x00\x00\x00\x01',
+                               dst='\x00\x00\x00\x00\x00\x0b',
+                               type=dpkt.ethernet.ETH_TYPE_IP, data=i)
+    return packet.Packet(str(e))
+
 def build_packet_tcp_22():
     """
     Build an SSH-like packet for use in tests.
@@ -4,8 +4,25 @@ Nmeta Unit Tests
 To run, type in nosetests in the nmeta directory
 """
 
+import time
+import struct
+import socket
+import sys
+import os
+import tempfile
+import shutil
+
+import dpkt
+import numpy as np
+
 import tc_policy
 import config
+import dhcp_scanner
+import tc_features
+
+#*** Offline tools aren't a package so import them from their directory:
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'misc'))
+import flowfeatures
 
 #======================== tc_policy.py Unit Tests ============================
 #*** Instantiate classes:
@@ -85,3 +102,319 @@ def test_is_match_ip_space():
                                             '192.168.56.10-192.168.56.42') == 1
     assert tc.static.is_match_ip_space('192.168.56.12', \
                                             '192.168.57.10-192.168.57.42') == 0
+
+#*** Condition Evaluation Order Tests:
+def test_order_conditions():
+    assert tc._order_conditions({'match_type': 'all',
+                                 'identity_service_dns_re': '.*\.example\.com',
+                                 'ip_src': '10.0.0.1',
+                                 'tcp_dst': 80}) == \
+                                 ['tcp_dst', 'ip_src', 'identity_service_dns_re']
+
+#*** Static Rule Compilation Tests:
+def test_compile_static_rule():
+    rule = {'comment': 'SSH from range', 'match_type': 'all',
+            'conditions_list': [{'match_type': 'any', 'tcp_src': 22,
+                                 'tcp_dst': 22},
+                                {'match_type': 'any',
+                                 'ip_src': '10.0.0.1-10.0.0.6'}],
+            'actions': {'set_qos_tag': 'QoS_treatment=high_priority'}}
+    boxes = tc._compile_static_rule(rule)
+    assert {'tcp_src': 22, 'ip_src': (167772161, 167772166)} in boxes
+    assert {'tcp_dst': 22, 'ip_src': (167772161, 167772166)} in boxes
+    assert len(boxes) == 2
+    #*** IP ranges are split into masked matches:
+    matches = tc._box_to_matches(boxes[0])
+    assert len(matches) == 4
+    assert matches[0]['eth_type'] == 0x0800
+    assert matches[0]['ip_proto'] == 6
+    #*** Non-static conditions can't be compiled:
+    rule['conditions_list'].append({'match_type': 'any',
+                                    'identity_service_dns': 'example.com'})
+    assert tc._compile_static_rule(rule) is None
+    #*** EtherType of packets are integers:
+    assert tc.static.is_match_ethertype(2048, '0x0800') == 1
+
+#*** Policy Analysis Tests:
+def test_analyze_policy():
+    actions_a = {'set_qos_tag': 'QoS_treatment=high_priority'}
+    actions_b = {'set_qos_tag': 'QoS_treatment=low_priority'}
+    ruleset = [{'match_type': 'any', 'actions': actions_a,
+                'conditions_list': [{'match_type': 'any', 'tcp_dst': 22}]},
+               {'match_type': 'any', 'actions': actions_a,
+                'conditions_list': [{'match_type': 'all', 'tcp_dst': 22,
+                                     'ip_src': '10.0.0.1'}]},
+               {'match_type': 'any', 'actions': actions_b,
+                'conditions_list': [{'match_type': 'all', 'tcp_dst': 22,
+                                     'ip_src': '10.0.0.0/24'}]},
+               {'match_type': 'any', 'actions': actions_b,
+                'conditions_list': [{'match_type': 'any',
+                                     'ip_src': '10.0.0.0/24'}]}]
+    saved_ruleset = tc.tc_ruleset
+    tc.tc_ruleset = ruleset
+    try:
+        tc.compile_static_rules()
+        analysis = tc.get_policy_analysis()
+    finally:
+        tc.tc_ruleset = saved_ruleset
+        tc.compile_static_rules()
+    assert analysis['redundant'] == [{'rule': 1, 'by': [0]}]
+    assert analysis['shadowed'] == [{'rule': 2, 'by': [0]}]
+    assert analysis['conflicting'] == [{'rule': 3, 'with': [0, 1]}]
+
+#======================== tc_identity.py Unit Tests ==========================
+#*** Identity regex memo tests:
+def test_identity_regex_match():
+    identity = tc.identity
+    identity.compile_regexes(['.*\.example\.com'])
+    assert '.*\.example\.com' in identity._regexes
+    assert identity._regex_match('.*\.example\.com', 'www.example.com')
+    assert not identity._regex_match('.*\.example\.com', 'www.example.org')
+    assert identity._regex_memo[('.*\.example\.com', 'www.example.com')]
+    #*** Patterns not seen at policy load still work:
+    assert identity._regex_match('sw[0-9]+', 'sw12')
+    tc.compile_identity_regexes()
+    assert identity._regex_memo == {}
+
+#*** DNS service suffix trie tests:
+def test_service_trie():
+    identity = tc.identity
+    identity._set_ip_service('default', '10.0.0.5', 'www.Example.com', 300,
+                             'dns')
+    assert identity._service_trie_match('default', 'example.com', '10.0.0.5')
+    assert identity._service_trie_match('default', '.example.com.',
+                                        '10.0.0.5')
+    assert identity._service_trie_match('default', 'www.example.com',
+                                        '10.0.0.5')
+    assert not identity._service_trie_match('default', 'ample.com',
+                                            '10.0.0.5')
+    assert not identity._service_trie_match('default', 'example.com',
+                                            '10.0.0.6')
+    identity._service_trie_remove('default', 'www.Example.com', '10.0.0.5')
+    del identity.id_service_ips['default']['www.Example.com']
+    assert not identity._service_trie_match('default', 'example.com',
+                                            '10.0.0.5')
+    assert identity.id_service_trie['default']['labels'] == {}
+    del identity.id_ip['default']['10.0.0.5']
+
+#*** Identity expiry heap tests:
+def test_identity_expiry():
+    identity = tc.identity
+    identity._set_ip_service('default', '10.0.0.7', 'old.example.com', 0,
+                             'dns')
+    identity._set_ip_service('default', '10.0.0.7', 'new.example.com', 0,
+                             'dns')
+    #*** Refresh one of them with a longer TTL:
+    identity._set_ip_service('default', '10.0.0.7', 'new.example.com', 300,
+                             'dns')
+    assert identity.get_service_ips('default', 'old.example.com') == {}
+    assert identity.get_service_ips('default',
+                                    'new.example.com').keys() == ['10.0.0.7']
+    identity._expire_deadlines(time.time() + 1)
+    services = identity.id_ip['default']['10.0.0.7']['service']
+    assert 'old.example.com' not in services
+    assert 'new.example.com' in services
+    #*** Refreshed entry is rescheduled at its new deadline:
+    assert identity._expiry_pending[('dns', ('default', '10.0.0.7',
+                        'new.example.com'))] == \
+                        services['new.example.com']['last_seen'] + 300
+    identity._expire_deadlines(time.time() + 301)
+    assert '10.0.0.7' not in identity.id_ip['default']
+    assert 'new.example.com' not in identity.id_service_ips['default']
+
+#======================== dns_experimental.py Unit Tests =====================
+#*** DNS response parser tests:
+def _build_dns_response():
+    dns = dpkt.dns.DNS(id=1)
+    dns.qr = dpkt.dns.DNS_R
+    dns.qd = [dpkt.dns.DNS.Q(name='www.example.com')]
+    dns.an = [dpkt.dns.DNS.RR(name='www.example.com',
+                              type=dpkt.dns.DNS_CNAME, ttl=60,
+                              cname='cdn.example.net'),
+              dpkt.dns.DNS.RR(name='cdn.example.net', type=dpkt.dns.DNS_A,
+                              ttl=30, rdata=socket.inet_aton('10.1.2.3')),
+              dpkt.dns.DNS.RR(name='cdn.example.net',
+                              type=dpkt.dns.DNS_AAAA, ttl=30,
+                              rdata=socket.inet_pton(socket.AF_INET6,
+                                                     '2001:db8::1'))]
+    return str(dns)
+
+def test_parse_dns():
+    payload = _build_dns_response()
+    result = tc.dns_parser.parse_dns(payload)
+    assert result['queries'] == ['www.example.com']
+    assert result['answers'] == [
+                    ('www.example.com', 5, 60, 'cdn.example.net'),
+                    ('cdn.example.net', 1, 30, '10.1.2.3'),
+                    ('cdn.example.net', 28, 30, '2001:db8::1')]
+    #*** DNS over TCP has a length prefix:
+    assert tc.dns_parser.parse_dns(struct.pack('!H', len(payload)) + payload,
+                                   tcp=1) == result
+    #*** Truncated, queries and pointer loops are rejected:
+    assert tc.dns_parser.parse_dns(payload[:-3]) == 0
+    query = dpkt.dns.DNS(id=1, qd=[dpkt.dns.DNS.Q(name='www.example.com')])
+    assert tc.dns_parser.parse_dns(str(query)) == 0
+    loop = payload[:12] + '\xc0\x0c' + payload[14:]
+    assert tc.dns_parser.parse_dns(loop) == 0
+
+#======================== dhcp_scanner.py Unit Tests =========================
+#*** DHCP scanner and lease expiry tests:
+def _build_dhcp(message_type, opts):
+    dhcp = dpkt.dhcp.DHCP(chaddr='\x00\x00\x00\x00\x00\x0a',
+                          yiaddr=struct.unpack('!I',
+                                       socket.inet_aton('10.0.0.10'))[0],
+                          opts=[(dpkt.dhcp.DHCP_OPT_MSGTYPE,
+                                 chr(message_type))] + opts)
+    return str(dhcp)
+
+def test_dhcp_lease():
+    request = tc.dhcp_parser.parse_dhcp(_build_dhcp(dhcp_scanner.DHCP_REQUEST,
+                        [(dpkt.dhcp.DHCP_OPT_HOSTNAME, 'host10'),
+                         (dpkt.dhcp.DHCP_OPT_REQ_IP,
+                          socket.inet_aton('10.0.0.10'))]))
+    assert request['message_type'] == dhcp_scanner.DHCP_REQUEST
+    assert request['chaddr'] == '00:00:00:00:00:0a'
+    assert request['hostname'] == 'host10'
+    assert request['requested_ip'] == '10.0.0.10'
+    ack = tc.dhcp_parser.parse_dhcp(_build_dhcp(dhcp_scanner.DHCP_ACK,
+                        [(dpkt.dhcp.DHCP_OPT_LEASE_SEC,
+                          struct.pack('!I', 3600))]))
+    assert ack['lease_time'] == 3600
+    assert ack['yiaddr'] == '10.0.0.10'
+    assert tc.dhcp_parser.parse_dhcp('\x01' * 100) == 0
+    #*** ACK picks up the host name from the REQUEST and expires on lease:
+    identity = tc.identity
+    identity.dhcp_request_in(request['chaddr'], request['hostname'])
+    identity.dhcp_in(ack['chaddr'], ack['yiaddr'], ack['hostname'],
+                     'default', ack['lease_time'])
+    assert 'host10' in identity.id_ip['default']['10.0.0.10']['node']
+    identity._expire_deadlines(time.time() + 3601)
+    assert '10.0.0.10' not in identity.id_ip['default']
+
+#======================== tc_features.py Unit Tests ==========================
+def test_flow_accumulator():
+    features = tc_features.FlowAccumulator()
+    features.update('forward', 10.0, 60, 1000, (1000, 0, 2))
+    features.update('reverse', 10.1, 1500, 2000, (2000, 1, 18))
+    features.update('forward', 10.5, 1200, 4000, (4000, 1, 16))
+    features.update('forward', 10.6, 48, 3000, (3000, 2, 16))
+    assert features.packets == 4
+    assert features.bytes == {'forward': 1308, 'reverse': 1500}
+    assert features.get_max_packet_size() == 1500
+    assert features.min_size['forward'] == 48
+    assert round(features.get_max_interpacket_interval(), 3) == 0.5
+    assert round(features.get_min_interpacket_interval(), 3) == 0.1
+    assert round(features.last_interval, 3) == 0.1
+    assert features.get_max_window_growth() == 4.0
+    assert features.size_counts[48] == 1
+    assert features.is_duplicate((2000, 1, 18))
+    assert not features.is_duplicate((2000, 1, 16))
+    assert features.get_feature_vector(['max_size', 'packets']) == \
+                                                            [1500.0, 4.0]
+
+def test_duplicate_filter():
+    duplicates = tc_features.DuplicateFilter(bits=512, hashes=4,
+                                             capacity=32)
+    for seq in range(32):
+        duplicates.add((seq, 0, 1500, 16))
+    assert all((seq, 0, 1500, 16) in duplicates for seq in range(32))
+    #*** Measure the false positive rate when full:
+    false_positives = sum((seq, 0, 1500, 16) in duplicates
+                          for seq in range(1000, 11000))
+    assert false_positives / 10000.0 < 0.01
+    assert duplicates.false_positive_rate() < 0.01
+    #*** Rotating keeps the previous generation:
+    duplicates.add((100, 0, 1500, 16))
+    assert duplicates.count == 1
+    assert (31, 0, 1500, 16) in duplicates
+    assert (100, 0, 1500, 16) in duplicates
+
+def test_flow_feature_buffer():
+    packets = tc_features.FlowFeatureBuffer(3)
+    packets.append('forward', 10.0, 60, 1000)
+    packets.append('reverse', 10.1, 1500)
+    assert len(packets) == 2
+    assert list(packets) == [('forward', 10.0, 60, 1000),
+                             ('reverse', 10.1, 1500, 0)]
+    packets.append('forward', 10.2, 52, 70000)
+    packets.append('forward', 10.3, 40, 2000)
+    #*** Oldest packet is overwritten once full:
+    assert len(packets) == 3
+    assert packets.count == 4
+    assert packets.column('sizes') == [1500, 52, 40]
+    assert packets.column('directions') == ['reverse', 'forward', 'forward']
+    assert packets.column('windows') == [0, 70000, 2000]
+
+#======================== misc/flowfeatures.py Unit Tests ====================
+#*** Flow feature extraction from captures and model training tests:
+def _build_frame(proto, ip_src, ip_dst, port_src, port_dst, seq, size):
+    if proto == 6:
+        transport = dpkt.tcp.TCP(sport=port_src, dport=port_dst, seq=seq,
+                                 flags=dpkt.tcp.TH_ACK, win=1000)
+    else:
+        transport = dpkt.udp.UDP(sport=port_src, dport=port_dst)
+    transport.data = 'x' * (size - 20 - len(transport))
+    if proto == 17:
+        transport.ulen = len(transport)
+    ip = dpkt.ip.IP(src=socket.inet_aton(ip_src), dst=socket.inet_aton(ip_dst),
+                    p=proto, id=seq, data=transport)
+    ip.len = len(ip)
+    return str(dpkt.ethernet.Ethernet(src='\x00\x00\x00\x00\x00\x01',
+                                      dst='\x00\x00\x00\x00\x00\x02',
+                                      type=dpkt.ethernet.ETH_TYPE_IP,
+                                      data=ip))
+
+def test_flow_extractor():
+    directory = tempfile.mkdtemp()
+    try:
+        capture = os.path.join(directory, 'capture.pcap')
+        with open(capture, 'wb') as capture_file:
+            writer = dpkt.pcap.Writer(capture_file)
+            for timestamp, frame in [
+                    (1.0, _build_frame(6, '10.0.0.2', '10.0.0.1', 5000, 80,
+                                       1, 60)),
+                    (1.2, _build_frame(17, '10.0.0.3', '10.0.0.4', 6881,
+                                       6881, 2, 100)),
+                    (1.5, _build_frame(6, '10.0.0.1', '10.0.0.2', 80, 5000,
+                                       3, 1500)),
+                    (2.0, _build_frame(6, '10.0.0.2', '10.0.0.1', 5000, 80,
+                                       4, 52)),
+                    (2.5, _build_frame(17, '10.0.0.4', '10.0.0.3', 6881,
+                                       6881, 5, 200)),
+                    #*** Same 5-tuple after the idle timeout is a new flow:
+                    (100.0, _build_frame(6, '10.0.0.2', '10.0.0.1', 5000, 80,
+                                         6, 60))]:
+                writer.writepkt(frame, timestamp)
+        extractor = flowfeatures.FlowExtractor(directory, first_packets=5,
+                                               idle_timeout=10)
+        extractor.read_capture(capture)
+        extractor.close()
+        assert extractor.packets == 6
+        assert extractor.flow_count == 3
+        chunk = np.load(os.path.join(directory, 'flows-00000.npz'))
+        assert chunk['proto'].tolist() == [6, 17, 6]
+        #*** Keys are canonical whichever direction the flow started in:
+        assert (chunk['ip_a'][0], chunk['port_a'][0], chunk['ip_b'][0],
+                chunk['port_b'][0]) == ('10.0.0.1', 80, '10.0.0.2', 5000)
+        assert chunk['packets'].tolist() == [3, 2, 1]
+        #*** First packets, with padding masked to 0:
+        assert chunk['sizes'][0].tolist() == [60, 1500, 52, 0, 0]
+        assert chunk['directions'][0].tolist() == [0, 1, 0, 0, 0]
+        assert np.allclose(chunk['interarrivals'][0], [0, 0.5, 0.5, 0, 0])
+        assert chunk['sizes'][1].tolist() == [100, 200, 0, 0, 0]
+        assert np.allclose(chunk['interarrivals'][1], [0, 1.3, 0, 0, 0])
+        assert chunk['sizes'][2].tolist() == [60, 0, 0, 0, 0]
+        assert not chunk['interarrivals'][2].any()
+        names = chunk['feature_names'].tolist()
+        assert chunk['features'][0][names.index('max_size')] == 1500
+        #*** Training recovers a separable labelling:
+        sizes = [1400, 1450, 1500, 1480, 60, 80, 120, 200]
+        toy_chunk = os.path.join(directory, 'toy.npz')
+        np.savez(toy_chunk, port_a=np.array([6881] * 4 + [80] * 4),
+                 port_b=np.array([50000] * 8), feature_names=np.array(
+                 ['max_size']), features=np.array([[size] for size in sizes]))
+        weights, bias = flowfeatures.train([toy_chunk], [6881], ['max_size'])
+        scores = np.array(sizes) * weights[0] + bias
+        assert (scores[:4] > 0).all() and (scores[4:] < 0).all()
+    finally:
+        shutil.rmtree(directory)